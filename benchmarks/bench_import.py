@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the startup cost of importing humanhive.
+
+Reports the time taken by `import humanhive` in a fresh interpreter, and the
+time to start each of the spawn-context child processes that HumanHive
+launches up to the point where its target module has been imported. Both are
+given relative to the cost of starting an interpreter, or spawning a child,
+that imports nothing. Spawned children re-import the main script, and with
+it numpy, so the child times are the cost of humanhive on top of numpy.
+"""
+import argparse
+import importlib
+import multiprocessing
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+# The modules each spawned child imports before it can run its target.
+CHILD_MODULES = {
+    "playback_consumer": ["humanhive.humanhive", "humanhive.audio_interface_file"],
+    "recording_consumer": ["humanhive.humanhive", "humanhive.recording"],
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(__doc__)
+
+    parser.add_argument(
+        "--repeats", type=int, default=10,
+        help="The number of times to time each startup.")
+    parser.add_argument(
+        "--backend-module", default=None,
+        help=(
+            "Also import this audio backend module in the playback_consumer "
+            "child, e.g. humanhive.audio_interface_alsa."))
+
+    return parser
+
+
+def time_interpreter(code, repeats):
+    times = np.empty(repeats)
+    for i in range(repeats):
+        st = time.perf_counter()
+        subprocess.check_call([sys.executable, "-c", code])
+        times[i] = time.perf_counter() - st
+    return times
+
+
+def import_modules(module_names):
+    for name in module_names:
+        importlib.import_module(name)
+
+
+def time_spawn(module_names, repeats):
+    """
+    Times starting a spawned child that imports module_names and exits, as
+    HumanHive's children do before entering their target function.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    times = np.empty(repeats)
+    for i in range(repeats):
+        st = time.perf_counter()
+        process = ctx.Process(target=import_modules, args=(module_names,))
+        process.start()
+        process.join()
+        times[i] = time.perf_counter() - st
+        if process.exitcode != 0:
+            raise RuntimeError(
+                "Child importing {} failed".format(module_names))
+    return times
+
+
+def report(name, times, baseline):
+    print("{:>20}: median {:8.1f} ms, {:8.1f} ms over baseline".format(
+        name, 1e3 * np.median(times),
+        1e3 * (np.median(times) - np.median(baseline))))
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+
+    child_modules = dict(CHILD_MODULES)
+    if args.backend_module is not None:
+        child_modules["playback_consumer"] = (
+            child_modules["playback_consumer"] + [args.backend_module])
+
+    interpreter = time_interpreter("pass", args.repeats)
+    report("python", interpreter, interpreter)
+    report("import humanhive",
+           time_interpreter("import humanhive", args.repeats), interpreter)
+
+    spawn = time_spawn([], args.repeats)
+    report("spawn", spawn, spawn)
+    for name, module_names in child_modules.items():
+        report(name, time_spawn(module_names, args.repeats), spawn)
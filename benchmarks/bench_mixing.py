@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the playback hot loop.
+
+Compares the preallocated Mixer against the original loop, which allocated a
+float64 mix buffer, an hstack copy of every source and several temporaries
+for each chunk. For both, reports the render time per chunk and the peak
+heap allocated while rendering a chunk, as traced by tracemalloc.
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from humanhive import samplestream
+from humanhive.playback import Mixer
+from humanhive.sources import SourceBank, SwarmSource
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(__doc__)
+
+    parser.add_argument(
+        "--n-channels", type=int, default=6,
+        help="The number of output channels.")
+    parser.add_argument(
+        "--n-sources", type=int, default=4,
+        help="The number of SwarmSources to mix.")
+    parser.add_argument(
+        "--n-frames", type=int, default=1024,
+        help="The number of frames per chunk.")
+    parser.add_argument(
+        "--n-chunks", type=int, default=500,
+        help="The number of chunks to time.")
+    parser.add_argument(
+        "--sample-rate", type=int, default=48000)
+
+    return parser
+
+
+def build_source_bank(n_sources, n_channels, sample_rate):
+    rng = np.random.RandomState(0)
+    source_bank = SourceBank()
+    for _ in range(n_sources):
+        audio_data = rng.randint(
+            -2**12, 2**12, size=10 * sample_rate).astype(np.int16)
+        source_bank.add_source(
+            SwarmSource(audio_data, n_channels, sample_rate))
+    return source_bank
+
+
+def legacy_render(source_bank, n_frames, n_channels, master_volume=1.0):
+    """
+    The per-chunk mixing loop as it was before the Mixer was introduced.
+    """
+    samples = np.zeros((n_frames, n_channels), dtype=np.float64)
+    for source in source_bank.sources:
+        frames = np.asarray(
+            source.sample.retrieve_samples(n_frames), np.float32)
+        frames_all_channels = samplestream.copy_n_channels(
+            frames, source.n_channels)
+        frames_all_channels *= source.swarm.sample_swarm_volumes(n_frames)
+        frames_all_channels *= source.volume
+        samples += frames_all_channels
+
+    samples *= master_volume
+    return np.asarray(samples, np.int16)
+
+
+def measure(render, n_chunks):
+    """
+    Returns the per-chunk render times and the peak heap allocated while
+    rendering each chunk.
+    """
+    # Warm up so that lazily allocated buffers are not counted.
+    for _ in range(10):
+        render()
+
+    times = np.empty(n_chunks)
+    for i in range(n_chunks):
+        st = time.perf_counter()
+        render()
+        times[i] = time.perf_counter() - st
+
+    tracemalloc.start()
+    heap = np.empty(n_chunks)
+    for i in range(n_chunks):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        render()
+        _, peak = tracemalloc.get_traced_memory()
+        heap[i] = peak - current
+    tracemalloc.stop()
+
+    return times, heap
+
+
+def report(name, times, heap, n_frames, sample_rate):
+    deadline = n_frames / sample_rate
+    print("{:>8}: mean {:8.1f} us, p99 {:8.1f} us, "
+          "{:5.1f}% of deadline, {:10.0f} bytes peak heap per chunk".format(
+              name,
+              1e6 * times.mean(),
+              1e6 * np.percentile(times, 99),
+              100 * times.mean() / deadline,
+              heap.mean()))
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+
+    legacy_bank = build_source_bank(
+        args.n_sources, args.n_channels, args.sample_rate)
+    mixer_bank = build_source_bank(
+        args.n_sources, args.n_channels, args.sample_rate)
+
+    mixer = Mixer(mixer_bank, args.n_channels, args.n_frames)
+    out = np.empty((args.n_frames, args.n_channels), dtype=np.int16)
+
+    legacy = measure(
+        lambda: legacy_render(legacy_bank, args.n_frames, args.n_channels),
+        args.n_chunks)
+    mixed = measure(lambda: mixer.render(out=out), args.n_chunks)
+
+    print("{} sources, {} channels, {} frames per chunk".format(
+        args.n_sources, args.n_channels, args.n_frames))
+    report("legacy", legacy[0], legacy[1], args.n_frames, args.sample_rate)
+    report("mixer", mixed[0], mixed[1], args.n_frames, args.sample_rate)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Benchmarks Swarm.sample_swarm_positions against the original per-sample
+implementation, and checks that both produce the same path from the same
+random seed.
+"""
+import argparse
+import time
+
+import numpy as np
+from humanhive import swarm, hive
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(__doc__)
+
+    parser.add_argument(
+        "--duration", type=float, default=60,
+        help="The duration of the path to generate in seconds.")
+    parser.add_argument(
+        "--sample-rate", type=int, default=41000)
+    parser.add_argument(
+        "--swarm-speed", type=float, default=3.,
+        help="The speed of the swarm in m/s.")
+    parser.add_argument(
+        "--seed", type=int, default=0)
+
+    return parser
+
+
+def legacy_sample_swarm_positions(self, n_samples):
+    """
+    Swarm.sample_swarm_positions as it was before it was vectorized, moving
+    the swarm one sample at a time. Uses the swarm's hive angles, so that it
+    follows the same hives as the vectorized version for any layout.
+    """
+    min_linger_time = 3 # s
+    max_linger_time = 30 # s
+    linger_options = range(min_linger_time, max_linger_time)
+
+    hive_no = np.random.randint(self.n_hives)
+    self.swarm_position = self.hive_angles[hive_no]
+
+    total_samples = n_samples
+    s_counter = 0
+    positions = np.empty((total_samples, 2))
+
+    increment = self.swarm_speed_rad/self.sample_rate
+    tolerance = increment
+
+    while s_counter < total_samples:
+        t_stay = linger_options[np.random.randint(len(linger_options))]
+        sample_num = t_stay * self.sample_rate
+        new_s_counter = s_counter + sample_num
+
+        current_position = np.array(
+            [[self.hive_radius * np.cos(self.swarm_position),
+              self.hive_radius * np.sin(self.swarm_position)]])
+
+        if s_counter + sample_num < total_samples:
+            positions[s_counter:new_s_counter, :] = \
+                np.full([sample_num,2], current_position)
+        else:
+            positions[s_counter:,:] = \
+                np.full([total_samples-s_counter,2], current_position)
+
+        hive_no = np.random.randint(self.n_hives)
+        destination_angle = self.hive_angles[hive_no]
+
+        s_dir = 2 * np.random.randint(2) - 1
+
+        while (new_s_counter < total_samples and
+                self.swarm_position != destination_angle):
+            self.swarm_position = self.swarm_position + s_dir*increment
+            current_position = (
+                np.array([[self.hive_radius * np.cos(self.swarm_position),
+                self.hive_radius * np.sin(self.swarm_position)]]))
+
+            positions[new_s_counter, :] = current_position
+
+            new_s_counter += 1
+
+            pos = (
+                self.swarm_position -
+                np.floor(self.swarm_position/(2*np.pi)) * 2 * np.pi)
+            if abs(destination_angle - pos) < tolerance:
+                self.swarm_position = destination_angle
+
+        s_counter = new_s_counter
+
+    return positions
+
+
+def time_positions(sample_positions, n_samples, seed):
+    np.random.seed(seed)
+    st = time.perf_counter()
+    positions = sample_positions(n_samples)
+    return positions, time.perf_counter() - st
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+
+    hive_radius = 3.
+    hives = hive.generate_hive_circle(6, hive_radius)
+    n_samples = int(args.duration * args.sample_rate)
+
+    def make_swarm():
+        return swarm.Swarm(
+            hive_radius, hives, args.swarm_speed, args.sample_rate)
+
+    legacy_swarm = make_swarm()
+    legacy, legacy_time = time_positions(
+        lambda n: legacy_sample_swarm_positions(legacy_swarm, n),
+        n_samples, args.seed)
+    vectorized, vectorized_time = time_positions(
+        make_swarm().sample_swarm_positions, n_samples, args.seed)
+
+    print("{} samples ({} s at {} Hz)".format(
+        n_samples, args.duration, args.sample_rate))
+    print("    legacy: {:8.3f} s".format(legacy_time))
+    print("vectorized: {:8.3f} s ({:.0f}x faster)".format(
+        vectorized_time, legacy_time / vectorized_time))
+    print("max position difference: {:.3g}".format(
+        np.abs(legacy - vectorized).max()))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Benchmarks SwarmVoicePool against mixing one SwarmSource per voice.
+"""
+import argparse
+import time
+
+import numpy as np
+from humanhive import hive
+from humanhive.playback import Mixer
+from humanhive.sources import SourceBank, SwarmSource
+from humanhive.voicepool import SwarmVoicePool
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(__doc__)
+
+    parser.add_argument(
+        "--n-channels", type=int, default=16,
+        help="The number of output channels.")
+    parser.add_argument(
+        "--n-voices", type=int, nargs="+", default=[1, 10, 100, 300],
+        help="The numbers of voices to benchmark.")
+    parser.add_argument(
+        "--n-frames", type=int, default=1024,
+        help="The number of frames per chunk.")
+    parser.add_argument(
+        "--n-chunks", type=int, default=50,
+        help="The number of chunks to time.")
+    parser.add_argument(
+        "--sample-rate", type=int, default=48000)
+
+    return parser
+
+
+def time_chunks(render, n_chunks):
+    render()
+    st = time.perf_counter()
+    for _ in range(n_chunks):
+        render()
+    return (time.perf_counter() - st) / n_chunks
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+
+    rng = np.random.RandomState(0)
+    hives = hive.generate_hive_circle(args.n_channels, 3)
+    deadline = args.n_frames / args.sample_rate
+    out = np.empty((args.n_frames, args.n_channels), dtype=np.float32)
+
+    print("{} channels, {} frames per chunk".format(
+        args.n_channels, args.n_frames))
+    for n_voices in args.n_voices:
+        voices_audio = [
+            rng.randint(-2**12, 2**12, size=5 * args.sample_rate).astype(np.int16)
+            for _ in range(n_voices)]
+
+        source_bank = SourceBank()
+        for audio_data in voices_audio:
+            source_bank.add_source(
+                SwarmSource(audio_data, args.n_channels, args.sample_rate))
+        mixer = Mixer(source_bank, args.n_channels, args.n_frames)
+
+        pool = SwarmVoicePool(hives, args.sample_rate, max_voices=n_voices)
+        for audio_data in voices_audio:
+            pool.add_voice(audio_data)
+
+        sources_time = time_chunks(mixer.render, args.n_chunks)
+        pool_time = time_chunks(
+            lambda: pool.get_frames(args.n_frames, out=out), args.n_chunks)
+
+        print("{:4d} voices: sources {:8.1f} us ({:5.1f}% of deadline), "
+              "pool {:8.1f} us ({:5.1f}% of deadline)".format(
+                  n_voices,
+                  1e6 * sources_time, 100 * sources_time / deadline,
+                  1e6 * pool_time, 100 * pool_time / deadline))
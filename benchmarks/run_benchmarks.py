@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+Runs the benchmark suite for the mixing, swarm and I/O paths.
+
+Each case is timed over a sweep of channel counts, chunk sizes and, where it
+applies, source counts. Per-chunk cases are also reported as a fraction of
+the real-time deadline, the time a chunk takes to play. Results are written
+as JSON and can be compared against a saved baseline; the script exits with
+status 1 if any case regressed or came too close to the deadline.
+
+Save a baseline:
+    python benchmarks/run_benchmarks.py --output baseline.json
+
+Compare against it:
+    python benchmarks/run_benchmarks.py --baseline baseline.json
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+from humanhive import hive, samplestream, swarm
+from humanhive.automation import GainAutomation
+from humanhive.playback import PlaybackQueueProducer
+from humanhive.ringbuffer import SharedRingBuffer
+from humanhive.sources import SourceBank, SwarmSource
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument(
+        "--cases", nargs="+", default=None,
+        help="The cases to run. Defaults to all of: {}.".format(
+            ", ".join(CASES)))
+    parser.add_argument(
+        "--n-channels", type=int, nargs="+", default=[2, 6, 16, 64],
+        help="The numbers of output channels to sweep over.")
+    parser.add_argument(
+        "--n-frames", type=int, nargs="+", default=[64, 256, 1024, 8192],
+        help="The chunk sizes to sweep over.")
+    parser.add_argument(
+        "--n-sources", type=int, nargs="+", default=[1, 4, 16],
+        help="The numbers of sources to sweep over, for cases that mix.")
+    parser.add_argument(
+        "--sample-rate", type=int, default=48000)
+    parser.add_argument(
+        "--repeats", type=int, default=50,
+        help="The number of timed calls for each configuration.")
+    parser.add_argument(
+        "--output", default=None,
+        help="Write the results to this JSON file.")
+    parser.add_argument(
+        "--baseline", default=None,
+        help="A JSON file of earlier results to compare against.")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help=(
+            "Flag a regression if the p99 time is more than this fraction "
+            "slower than the baseline."))
+    parser.add_argument(
+        "--deadline-threshold", type=float, default=0.5,
+        help=(
+            "Flag any per-chunk case whose p99 time takes more than this "
+            "fraction of the real-time deadline."))
+
+    return parser
+
+
+def random_audio(n_samples, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randint(-2**12, 2**12, size=n_samples).astype(np.int16)
+
+
+def build_source_bank(n_sources, n_channels, sample_rate):
+    source_bank = SourceBank()
+    for i in range(n_sources):
+        source_bank.add_source(
+            SwarmSource(
+                random_audio(10 * sample_rate, seed=i),
+                n_channels,
+                sample_rate))
+    return source_bank
+
+
+# Each case takes the sweep parameters and returns a function that runs one
+# iteration of the benchmark. Setup happens outside the returned function so
+# that only the work done per chunk is timed.
+
+def swarm_source_get_frames(n_channels, n_frames, sample_rate, **kwargs):
+    source = SwarmSource(random_audio(10 * sample_rate), n_channels, sample_rate)
+    out = np.empty((n_frames, n_channels), dtype=np.float32)
+    return lambda: source.get_frames(n_frames, out=out)
+
+
+def swarm_linear_positions(n_channels, n_frames, sample_rate, **kwargs):
+    hives = hive.generate_hive_circle(n_channels, 3)
+    swarm_linear = swarm.SwarmLinear(hives, 0.1, sample_rate)
+    out = np.empty((n_frames, 2))
+    return lambda: swarm_linear.sample_swarm_positions(n_frames, out=out)
+
+
+def swarm_positions(n_channels, n_frames, sample_rate, **kwargs):
+    hive_radius = 3
+    hives = hive.generate_hive_circle(n_channels, hive_radius)
+    circular_swarm = swarm.Swarm(hive_radius, hives, 3., sample_rate)
+    out = np.empty((n_frames, 2))
+    return lambda: circular_swarm.sample_swarm_positions(n_frames, out=out)
+
+
+def hive_volumes(n_channels, n_frames, sample_rate, **kwargs):
+    hives = hive.generate_hive_circle(n_channels, 3)
+    positions = np.random.RandomState(0).uniform(-3, 3, size=(n_frames, 2))
+    out = np.empty((n_frames, n_channels), dtype=np.float32)
+    return lambda: swarm.hive_volumes(hives, positions, out=out)
+
+
+def path_positions(n_frames, hive_radius=3):
+    """
+    Positions along a short arc of the circle of hives, as a swarm covers in
+    one chunk of control ticks.
+    """
+    theta = np.linspace(0, 0.1, n_frames)
+    return hive_radius * np.stack((np.cos(theta), np.sin(theta)), axis=1)
+
+
+def hive_volumes_dense(n_channels, n_frames, sample_rate, **kwargs):
+    kernel = swarm.GainKernel(hive.generate_hive_circle(n_channels, 3))
+    positions = path_positions(n_frames)
+    out = np.empty((n_frames, n_channels), dtype=np.float32)
+    return lambda: kernel(positions, out=out)
+
+
+def hive_volumes_sparse(n_channels, n_frames, sample_rate, **kwargs):
+    kernel = swarm.SparseGainKernel(hive.generate_hive_circle(n_channels, 3))
+    positions = path_positions(n_frames)
+    return lambda: kernel.sparse(positions)
+
+
+def swarm_source_mix(n_channels, n_frames, sample_rate,
+                     gain_threshold=None, control_rate_divisor=64, **kwargs):
+    source = SwarmSource(
+        random_audio(10 * sample_rate), n_channels, sample_rate,
+        control_rate_divisor=control_rate_divisor,
+        gain_threshold=gain_threshold)
+    bus = np.zeros((n_frames, n_channels), dtype=np.float32)
+    scratch = np.empty((n_frames, n_channels), dtype=np.float32)
+    return lambda: source.mix_into(bus, scratch)
+
+
+def swarm_source_mix_sparse(n_channels, n_frames, sample_rate, **kwargs):
+    return swarm_source_mix(
+        n_channels, n_frames, sample_rate, gain_threshold=1e-3)
+
+
+def swarm_source_mix_full_rate(n_channels, n_frames, sample_rate, **kwargs):
+    return swarm_source_mix(
+        n_channels, n_frames, sample_rate, control_rate_divisor=1)
+
+
+def swarm_source_mix_full_rate_sparse(
+        n_channels, n_frames, sample_rate, **kwargs):
+    return swarm_source_mix(
+        n_channels, n_frames, sample_rate, gain_threshold=1e-3,
+        control_rate_divisor=1)
+
+
+def gain_table_volumes(n_channels, n_frames, sample_rate, tmp_dir, **kwargs):
+    hives = hive.generate_hive_circle(n_channels, 3)
+    gain_table = hive.GainTable(hives, cache_dir=tmp_dir)
+    positions = np.random.RandomState(0).uniform(-3, 3, size=(n_frames, 2))
+    out = np.empty((n_frames, n_channels), dtype=np.float32)
+    return lambda: gain_table(positions, out=out)
+
+
+def swarm_source_mix_automation(
+        n_channels, n_frames, sample_rate, tmp_dir, **kwargs):
+    gains = GainAutomation(
+        hive.HiveLayout.circle(n_channels, 3), sample_rate, duration=60,
+        cache_dir=tmp_dir)
+    source = SwarmSource(
+        random_audio(10 * sample_rate), n_channels, sample_rate,
+        automation=gains)
+    bus = np.zeros((n_frames, n_channels), dtype=np.float32)
+    scratch = np.empty((n_frames, n_channels), dtype=np.float32)
+    return lambda: source.mix_into(bus, scratch)
+
+
+def sample_stream_retrieve(n_frames, sample_rate, **kwargs):
+    # A short buffer so that the loop point is crossed regularly.
+    sample = samplestream.SampleStream(random_audio(sample_rate + 1))
+    out = np.empty(n_frames, dtype=np.int16)
+    return lambda: sample.retrieve_samples(n_frames, out=out)
+
+
+def load_wave_file(n_channels, sample_rate, tmp_dir, **kwargs):
+    """
+    Opens a 10 second file and reads every sample of its first channel, as
+    a source does over one pass of its loop.
+    """
+    path = os.path.join(tmp_dir, "bench_{}.wav".format(n_channels))
+    if not os.path.exists(path):
+        with wave.open(path, "wb") as wf:
+            wf.setnchannels(n_channels)
+            wf.setsampwidth(2)
+            wf.setframerate(sample_rate)
+            wf.writeframes(random_audio(10 * sample_rate * n_channels))
+
+    def run():
+        audio = samplestream.load_wave_file(path, mono=True)
+        return np.array(audio)
+    return run
+
+
+def producer_chunk(n_channels, n_frames, n_sources, sample_rate, **kwargs):
+    playback_buffer = SharedRingBuffer(2, n_frames, n_channels)
+    producer = PlaybackQueueProducer(
+        build_source_bank(n_sources, n_channels, sample_rate),
+        playback_buffer,
+        n_channels,
+        sample_rate,
+        n_frames)
+
+    def run():
+        producer.run(n_chunks=1)
+        playback_buffer.read_chunk(block=False)
+        playback_buffer.commit_read()
+    run.close = playback_buffer.close
+    return run
+
+
+# The sweep parameters each case depends on, and whether it runs once per
+# chunk and so has a real-time deadline.
+CASES = {
+    "swarm_source_get_frames": (
+        swarm_source_get_frames, ("n_channels", "n_frames"), True),
+    "swarm_linear_positions": (
+        swarm_linear_positions, ("n_channels", "n_frames"), True),
+    "swarm_positions": (
+        swarm_positions, ("n_channels", "n_frames"), True),
+    "hive_volumes": (
+        hive_volumes, ("n_channels", "n_frames"), True),
+    "hive_volumes_dense": (
+        hive_volumes_dense, ("n_channels", "n_frames"), True),
+    "hive_volumes_sparse": (
+        hive_volumes_sparse, ("n_channels", "n_frames"), True),
+    "swarm_source_mix": (
+        swarm_source_mix, ("n_channels", "n_frames"), True),
+    "swarm_source_mix_sparse": (
+        swarm_source_mix_sparse, ("n_channels", "n_frames"), True),
+    "swarm_source_mix_full_rate": (
+        swarm_source_mix_full_rate, ("n_channels", "n_frames"), True),
+    "swarm_source_mix_full_rate_sparse": (
+        swarm_source_mix_full_rate_sparse, ("n_channels", "n_frames"), True),
+    "gain_table_volumes": (
+        gain_table_volumes, ("n_channels", "n_frames"), True),
+    "swarm_source_mix_automation": (
+        swarm_source_mix_automation, ("n_channels", "n_frames"), True),
+    "sample_stream_retrieve": (
+        sample_stream_retrieve, ("n_frames",), True),
+    "load_wave_file": (
+        load_wave_file, ("n_channels",), False),
+    "producer_chunk": (
+        producer_chunk, ("n_channels", "n_frames", "n_sources"), True),
+}
+
+
+def measure(run, repeats):
+    """
+    Returns the times of repeats calls to run, after a few warm up calls.
+    """
+    for _ in range(3):
+        run()
+    times = np.empty(repeats)
+    for i in range(repeats):
+        st = time.perf_counter()
+        run()
+        times[i] = time.perf_counter() - st
+    return times
+
+
+def run_case(name, params, sample_rate, repeats, tmp_dir):
+    build, _, per_chunk = CASES[name]
+
+    # The swarms report their decisions on stdout; keep them out of the
+    # report.
+    np.random.seed(0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        run = build(sample_rate=sample_rate, tmp_dir=tmp_dir, **params)
+        try:
+            times = measure(run, repeats)
+        finally:
+            if hasattr(run, "close"):
+                run.close()
+
+    result = {
+        "case": name,
+        "params": params,
+        "mean": times.mean(),
+        "p50": np.percentile(times, 50),
+        "p99": np.percentile(times, 99),
+        "deadline": None,
+        "deadline_fraction": None,
+    }
+    if per_chunk:
+        result["deadline"] = params["n_frames"] / sample_rate
+        result["deadline_fraction"] = result["p99"] / result["deadline"]
+    return result
+
+
+def result_key(result):
+    return (result["case"], tuple(sorted(result["params"].items())))
+
+
+def check_results(results, baseline, tolerance, deadline_threshold):
+    """
+    Returns a list of messages describing results that regressed against
+    the baseline or came within deadline_threshold of the deadline.
+    """
+    baseline_results = {}
+    if baseline is not None:
+        baseline_results = {
+            result_key(result): result for result in baseline["results"]}
+
+    flags = []
+    for result in results:
+        description = "{} {}".format(result["case"], result["params"])
+
+        previous = baseline_results.get(result_key(result))
+        if previous is not None:
+            slowdown = result["p99"] / previous["p99"] - 1
+            if slowdown > tolerance:
+                flags.append(
+                    "{}: p99 {:.1f} us is {:.0f}% slower than the "
+                    "baseline {:.1f} us".format(
+                        description, 1e6 * result["p99"], 100 * slowdown,
+                        1e6 * previous["p99"]))
+
+        fraction = result["deadline_fraction"]
+        if fraction is not None and fraction > deadline_threshold:
+            flags.append(
+                "{}: p99 takes {:.0f}% of the {:.2f} ms deadline".format(
+                    description, 100 * fraction, 1e3 * result["deadline"]))
+    return flags
+
+
+def report(result):
+    params = " ".join(
+        "{}={}".format(key, value) for key, value in result["params"].items())
+    line = "{:>24} {:<40} mean {:10.1f} us, p99 {:10.1f} us".format(
+        result["case"], params, 1e6 * result["mean"], 1e6 * result["p99"])
+    if result["deadline_fraction"] is not None:
+        line += ", {:6.1f}% of deadline".format(
+            100 * result["deadline_fraction"])
+    print(line)
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+
+    cases = args.cases if args.cases is not None else list(CASES)
+    unknown = set(cases) - set(CASES)
+    if unknown:
+        sys.exit("Unknown cases: {}".format(", ".join(sorted(unknown))))
+
+    sweep = {
+        "n_channels": args.n_channels,
+        "n_frames": args.n_frames,
+        "n_sources": args.n_sources,
+    }
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in cases:
+            _, param_names, _ = CASES[name]
+            for values in itertools.product(
+                    *[sweep[param] for param in param_names]):
+                params = dict(zip(param_names, values))
+                result = run_case(
+                    name, params, args.sample_rate, args.repeats, tmp_dir)
+                report(result)
+                results.append(result)
+
+    output = {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "time": time.time(),
+        },
+        "sample_rate": args.sample_rate,
+        "repeats": args.repeats,
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    flags = check_results(
+        results, baseline, args.tolerance, args.deadline_threshold)
+    for flag in flags:
+        print("FLAG: {}".format(flag))
+    sys.exit(1 if flags else 0)
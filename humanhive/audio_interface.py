@@ -1,58 +1,156 @@
+import collections
 import pyaudio
 import numpy as np
 import time
+from .metrics import Metrics
+from .ringbuffer import FrameReader
+
+
+# The PortAudio format for each sample format of the playback ring buffer
+PA_FORMATS = {
+    np.dtype(np.int16): pyaudio.paInt16,
+    np.dtype(np.int32): pyaudio.paInt32,
+    np.dtype(np.float32): pyaudio.paFloat32,
+}
+
+
+def input_to_int16(in_data, dtype, n_channels):
+    """
+    Converts a buffer of recorded input in the stream's sample format to
+    int16 frames, the format the recording process works in.
+    """
+    samples = np.frombuffer(in_data, dtype=dtype).reshape(-1, n_channels)
+    if dtype == np.int16:
+        return samples
+    if dtype == np.int32:
+        return (samples >> 16).astype(np.int16)
+    return np.clip(samples * 32768, -32768, 32767).astype(np.int16)
 
 
 class AudioInterface:
     """
     Manages the sound interface. This manages the main callback for the audio
     interface and delegates behaviour to the Playback and Recording modules.
+
+    The stream runs in callback mode. PortAudio calls audio_callback() from
+    its own thread once per period, and the callback only copies frames out
+    of the pre-filled playback ring buffer and hands input to a local deque.
+    It never blocks: if the ring is empty the period is padded with silence
+    and counted as an underrun. run() forwards recorded input to the
+    recording queue from the main thread, where blocking is harmless.
+
+    The stream's sample format is that of the playback ring buffer: int16,
+    int32 or float32. Input shares the duplex stream's format and is
+    converted to int16 before it is sent to the recording queue.
     """
 
     def __init__(self,
-                 playback,
+                 playback_buffer,
                  recording_queue,
                  n_channels,
                  sample_rate,
                  sample_width,
                  output_device_id,
                  input_device_id,
-                 frame_count=1024):
-        self.playback = playback
+                 frame_count=1024,
+                 metrics=None,
+                 period_size=None,
+                 periods=None,
+                 input_channels=None,
+                 prefill_chunks=2):
+        """
+        Parameters
+        ----------
+        frame_count: int
+            The number of frames in each chunk of the playback ring buffer.
+        period_size: int or None
+            The number of frames per callback, e.g. 128 or 256 for low
+            latency. Defaults to frame_count. PortAudio uses the device's
+            default low latency for the rest of its buffering.
+        periods: int or None
+            Ignored. PyAudio does not expose the number of device periods.
+        input_channels: int or None
+            Ignored. Input and output share one duplex stream, so input has
+            n_channels channels.
+        prefill_chunks: int
+            The number of chunks to wait for in the playback ring buffer
+            before starting the stream.
+        """
+        self.playback_buffer = playback_buffer
         self.recording_queue = recording_queue
         self.n_channels = n_channels
         self.sample_rate = sample_rate
         self.sample_width = sample_width
         self.frame_count = frame_count
-
-        print("frame_count: {}".format(frame_count))
+        if period_size is None:
+            period_size = frame_count
+        self.period_size = period_size
+        self.prefill_chunks = min(prefill_chunks, playback_buffer.n_chunks)
+        self.dtype = playback_buffer.dtype
+        if self.dtype not in PA_FORMATS:
+            raise ValueError(
+                "Unsupported sample format: {}".format(self.dtype))
+
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        # Create everything the callback touches up front, so that the
+        # exporting thread never sees the metrics change size.
+        for name in ["output_xruns", "input_xruns", "ring_underruns",
+                     "underrun_frames", "dropped_input"]:
+            metrics.increment(name, 0)
+        self.callback_time = metrics.histogram("callback_time")
+        self.frame_reader = FrameReader(
+            playback_buffer, metrics.histogram("end_to_end_latency"))
+
+        # Output is assembled here, sized for the largest period PortAudio
+        # may ask for.
+        self.out_buffer = np.zeros(
+            (max(period_size, frame_count), n_channels), dtype=self.dtype)
+
+        # Input chunks waiting to be forwarded to the recording queue. Bounded
+        # so that a stalled recording process cannot grow it without limit.
+        self.input_chunks = collections.deque(maxlen=64)
+
+        print("frame_count: {}, period_size: {}".format(
+            frame_count, period_size))
 
         # Initialise pyaudio interface
         self.p = pyaudio.PyAudio()
 
         output_device_id = int(output_device_id)
-        input_device_id = int(input_device_id)
-
-
         print("Output device parameters for device with id: {}\n{}".format(
             output_device_id, self.p.get_device_info_by_index(output_device_id)))
-        print("Input device parameters for device with id: {}\n{}".format(
-            input_device_id, self.p.get_device_info_by_index(input_device_id)))
+
+        record = recording_queue is not None
+        if record:
+            input_device_id = int(input_device_id)
+            print("Input device parameters for device with id: {}\n{}".format(
+                input_device_id,
+                self.p.get_device_info_by_index(input_device_id)))
+        else:
+            input_device_id = None
 
         self.stream = self.p.open(
-            format=self.p.get_format_from_width(2),
+            format=PA_FORMATS[self.dtype],
             channels=self.n_channels,
             rate=self.sample_rate,
             output_device_index=output_device_id,
             input_device_index=input_device_id,
-            input=True,
+            input=record,
             output=True,
-            #stream_callback=self.audio_callback,
+            frames_per_buffer=period_size,
+            start=False,
+            stream_callback=self.audio_callback,
             )
 
         print("Finished initialising audio")
 
     def start_stream(self):
+        # Let the producer fill the ring first, so the stream does not start
+        # with an underrun.
+        while self.playback_buffer.fill_level() < self.prefill_chunks:
+            time.sleep(self.playback_buffer.poll_interval)
         self.stream.start_stream()
 
 
@@ -66,20 +164,48 @@ class AudioInterface:
     def is_active(self):
         return self.stream.is_active()
 
-
-    # def audio_callback(in_data, frame_count, time_info, status):
-    #     pass
-
+    def audio_callback(self, in_data, frame_count, time_info, status):
+        """
+        Called by PortAudio from its callback thread for each period. Must
+        not block.
+        """
+        st = time.perf_counter()
+        metrics = self.metrics
+
+        if status & pyaudio.paOutputUnderflow:
+            metrics.increment("output_xruns")
+        if status & pyaudio.paInputOverflow:
+            metrics.increment("input_xruns")
+
+        if in_data is not None and self.recording_queue is not None:
+            if len(self.input_chunks) == self.input_chunks.maxlen:
+                metrics.increment("dropped_input")
+            self.input_chunks.append(in_data)
+
+        if frame_count > len(self.out_buffer):
+            # Only happens if PortAudio asks for more than the requested
+            # period; allocating here is better than not playing.
+            self.out_buffer = np.zeros(
+                (frame_count, self.n_channels), dtype=self.dtype)
+        out = self.out_buffer[:frame_count]
+        n_read = self.frame_reader.read_frames(out)
+        if n_read < frame_count:
+            out[n_read:] = 0
+            metrics.increment("ring_underruns")
+            metrics.increment("underrun_frames", frame_count - n_read)
+
+        self.callback_time.record(time.perf_counter() - st)
+        return out.tobytes(), pyaudio.paContinue
 
     def run(self):
-        while True:
-            # Send recording data
-            if self.recording_queue is not None:
-                in_data = self.stream.read(self.frame_count, exception_on_overflow=False)
-                in_data = np.frombuffer(in_data, dtype=np.int16).reshape(-1, 2)
-                self.recording_queue.put(in_data, block=False)
-
-            # Get output audio
-            samples = self.playback.get()
-
-            self.stream.write(samples, self.frame_count, exception_on_underflow=False)
+        """
+        Forwards recorded input to the recording queue and exports metrics
+        while the stream runs in its callback thread.
+        """
+        while self.stream.is_active():
+            while self.input_chunks:
+                in_data = self.input_chunks.popleft()
+                self.recording_queue.put(
+                    input_to_int16(in_data, self.dtype, self.n_channels))
+            self.metrics.maybe_export()
+            time.sleep(self.period_size / self.sample_rate)
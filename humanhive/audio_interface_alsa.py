@@ -1,55 +1,123 @@
+import queue
+import select
 import time
 import alsaaudio
 import numpy as np
+from .metrics import Metrics
+from .ringbuffer import FrameReader
+
+
+# The ALSA format for each sample format of the playback ring buffer
+PCM_FORMATS = {
+    np.dtype(np.int16): alsaaudio.PCM_FORMAT_S16_LE,
+    np.dtype(np.int32): alsaaudio.PCM_FORMAT_S32_LE,
+    np.dtype(np.float32): alsaaudio.PCM_FORMAT_FLOAT_LE,
+}
 
 
 class AudioInterface:
     """
     Manages the sound interface. This manages the main callback for the audio
     interface and delegates behaviour to the Playback and Recording modules.
+
+    Capture and playback PCMs are both opened non-blocking and polled
+    together, so each is serviced as soon as the device is ready and a late
+    capture period can no longer hold up the next playback write. Playback is
+    written a period at a time from the playback ring buffer. Xruns are
+    counted and the PCM recovered in place, without reopening the stream.
+
+    pyalsaaudio does not expose ALSA's mmap transfer, so periods are copied
+    with writei/readi.
+
+    Playback uses the sample format of the playback ring buffer: S16_LE,
+    S32_LE or FLOAT_LE. Capture is always S16_LE.
     """
 
     def __init__(self,
-                 playback_queue,
+                 playback_buffer,
                  recording_queue,
                  n_channels,
                  sample_rate,
                  sample_width,
                  output_device_id,
                  input_device_id,
-                 frame_count=1024):
-        self.playback_queue = playback_queue
+                 frame_count=1024,
+                 metrics=None,
+                 period_size=None,
+                 periods=4,
+                 input_channels=2):
+        """
+        Parameters
+        ----------
+        frame_count: int
+            The number of frames in each chunk of the playback ring buffer.
+        period_size: int or None
+            The number of frames per ALSA period. Defaults to frame_count.
+        periods: int
+            The number of periods in the ALSA buffer. The output latency of
+            the device is roughly periods * period_size frames.
+        input_channels: int
+            The number of capture channels.
+        """
+        self.playback_buffer = playback_buffer
         self.recording_queue = recording_queue
         self.n_channels = n_channels
         self.sample_rate = sample_rate
         self.sample_width = sample_width
         self.frame_count = frame_count
-
-        print("frame_count: {}".format(frame_count))
+        if period_size is None:
+            period_size = frame_count
+        self.period_size = period_size
+        self.periods = periods
+        self.input_channels = input_channels
+        self.dtype = playback_buffer.dtype
+        if self.dtype not in PCM_FORMATS:
+            raise ValueError(
+                "Unsupported sample format: {}".format(self.dtype))
+
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+
+        self.write_latency = metrics.histogram("write_latency")
+        self.frame_reader = FrameReader(
+            playback_buffer, metrics.histogram("end_to_end_latency"))
+        # The period being written to the device, and the range of its
+        # frames still to be written.
+        self.period = np.zeros((period_size, n_channels), dtype=self.dtype)
+        self.period_start = 0
+        self.period_end = 0
+
+        print("frame_count: {}, period_size: {}, periods: {}".format(
+            frame_count, period_size, periods))
 
         print("available cards: {}".format(alsaaudio.cards()))
         print("available PCMs: {}".format(alsaaudio.pcms()))
 
-        self.in_stream = alsaaudio.PCM(
-            type=alsaaudio.PCM_CAPTURE,
-#            mode=alsaaudio.PCM_NONBLOCK,
-            device=input_device_id)
-        self.in_stream.setchannels(2)
-        self.in_stream.setrate(self.sample_rate)
-        self.in_stream.setformat(alsaaudio.PCM_FORMAT_S16_LE)
-        self.in_stream.setperiodsize(self.frame_count)
-        print("in_stream card: {}".format(self.in_stream.cardname()))
+        self.in_stream = None
+        if self.recording_queue is not None:
+            self.in_stream = alsaaudio.PCM(
+                type=alsaaudio.PCM_CAPTURE,
+                mode=alsaaudio.PCM_NONBLOCK,
+                device=input_device_id,
+                channels=self.input_channels,
+                rate=self.sample_rate,
+                format=alsaaudio.PCM_FORMAT_S16_LE,
+                periodsize=self.period_size,
+                periods=self.periods)
+            print("in_stream card: {}".format(self.in_stream.cardname()))
 
         self.out_stream = alsaaudio.PCM(
             type=alsaaudio.PCM_PLAYBACK,
-            device=output_device_id)
-        self.out_stream.setchannels(self.n_channels)
-        self.out_stream.setrate(self.sample_rate)
-        self.out_stream.setformat(alsaaudio.PCM_FORMAT_S16_LE)
-        self.out_stream.setperiodsize(self.frame_count)
+            mode=alsaaudio.PCM_NONBLOCK,
+            device=output_device_id,
+            channels=self.n_channels,
+            rate=self.sample_rate,
+            format=PCM_FORMATS[self.dtype],
+            periodsize=self.period_size,
+            periods=self.periods)
         print("out_stream card: {}".format(self.out_stream.cardname()))
 
-
         print("Finished initialising audio")
 
 
@@ -58,30 +126,101 @@ class AudioInterface:
 
 
     def close_stream(self):
-        pass
+        if self.in_stream is not None:
+            self.in_stream.close()
+        self.out_stream.close()
 
 
     def is_active(self):
         return True
 
-    def run(self):
+    def _register(self, poller, stream, events):
+        fds = []
+        for fd, _ in stream.polldescriptors():
+            poller.register(fd, events)
+            fds.append(fd)
+        return fds
+
+    def service_capture(self):
+        """
+        Reads every period the capture device has ready and forwards them to
+        the recording queue without blocking.
+        """
+        metrics = self.metrics
         while True:
-            st = time.time()
+            n_frames, data = self.in_stream.read()
+            if n_frames == 0:
+                return
+            if n_frames < 0:
+                # Overrun. pyalsaaudio has already re-prepared the PCM, so
+                # capture resumes with the next read.
+                metrics.increment("input_xruns")
+                return
+            in_data = np.frombuffer(data, dtype=np.int16).reshape(
+                -1, self.input_channels)
+            try:
+                self.recording_queue.put(in_data, block=False)
+            except queue.Full:
+                metrics.increment("dropped_input")
+
+    def service_playback(self):
+        """
+        Writes periods from the playback ring buffer until the device buffer
+        is full or the ring is empty. Returns False if it stopped because the
+        ring is empty.
+        """
+        metrics = self.metrics
+        while True:
+            if self.period_start == self.period_end:
+                n_read = self.frame_reader.read_frames(self.period)
+                if n_read == 0:
+                    return False
+                self.period_start = 0
+                self.period_end = n_read
+
+            st = time.monotonic()
+            n_written = self.out_stream.write(
+                self.period[self.period_start:self.period_end])
+            self.write_latency.record(time.monotonic() - st)
+
+            if n_written == 0:
+                # The device buffer is full; wait for the next poll.
+                return True
+            if n_written < 0:
+                # Underrun. The PCM has been re-prepared, so the period is
+                # written again on the next pass.
+                metrics.increment("output_xruns")
+                return True
+            self.period_start += n_written
 
-            # Send recording data
-            if self.recording_queue is not None:
-                pass
-                in_data = self.in_stream.read()
-                if in_data[0]:
-                     recdata = np.frombuffer(in_data[1], dtype=np.int16).reshape(-1, 2)
-                     self.recording_queue.put(recdata, block=False)
+    def run(self):
+        metrics = self.metrics
 
-            # Get output audio
-            samples = self.playback_queue.get()
+        poller = select.poll()
+        out_fds = self._register(poller, self.out_stream, select.POLLOUT)
+        if self.in_stream is not None:
+            self._register(poller, self.in_stream, select.POLLIN)
 
-            te = time.time() - st
-            # print("Time elapsed: {}".format(te))
+        # Wait for the producer before starting, then keep the device
+        # buffer topped up.
+        while self.playback_buffer.fill_level() == 0:
+            time.sleep(self.playback_buffer.poll_interval)
 
-            st = time.time()
-            self.out_stream.write(samples)
-            #print("Write time: {}".format(time.time() - st))
+        ring_empty = False
+        while True:
+            # While the ring is empty, don't wake for the output. Poll with a
+            # short timeout instead, to pick up the next chunk when it lands.
+            timeout = self.playback_buffer.poll_interval if ring_empty else None
+            for fd in out_fds:
+                poller.modify(fd, 0 if ring_empty else select.POLLOUT)
+            poller.poll(None if timeout is None else 1e3 * timeout)
+
+            if self.in_stream is not None:
+                self.service_capture()
+
+            has_data = self.service_playback()
+            if not has_data and not ring_empty:
+                metrics.increment("ring_underruns")
+            ring_empty = not has_data
+
+            metrics.maybe_export()
@@ -0,0 +1,115 @@
+import os
+import time
+import wave
+import numpy as np
+from .metrics import Metrics
+
+
+class AudioInterface:
+    """
+    An audio interface without a sound card. Drains the playback ring buffer
+    as fast as it is filled and writes the audio to a file, or discards it.
+    Used for offline rendering and for running on headless machines.
+
+    The output device is the path of the file to write: a WAV file if the
+    path ends in .wav, otherwise raw interleaved samples. If it is None, or
+    anything else that isn't a path, such as the device index the other
+    backends default to, the audio is discarded. There is no input, so nothing is ever sent to the
+    recording queue. period_size, periods and input_channels are accepted for
+    compatibility with the device backends and ignored.
+
+    Samples are written in the format of the playback ring buffer. WAV files
+    hold int16 or int32 PCM; float32 output must be written raw.
+    """
+
+    def __init__(self,
+                 playback_buffer,
+                 recording_queue,
+                 n_channels,
+                 sample_rate,
+                 sample_width,
+                 output_device_id,
+                 input_device_id=None,
+                 frame_count=1024,
+                 metrics=None,
+                 period_size=None,
+                 periods=None,
+                 input_channels=None):
+        self.playback_buffer = playback_buffer
+        self.recording_queue = recording_queue
+        self.n_channels = n_channels
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.frame_count = frame_count
+
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+
+        self.dtype = playback_buffer.dtype
+        self.path = None
+        if isinstance(output_device_id, (str, os.PathLike)):
+            self.path = output_device_id
+        self.wave_file = None
+        self.raw_file = None
+        if self.path is None:
+            pass
+        elif str(self.path).lower().endswith(".wav"):
+            if self.dtype.kind != "i":
+                raise ValueError(
+                    "WAV output needs an integer sample format, not {}".format(
+                        self.dtype))
+            self.wave_file = wave.open(str(self.path), "wb")
+            self.wave_file.setnchannels(self.n_channels)
+            self.wave_file.setsampwidth(self.dtype.itemsize)
+            self.wave_file.setframerate(self.sample_rate)
+        else:
+            self.raw_file = open(self.path, "wb")
+
+        self.n_frames_written = 0
+
+    def start_stream(self):
+        pass
+
+    def close_stream(self):
+        """
+        Closes the output file. WAV headers are only complete once the file
+        has been closed.
+        """
+        if self.wave_file is not None:
+            self.wave_file.close()
+            self.wave_file = None
+        if self.raw_file is not None:
+            self.raw_file.close()
+            self.raw_file = None
+
+    def is_active(self):
+        return True
+
+    def write(self, samples):
+        if self.wave_file is not None:
+            self.wave_file.writeframesraw(np.ascontiguousarray(samples))
+        elif self.raw_file is not None:
+            self.raw_file.write(np.ascontiguousarray(samples))
+        self.n_frames_written += len(samples)
+
+    def run(self, n_chunks=None):
+        """
+        Writes chunks from the playback ring buffer to the output. If n_chunks
+        is given, returns after writing that many chunks, otherwise runs
+        forever.
+        """
+        metrics = self.metrics
+        write_latency = metrics.histogram("write_latency")
+
+        while n_chunks is None or n_chunks > 0:
+            samples = self.playback_buffer.read_chunk()
+
+            st = time.monotonic()
+            self.write(samples)
+            self.playback_buffer.commit_read()
+            write_latency.record(time.monotonic() - st)
+            metrics.maybe_export()
+
+            if n_chunks is not None:
+                n_chunks -= 1
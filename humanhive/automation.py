@@ -0,0 +1,303 @@
+"""
+automation module
+
+Pre-renders the hive gains of a swarm over a long trajectory, so that they can
+be played back without modelling the swarm. The gains are rendered once at
+control rate, stored compactly on disk as float16 or uint8, and memory mapped
+on later runs, so restarting the installation is instant and the producer
+spends no time on the swarm while it plays.
+
+The trajectory is looped. Its start is crossfaded with the trajectory's
+continuation past the end, so the swarm carries on smoothly over the loop
+point rather than jumping back to where it started.
+"""
+import hashlib
+import os
+import numpy as np
+from . import samplestream
+from .hive import default_cache_dir
+from .swarm import SwarmLinear
+
+
+# The formats gains can be stored in, and the scale from stored values back
+# to gains.
+AUTOMATION_FORMATS = {
+    "float16": (np.dtype(np.float16), 1.),
+    "uint8": (np.dtype(np.uint8), 1 / 255),
+}
+
+
+class GainAutomation:
+    """
+    The gain of each hive over a long swarm trajectory, rendered at control
+    rate and cached on disk as a .npy file, keyed by the layout, seed, swarm
+    speed, sample rate and the other parameters of the rendering.
+
+    The table is memory mapped rather than read, so only the pages that are
+    played are ever loaded. Use player() to play it back.
+    """
+
+    # Bump when the way automation is rendered changes, to invalidate caches.
+    version = 2
+
+    def __init__(self,
+                 layout,
+                 sample_rate,
+                 seed=0,
+                 swarm_speed=0.1,
+                 duration=600.,
+                 control_rate_divisor=64,
+                 crossfade=5.,
+                 sample_format="float16",
+                 cache_dir=None,
+                 use_cache=True):
+        """
+        Parameters
+        ----------
+        layout: hive.HiveLayout
+            The positions of the hives, and the gain function of the swarm.
+        sample_rate: int
+            The audio sample rate the automation is played at.
+        seed: int
+            Seeds the swarm's random choices of direction and destination.
+        swarm_speed: float
+            The speed of the swarm, as for swarm.SwarmLinear.
+        duration: float
+            The length of the loop, in seconds.
+        control_rate_divisor: int
+            The number of audio frames per rendered tick. The gains are
+            interpolated linearly between ticks.
+        crossfade: float
+            The length of the crossfade at the loop point, in seconds.
+        sample_format: str
+            "float16", or "uint8" for half the size. uint8 steps the gains by
+            1/255, which interpolation smooths but which can be heard on
+            quiet sources.
+        cache_dir: str or None
+            Directory to cache automation in. Defaults to
+            hive.default_cache_dir().
+        use_cache: bool
+            If False, the automation is always rendered, into memory, and
+            not saved.
+        """
+        if sample_format not in AUTOMATION_FORMATS:
+            raise ValueError(
+                "Unknown automation format: {}".format(sample_format))
+        self.layout = layout
+        self.n_hives = layout.n_hives
+        self.sample_rate = sample_rate
+        self.seed = seed
+        self.swarm_speed = swarm_speed
+        self.control_rate_divisor = control_rate_divisor
+        self.sample_format = sample_format
+        self.dtype, self.scale = AUTOMATION_FORMATS[sample_format]
+
+        self.tick_rate = sample_rate / control_rate_divisor
+        self.n_ticks = max(int(round(duration * self.tick_rate)), 1)
+        self.n_crossfade_ticks = min(
+            int(round(crossfade * self.tick_rate)), self.n_ticks)
+        # The length of the loop in audio frames
+        self.n_frames = self.n_ticks * control_rate_divisor
+
+        self.loaded_from_cache = False
+        self.cache_file = None
+        if use_cache:
+            if cache_dir is None:
+                cache_dir = default_cache_dir()
+            self.cache_file = os.path.join(
+                cache_dir, "automation_{}.npy".format(self.key()))
+            if os.path.exists(self.cache_file):
+                self.table = np.load(self.cache_file, mmap_mode="r")
+                self.loaded_from_cache = True
+
+        if not self.loaded_from_cache:
+            if self.cache_file is None:
+                self.table = np.empty(
+                    (self.n_ticks, self.n_hives), dtype=self.dtype)
+                self._render(self.table)
+            else:
+                self._render_to_file(self.cache_file)
+                self.table = np.load(self.cache_file, mmap_mode="r")
+
+    def key(self):
+        """
+        Returns a hash identifying the automation, from the hive positions
+        and the rendering parameters.
+        """
+        h = hashlib.sha1()
+        h.update(self.layout.hives.tobytes())
+        h.update(repr((
+            self.version, self.layout.hives.shape,
+            self.layout.use_gain_table, self.seed, self.swarm_speed,
+            self.sample_rate, self.control_rate_divisor, self.n_ticks,
+            self.n_crossfade_ticks, self.sample_format)).encode())
+        return h.hexdigest()[:16]
+
+    def _quantise(self, gains, out):
+        if self.dtype.kind == "u":
+            gains = np.rint(gains / self.scale)
+            np.clip(gains, 0, np.iinfo(self.dtype).max, out=gains)
+        np.copyto(out, gains, casting="unsafe")
+
+    def _render(self, table, block_size=4096):
+        """
+        Renders the trajectory into table, (n_ticks, n_hives), a block of
+        ticks at a time.
+        """
+        swarm = SwarmLinear(
+            hives=self.layout.hives,
+            swarm_speed=self.swarm_speed,
+            sample_rate=self.tick_rate,
+            gain_kernel=self.layout.gain_kernel(),
+            seed=self.seed)
+
+        n_fade = self.n_crossfade_ticks
+        # The first block holds every tick of the crossfade
+        block_size = max(block_size, n_fade)
+        gains = np.empty((block_size, self.n_hives), dtype=np.float32)
+        head = None
+        for start in range(0, self.n_ticks, block_size):
+            n = min(block_size, self.n_ticks - start)
+            swarm.sample_swarm_volumes(n, out=gains[:n])
+            if head is None:
+                head = gains[:n_fade].copy()
+            self._quantise(gains[:n], table[start:start + n])
+        # Where the swarm would have gone after the end of the loop
+        tail = swarm.sample_swarm_volumes(n_fade)
+
+        # Fade from the continuation of the trajectory into its start, so
+        # the tick after the last is where the swarm would have been next.
+        if n_fade == 0:
+            return
+        weights = (np.arange(n_fade, dtype=np.float32) / n_fade)[:,np.newaxis]
+        head *= weights
+        head += (1 - weights) * tail
+        self._quantise(head, table[:n_fade])
+
+    def _render_to_file(self, filename):
+        # Render into a memory mapped temporary file, then rename, so that a
+        # process reading the cache never sees partly rendered automation.
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        table = np.lib.format.open_memmap(
+            tmp_filename, mode="w+", dtype=self.dtype,
+            shape=(self.n_ticks, self.n_hives))
+        self._render(table)
+        table.flush()
+        del table
+        os.replace(tmp_filename, filename)
+
+    def player(self, start_frame=0):
+        """
+        Returns an AutomationPlayer that plays the automation from
+        start_frame.
+        """
+        return AutomationPlayer(self, start_frame)
+
+
+class AutomationPlayer:
+    """
+    Plays back a GainAutomation in place of a swarm. The stored ticks of each
+    chunk are read, wrapping around the loop, and interpolated up to audio
+    rate. Any number of players can share one automation, each with its own
+    position in the loop.
+    """
+
+    def __init__(self, automation, start_frame=0):
+        self.automation = automation
+        self.n_hives = automation.n_hives
+        self.hives = automation.layout.hives
+        self.control_rate_divisor = automation.control_rate_divisor
+        self.seek(start_frame)
+
+        # Interpolation weights for the ticks at the start and end of a tick,
+        # for each frame within the tick
+        ramp = (
+            np.arange(self.control_rate_divisor, dtype=np.float32) /
+            self.control_rate_divisor)
+        self._weights = np.stack((1 - ramp, ramp), axis=1)
+        # Interpolation indices and weights, by chunk size and position
+        # within a tick, so chunks aligned with the ticks reuse them.
+        self._interpolation = {}
+        # Reusable buffer for the ticks of a chunk, allocated on first use
+        # and whenever more ticks are needed.
+        self._ticks = None
+
+    def seek(self, frame):
+        """
+        Moves playback to frame, wrapped into the loop. Takes constant time.
+        """
+        self.frame = int(frame) % self.automation.n_frames
+
+    def _interpolation_for(self, phase, n_samples):
+        key = (phase, n_samples)
+        interpolation = self._interpolation.get(key)
+        if interpolation is None:
+            K = self.control_rate_divisor
+            frames = phase + np.arange(n_samples)
+            interpolation = self._interpolation[key] = (
+                frames // K,
+                ((frames % K).astype(np.float32) / K)[:,np.newaxis])
+        return interpolation
+
+    def sample_swarm_volumes(self, n_samples, out=None, channels=None):
+        """
+        Samples the volume of each hive for the next n_samples frames.
+
+        Parameters
+        ----------
+        n_samples: int
+            The number of samples to generate.
+        out: array_like, (N, H) float32 or None
+            If given, the volumes are written into this array.
+        channels: array_like of int or None
+            If given, only the volumes of these hives are interpolated, and
+            out is (N, len(channels)).
+
+        Returns
+        -------
+        volumes: array_like, (N, H)
+            The volume for each hive at each sample.
+        """
+        automation = self.automation
+        K = self.control_rate_divisor
+        n_hives = self.n_hives if channels is None else len(channels)
+        if out is None:
+            out = np.empty((n_samples, n_hives), dtype=np.float32)
+        if n_samples == 0:
+            return out
+
+        first_tick, phase = divmod(self.frame, K)
+        n_ticks = (phase + n_samples - 1) // K + 2
+        if self._ticks is None or self._ticks.shape[0] < n_ticks:
+            self._ticks = np.empty((n_ticks, self.n_hives), dtype=np.float32)
+        ticks = samplestream.read_looped(
+            automation.table, first_tick, n_ticks, out=self._ticks[:n_ticks])
+        if automation.scale != 1.:
+            ticks *= automation.scale
+        if channels is not None:
+            ticks = ticks[:, channels]
+
+        if phase == 0 and n_samples % K == 0:
+            # Chunk is aligned with the ticks, so interpolate a whole tick at
+            # a time, as swarm.ControlRateSwarm does.
+            n_chunk_ticks = n_samples // K
+            tick_pairs = np.ndarray(
+                (n_chunk_ticks, 2, n_hives),
+                dtype=ticks.dtype,
+                buffer=np.ascontiguousarray(ticks),
+                strides=(ticks.strides[0],) + ticks.strides)
+            blocks = out.reshape(n_chunk_ticks, K, n_hives)
+            np.matmul(self._weights, tick_pairs, out=blocks)
+            if not np.may_share_memory(blocks, out):
+                # out couldn't be reshaped in place, so the volumes went
+                # into a copy.
+                np.copyto(out, blocks.reshape(n_samples, n_hives))
+        else:
+            index, fractions = self._interpolation_for(phase, n_samples)
+            np.subtract(ticks[index + 1], ticks[index], out=out)
+            out *= fractions
+            out += ticks[index]
+
+        self.seek(self.frame + n_samples)
+        return out
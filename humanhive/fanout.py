@@ -0,0 +1,269 @@
+"""
+fanout module
+
+Plays one mix over several sound cards. The mixer renders every channel once
+and each card is given its own slice of the channels, through its own shared
+ring buffer and AudioInterface process.
+
+The cards' clocks drift apart slowly. The first card is the reference: the
+producer is paced by its ring, and its slice is copied across unchanged. The
+slice for every other card is resampled by a ratio very close to one, which
+a DriftCompensator adjusts to keep that card's ring as full as the
+reference's.
+"""
+import time
+import numpy as np
+from .playback import PlaybackQueueProducer, clip_and_cast
+
+
+def split_channels(n_channels, device_channels=None, n_devices=1):
+    """
+    Returns a slice of the mix channels for each device.
+
+    Parameters
+    ----------
+    n_channels: int
+        The total number of channels in the mix.
+    device_channels: list of int or None
+        The number of channels on each device, in order. Must sum to
+        n_channels. If None, the channels are split evenly over n_devices.
+    n_devices: int
+        The number of devices, used if device_channels is None.
+    """
+    if device_channels is None:
+        if n_channels % n_devices != 0:
+            raise ValueError(
+                "Cannot split {} channels evenly over {} devices".format(
+                    n_channels, n_devices))
+        device_channels = [n_channels // n_devices] * n_devices
+    if sum(device_channels) != n_channels:
+        raise ValueError(
+            "Device channels {} do not add up to {} channels".format(
+                device_channels, n_channels))
+
+    starts = np.cumsum([0] + list(device_channels))
+    return [slice(int(start), int(end))
+            for start, end in zip(starts[:-1], starts[1:])]
+
+
+class DriftCompensator:
+    """
+    Estimates the resampling ratio that keeps a device's ring buffer level
+    with the reference device's, with a proportional-integral controller on
+    the difference in fill levels.
+
+    The ratio is the number of input frames consumed per output frame. If a
+    device's clock runs fast, its ring drains faster than the reference's,
+    and the ratio drops below one so that more frames are produced for it.
+    """
+
+    def __init__(self,
+                 n_frames_per_chunk,
+                 max_correction=1e-3,
+                 proportional_gain=2e-4,
+                 integral_gain=5e-8,
+                 smoothing=0.002):
+        """
+        Parameters
+        ----------
+        n_frames_per_chunk: int
+            The number of frames in each ring buffer chunk.
+        max_correction: float
+            The largest adjustment to the ratio, e.g. 1e-3 is 1000ppm. Far
+            beyond real clock drift, but small enough to be inaudible.
+        proportional_gain: float
+            Change in ratio per chunk of fill level difference.
+        integral_gain: float
+            Change in ratio per chunk of accumulated fill level difference,
+            per update. Removes the steady state error that constant drift
+            leaves with proportional control alone.
+        smoothing: float
+            Weight of each new fill level difference in its moving average.
+            Fill levels move in whole chunks, so are smoothed heavily before
+            use; otherwise the ratio jitters with every chunk read.
+        """
+        self.n_frames_per_chunk = n_frames_per_chunk
+        self.max_correction = max_correction
+        self.proportional_gain = proportional_gain
+        self.integral_gain = integral_gain
+        self.smoothing = smoothing
+
+        self.error = 0.
+        self.integral = 0.
+        self.ratio = 1.
+
+    def update(self, fill_difference):
+        """
+        Updates the ratio from the latest fill level difference, in frames,
+        of the device's ring minus the reference's, and returns it.
+        """
+        error = fill_difference / self.n_frames_per_chunk
+        self.error += self.smoothing * (error - self.error)
+
+        # Only integrate while the output is not saturated, so the integral
+        # cannot wind up while the ring recovers from a large offset.
+        correction = (
+            self.proportional_gain * self.error +
+            self.integral_gain * self.integral)
+        if abs(correction) < self.max_correction:
+            self.integral += self.error
+
+        self.ratio = 1. + np.clip(
+            correction, -self.max_correction, self.max_correction)
+        return self.ratio
+
+
+class DeviceOutput:
+    """
+    Feeds one device's slice of the mix into its ring buffer, resampled by
+    the ratio from its DriftCompensator.
+
+    Each chunk of the mix is linearly interpolated into a small FIFO, and
+    whole chunks are moved from the FIFO to the ring as they become
+    available, so a chunk of the mix may give zero, one or two ring chunks.
+    """
+
+    def __init__(self, ring, channels, compensator):
+        self.ring = ring
+        self.channels = channels
+        self.compensator = compensator
+
+        n_frames = ring.n_frames
+        n_channels = ring.n_channels
+        # The last input frame of the previous chunk, followed by the
+        # current chunk, so that interpolation runs across chunk boundaries.
+        self.input = np.zeros((n_frames + 1, n_channels), dtype=np.float32)
+        # Position of the next output frame, relative to the last input
+        # frame of the previous chunk.
+        self.phase = 0.
+        # Resampled frames waiting for a full chunk. Room for two chunks
+        # plus the extra frames from a ratio below one.
+        self.fifo = np.zeros((3 * n_frames, n_channels), dtype=np.float32)
+        self.n_fifo = 0
+
+    def fill_level(self):
+        return (self.ring.fill_level() * self.ring.n_frames) + self.n_fifo
+
+    def push(self, frames, timestamp):
+        """
+        Resamples a chunk of the mix into the FIFO and writes any full chunks
+        to the ring. Returns the number of frames dropped because the ring
+        was full.
+        """
+        ratio = self.compensator.ratio
+        n_frames = len(frames)
+        self.input[1:] = frames
+
+        # Output frames are taken at phase, phase + ratio, ... up to but not
+        # including the last input frame, which is kept for the next chunk.
+        n_out = int(np.ceil((n_frames - self.phase) / ratio))
+        n_out = min(n_out, len(self.fifo) - self.n_fifo)
+        positions = self.phase + ratio * np.arange(n_out)
+        index = positions.astype(np.int64)
+        frac = (positions - index).astype(np.float32)[:, np.newaxis]
+
+        out = self.fifo[self.n_fifo:self.n_fifo + n_out]
+        np.subtract(self.input[index + 1], self.input[index], out=out)
+        out *= frac
+        out += self.input[index]
+        self.n_fifo += n_out
+
+        self.phase += n_out * ratio - n_frames
+        self.input[0] = self.input[-1]
+
+        n_dropped = 0
+        while self.n_fifo >= self.ring.n_frames:
+            slot = self.ring.write_chunk(block=False)
+            n_chunk = self.ring.n_frames
+            if slot is None:
+                # The device has stalled. Drop the chunk rather than hold up
+                # the other devices.
+                n_dropped += n_chunk
+            else:
+                clip_and_cast(self.fifo[:n_chunk], slot)
+                self.ring.commit_write(timestamp)
+            self.fifo[:self.n_fifo - n_chunk] = self.fifo[n_chunk:self.n_fifo]
+            self.n_fifo -= n_chunk
+        return n_dropped
+
+
+class FanoutQueueProducer(PlaybackQueueProducer):
+    """
+    Keeps the playback ring buffers of several devices filled, each with its
+    own slice of the mix channels.
+
+    The first device is the reference. The producer waits on its ring as
+    PlaybackQueueProducer does, and casts its slice of the mix straight into
+    it. The other devices' slices are resampled to follow their own clocks.
+    """
+
+    def __init__(self,
+                 source_bank,
+                 playback_buffers,
+                 n_channels,
+                 sample_rate,
+                 n_samples_per_chunk,
+                 device_channels=None,
+                 master_volume=1.0,
+                 metrics=None,
+                 limiter=None,
+                 scheduler=None):
+        """
+        Parameters
+        ----------
+        playback_buffers: list of SharedRingBuffer
+            The ring buffer for each device, with the reference device first.
+            Each ring's n_channels is the number of channels on its device.
+        n_channels: int
+            The total number of channels in the mix.
+        device_channels: list of int or None
+            The number of channels on each device. Defaults to the number of
+            channels of each ring buffer.
+        """
+        super().__init__(
+            source_bank,
+            playback_buffers[0],
+            n_channels,
+            sample_rate,
+            n_samples_per_chunk,
+            master_volume=master_volume,
+            metrics=metrics,
+            limiter=limiter,
+            scheduler=scheduler)
+
+        if device_channels is None:
+            device_channels = [ring.n_channels for ring in playback_buffers]
+        self.playback_buffers = playback_buffers
+        self.channel_slices = split_channels(n_channels, device_channels)
+
+        self.devices = [
+            DeviceOutput(
+                ring, channels, DriftCompensator(n_samples_per_chunk))
+            for ring, channels in zip(
+                playback_buffers[1:], self.channel_slices[1:])]
+
+        for i in range(len(self.devices)):
+            self.metrics.increment("device_{}_dropped_frames".format(i + 1), 0)
+
+    def render_chunk(self, slot):
+        bus = self.mixer.render()
+        timestamp = time.monotonic()
+
+        clip_and_cast(bus[:, self.channel_slices[0]], slot)
+        self.playback_buffer.commit_write(timestamp)
+
+        reference_fill = (
+            self.playback_buffer.fill_level() * self.n_samples_per_chunk)
+        for i, device in enumerate(self.devices):
+            device.compensator.update(device.fill_level() - reference_fill)
+            n_dropped = device.push(bus[:, device.channels], timestamp)
+            if n_dropped:
+                self.metrics.increment(
+                    "device_{}_dropped_frames".format(i + 1), n_dropped)
+
+    def drift_ratios(self):
+        """
+        Returns the current resampling ratio of each device after the
+        reference.
+        """
+        return [device.compensator.ratio for device in self.devices]
@@ -1,16 +1,305 @@
 """
 The Human Hive
 """
+import hashlib
+import itertools
+import json
+import os
 import numpy as np
+from .swarm import GainKernel
 
 def generate_hive_circle(n_hives, hive_radius):
     """
-    Space the hives evenly around a circle. 0 angle is the top bar hive
+    Space the hives evenly around a circle, starting at an angle of pi/12.
     """
-    hives = []
+    theta = np.pi/12 + 2*np.pi*np.arange(n_hives)/n_hives
+    hives = np.empty((n_hives, 2))
+    hives[:,0] = hive_radius * np.cos(theta)
+    hives[:,1] = hive_radius * np.sin(theta)
+    return hives
 
-    for i in range(n_hives):
-        theta = np.pi/12 + i*np.pi/6
-        hives.append([hive_radius * np.cos(theta), hive_radius * np.sin(theta)])
 
-    return hives
+def default_cache_dir():
+    """
+    Returns the directory that gain tables are cached in: $HUMANHIVE_CACHE
+    if set, otherwise ~/.cache/humanhive.
+    """
+    return os.environ.get(
+        "HUMANHIVE_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "humanhive"))
+
+
+class HiveLayout:
+    """
+    The positions of the hives in an installation, in 2D or 3D.
+
+    Layouts are stored as JSON files of the form
+
+        {"name": "courtyard", "hives": [[x, y], [x, y], ...]}
+
+    with one coordinate list per hive, in metres, in channel order. An
+    optional "gain_table": true makes swarms look their gains up from a
+    precomputed GainTable rather than evaluating the kernel directly.
+    """
+
+    def __init__(self, hives, name=None, use_gain_table=False):
+        self.hives = np.asarray(hives, dtype=np.float64)
+        if self.hives.ndim != 2 or self.hives.shape[1] not in (2, 3):
+            raise ValueError(
+                "Hives must be an (H, 2) or (H, 3) array, got shape {}".format(
+                    self.hives.shape))
+        self.name = name
+        self.use_gain_table = use_gain_table
+        # Gain tables already built for this layout, by their parameters.
+        self._gain_tables = {}
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename) as f:
+            config = json.load(f)
+        return cls(
+            config["hives"],
+            name=config.get("name"),
+            use_gain_table=config.get("gain_table", False))
+
+    @classmethod
+    def circle(cls, n_hives, hive_radius):
+        return cls(
+            generate_hive_circle(n_hives, hive_radius),
+            name="circle_{}_{}".format(n_hives, hive_radius))
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"name": self.name,
+                       "hives": self.hives.tolist(),
+                       "gain_table": self.use_gain_table}, f, indent=2)
+
+    @property
+    def n_hives(self):
+        return len(self.hives)
+
+    @property
+    def n_dims(self):
+        return self.hives.shape[1]
+
+    def gain_kernel(self, sigma=1):
+        """
+        Returns the function swarms use to compute hive volumes from swarm
+        positions for this layout: its GainTable if the layout uses one,
+        otherwise a GainKernel.
+        """
+        if self.use_gain_table:
+            return self.gain_table(sigma)
+        return GainKernel(self.hives, sigma=sigma)
+
+    def gain_table(self, sigma=1, **kwargs):
+        """
+        Returns the GainTable for this layout, building or loading it the
+        first time it is asked for. kwargs are passed on to GainTable.
+        """
+        key = (sigma,) + tuple(sorted(kwargs.items()))
+        table = self._gain_tables.get(key)
+        if table is None:
+            table = self._gain_tables[key] = GainTable(
+                self.hives, sigma=sigma, **kwargs)
+        return table
+
+
+class GainTable:
+    """
+    The gaussian gain kernel of swarm.GainKernel, precomputed for every hive
+    over a regular grid of positions and interpolated linearly between grid
+    points (bilinearly in 2D, trilinearly in 3D). Evaluating a position is
+    then a few gathers from the table rather than an exp for every hive.
+
+    Tables are cached on disk, keyed by the hive positions and the table
+    parameters, so a layout only has to be computed once.
+
+    Instances are called like a GainKernel, and can be used in its place.
+    Each position costs 2^D gathered rows of the table, so a table is only
+    faster than evaluating the gaussian directly when the kernel is
+    expensive; its use is in fixing the cost of a gain function regardless
+    of its shape.
+    """
+
+    # Bump when the way tables are computed changes, to invalidate caches.
+    version = 1
+
+    def __init__(self,
+                 hives,
+                 sigma=1,
+                 resolution=0.05,
+                 margin=None,
+                 cache_dir=None,
+                 use_cache=True):
+        """
+        Parameters
+        ----------
+        hives: array_like, (H, D)
+            The positions of the hives, with D 2 or 3.
+        sigma: float
+            The width of the kernel, as for swarm.GainKernel.
+        resolution: float
+            The spacing of the grid, in the same units as the hives. The
+            interpolation error is at most about
+            D * resolution^2 / (4 sigma^2), 1.25e-3 by default in 2D.
+        margin: float or None
+            How far the grid extends beyond the outermost hives. Positions
+            outside the grid are clamped to its edge. Defaults to 3 sigma,
+            beyond which the gains are below 1e-4.
+        cache_dir: str or None
+            Directory to cache tables in. Defaults to default_cache_dir().
+        use_cache: bool
+            If False, the table is always computed and not saved.
+        """
+        self.hives = np.asarray(hives, dtype=np.float64)
+        self.n_hives, self.n_dims = self.hives.shape
+        self.sigma = sigma
+        self.resolution = resolution
+        if margin is None:
+            margin = 3 * sigma
+        self.margin = margin
+
+        self.lower = self.hives.min(axis=0) - margin
+        upper = self.hives.max(axis=0) + margin
+        self.grid_shape = tuple(
+            int(n) + 1 for n in np.ceil((upper - self.lower) / resolution))
+        # Strides of each grid dimension in the flattened table
+        self.grid_strides = np.array(
+            [int(np.prod(self.grid_shape[d+1:])) for d in range(self.n_dims)])
+
+        self.loaded_from_cache = False
+        self.cache_file = None
+        if use_cache:
+            if cache_dir is None:
+                cache_dir = default_cache_dir()
+            self.cache_file = os.path.join(
+                cache_dir, "gain_table_{}.npy".format(self.key()))
+            if os.path.exists(self.cache_file):
+                self.table = np.load(self.cache_file)
+                self.loaded_from_cache = True
+
+        if not self.loaded_from_cache:
+            self.table = self._compute(GainKernel(self.hives, sigma=sigma))
+            if self.cache_file is not None:
+                self._save(self.table, self.cache_file)
+
+        # Corners of a grid cell, as offsets along each dimension and as
+        # offsets into the flattened table.
+        self.corners = np.array(
+            list(itertools.product([0, 1], repeat=self.n_dims)))
+        self.corner_offsets = (self.corners @ self.grid_strides)[:,np.newaxis]
+        self.n_corners = len(self.corners)
+        # Largest grid position, leaving every cell an upper neighbour in
+        # each dimension
+        self.grid_limit = np.array(self.grid_shape, dtype=np.float32) - 1.001
+
+        # Reusable scratch buffers, allocated on first use and whenever the
+        # number of positions changes.
+        self._n_positions = None
+
+    def key(self):
+        """
+        Returns a hash identifying the table, from the hive positions and the
+        table parameters.
+        """
+        h = hashlib.sha1()
+        h.update(self.hives.tobytes())
+        h.update(repr((self.version, self.n_hives, self.n_dims, self.sigma,
+                       self.resolution, self.margin)).encode())
+        return h.hexdigest()[:16]
+
+    def _compute(self, gain_kernel):
+        n_points = int(np.prod(self.grid_shape))
+        table = np.empty((n_points, self.n_hives), dtype=np.float32)
+
+        axes = [self.lower[d] + self.resolution * np.arange(n)
+                for d, n in enumerate(self.grid_shape)]
+        # One slice of the grid along the first dimension at a time, to bound
+        # the size of the temporaries.
+        slab = n_points // self.grid_shape[0]
+        rest = np.stack(
+            np.meshgrid(*axes[1:], indexing="ij"), axis=-1).reshape(slab, -1)
+        positions = np.empty((slab, self.n_dims), dtype=np.float32)
+        positions[:,1:] = rest
+        for i, x in enumerate(axes[0]):
+            positions[:,0] = x
+            gain_kernel(positions, out=table[i*slab:(i+1)*slab])
+        return table
+
+    def _save(self, table, filename):
+        # Write then rename, so that a process reading the cache never sees
+        # a partly written table.
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmp_filename, "wb") as f:
+            np.save(f, table)
+        os.replace(tmp_filename, filename)
+
+    def _ensure_scratch(self, n_positions):
+        if self._n_positions != n_positions:
+            self._n_positions = n_positions
+            N, D, C = n_positions, self.n_dims, self.n_corners
+            self._grid_positions = np.empty((N, D), dtype=np.float32)
+            self._cells = np.empty((N, D), dtype=np.int64)
+            # Weights of the lower and upper corner along each dimension
+            self._fractions = np.empty((2, N, D), dtype=np.float32)
+            # Index into the flattened fractions of the weight of each corner
+            # along each dimension, for each position, (C, D, N)
+            self._weight_index = (
+                self.corners[:,:,np.newaxis] * N * D +
+                np.arange(N) * D +
+                np.arange(D)[:,np.newaxis])
+            self._corner_weights = np.empty((C, D, N), dtype=np.float32)
+            self._weights = np.empty((C, N, 1), dtype=np.float32)
+            self._base_index = np.empty(N, dtype=np.int64)
+            self._index = np.empty((C, N), dtype=np.int64)
+            self._gathered = np.empty((C, N, self.n_hives), dtype=np.float32)
+
+    def __call__(self, positions, out=None):
+        """
+        Parameters
+        ----------
+        positions: array_like, (N, D)
+            The position of the swarm at each sample.
+        out: array_like, (N, H) float32 or None
+            If given, the volumes are written into this array.
+
+        Returns
+        -------
+        volumes: array_like, (N, H)
+            The volume for each hive at each sample.
+        """
+        positions = np.asarray(positions)
+        n_positions = positions.shape[0]
+        if out is None:
+            out = np.empty((n_positions, self.n_hives), dtype=np.float32)
+        self._ensure_scratch(n_positions)
+
+        # Position in grid units, clamped to the grid.
+        grid = self._grid_positions
+        np.subtract(positions, self.lower, out=grid, casting='unsafe')
+        grid /= self.resolution
+        np.clip(grid, 0, self.grid_limit, out=grid)
+
+        # Grid positions are non-negative, so truncating gives the cell.
+        cells = self._cells
+        np.copyto(cells, grid, casting='unsafe')
+        fractions = self._fractions
+        np.subtract(grid, cells, out=fractions[1], casting='unsafe')
+        np.subtract(1, fractions[1], out=fractions[0])
+
+        # The weight of each corner of the cell is the product of its
+        # weights along each dimension.
+        np.take(fractions, self._weight_index, out=self._corner_weights)
+        np.prod(self._corner_weights, axis=1, out=self._weights[:,:,0])
+
+        # Gather the table rows at every corner of every cell at once, and
+        # sum them weighted.
+        np.matmul(cells, self.grid_strides, out=self._base_index)
+        np.add(self._base_index, self.corner_offsets, out=self._index)
+        gathered = self._gathered
+        np.take(self.table, self._index, axis=0, out=gathered)
+        gathered *= self._weights
+        np.sum(gathered, axis=0, out=out)
+        return out
@@ -7,44 +7,82 @@ import multiprocessing
 from multiprocessing import Queue, Process
 from threading import Thread
 import numpy as np
-import pyaudio
 from . import samplestream, swarm, hive, utils
-from .playback import PlaybackQueueProducer
+from .fanout import FanoutQueueProducer, split_channels
+from .metrics import Metrics
+from .mixpool import MixPool
+from .playback import PlaybackQueueProducer, SAMPLE_FORMATS
 from .recording import Recording
-from .sources import SourceBank
+from .ringbuffer import SharedRingBuffer
+from .scheduler import Scheduler
+from .sources import SourceBank, SwarmSource
 
-if "linux" in sys.platform:
-    # If using linux, use the ALSA module directly
-    from .audio_interface_alsa import AudioInterface
-else:
-    from .audio_interface import AudioInterface
 
-def playback_consumer(playback_queue,
+def get_audio_interface(audio_backend=None):
+    """
+    Returns the AudioInterface class for a backend. The backend modules are
+    imported here rather than at the top of the module so that only the
+    selected backend's sound library needs to be installed.
+
+    Parameters
+    ----------
+    audio_backend: str or None
+        One of "alsa", "pyaudio" or "file". If None, ALSA is used directly on
+        linux and pyaudio elsewhere.
+    """
+    if audio_backend is None:
+        audio_backend = "alsa" if "linux" in sys.platform else "pyaudio"
+
+    if audio_backend == "alsa":
+        from .audio_interface_alsa import AudioInterface
+    elif audio_backend == "pyaudio":
+        from .audio_interface import AudioInterface
+    elif audio_backend == "file":
+        from .audio_interface_file import AudioInterface
+    else:
+        raise ValueError("Unknown audio backend: {}".format(audio_backend))
+    return AudioInterface
+
+
+def playback_consumer(playback_buffer,
                       recording_queue,
                       n_channels,
                       sample_rate,
                       sample_width,
                       n_frames_per_chunk,
                       output_device_id,
-                      input_device_id=None):
+                      input_device_id=None,
+                      metrics_path=None,
+                      metrics_interval=5.0,
+                      audio_backend=None,
+                      period_size=None,
+                      periods=4,
+                      input_channels=2):
     """
-    Creates a PlaybackQueueConsumer and audio interface and configured to
-    retrieve and send samples to the playback and recording queues respectively.
+    Creates an audio interface configured to retrieve samples from the shared
+    playback ring buffer and send samples to the recording queue.
     This function then enters a blocking loop to process audio data.
     """
 
     proc_name = multiprocessing.current_process().name
     print("playback_consumer: Running on {}".format(proc_name))
 
+    metrics = Metrics(metrics_path, metrics_interval, proc_name)
+
+    AudioInterface = get_audio_interface(audio_backend)
     audio_interface = AudioInterface(
-        playback_queue,
+        playback_buffer,
         recording_queue,
         n_channels,
         sample_rate,
         sample_width,
         output_device_id,
         input_device_id,
-        n_frames_per_chunk)
+        n_frames_per_chunk,
+        metrics=metrics,
+        period_size=period_size,
+        periods=periods,
+        input_channels=input_channels)
 
     print("playback_consumer: Starting audio stream in {}".format(proc_name))
     audio_interface.start_stream()
@@ -52,15 +90,22 @@ def playback_consumer(playback_queue,
     audio_interface.run()
 
 
-def recording_consumer(recording_queue, sample_rate):
+def recording_consumer(recording_queue,
+                       take_queue,
+                       sample_rate,
+                       metrics_path=None,
+                       metrics_interval=5.0):
     """
-    Sets up the recording consumer.
+    Sets up the recording consumer, which segments the recorded audio into
+    takes and sends them to the take queue.
     """
     proc_name = multiprocessing.current_process().name
     print("recording_consumer: Running on {}".format(proc_name))
 
+    metrics = Metrics(metrics_path, metrics_interval, "recording_consumer")
+
     recording = Recording(
-        None, recording_queue, 4*sample_rate)
+        take_queue, recording_queue, sample_rate, metrics=metrics)
     print("Entering recording.run()")
     recording.run()
 
@@ -76,60 +121,243 @@ class HumanHive:
                  sample_width=2,
                  output_device_id=0,
                  input_device_id=0,
-                 master_volume=1.0):
+                 master_volume=1.0,
+                 metrics_path=None,
+                 metrics_interval=5.0,
+                 audio_backend=None,
+                 n_frames_per_chunk=1024,
+                 period_size=None,
+                 periods=4,
+                 input_channels=2,
+                 device_channels=None,
+                 layout=None,
+                 gain_threshold=None,
+                 sample_format=None,
+                 limiter=None,
+                 automation=None,
+                 mix_workers=0,
+                 worker_source_bank_factory=None):
+        """
+        Parameters
+        ----------
+        output_device_id:
+            The output sound card, or for the "file" backend the path to
+            write the output to. A list plays the mix over several cards,
+            each taking a slice of the n_channels channels.
+        metrics_path: str or None
+            If given, each process periodically exports its latency, queue
+            depth and xrun metrics to this destination, either a file path
+            or "udp://host:port". See metrics.Metrics.
+        metrics_interval: float
+            Time in seconds between metrics exports.
+        audio_backend: str or None
+            The audio backend to use. See get_audio_interface().
+        n_frames_per_chunk: int
+            The number of frames rendered at a time by the playback
+            producer.
+        period_size: int or None
+            The number of frames the audio device plays per period. Can be
+            smaller than n_frames_per_chunk for lower latency. Defaults to
+            n_frames_per_chunk.
+        periods: int
+            The number of periods in the audio device's buffer, where the
+            backend supports it.
+        input_channels: int
+            The number of channels to capture, where the backend supports
+            it.
+        device_channels: list of int or None
+            With several output devices, the number of channels on each.
+            Defaults to splitting the channels evenly.
+        layout: hive.HiveLayout or None
+            The positions of the hives, one per channel. Defaults to a
+            circle.
+        gain_threshold: float or None
+            If given, recorded takes use sparse gains, treating hives
+            quieter than this as silent. Only faster for swarms evaluated at
+            every frame; at control rate it is slower than mixing every hive.
+            See sources.SwarmSource and swarm.SparseGainKernel.
+        sample_format: str or None
+            The sample format sent to the audio devices, one of
+            playback.SAMPLE_FORMATS: "int16", "int32" or "float32". Defaults
+            to the integer format of sample_width bytes.
+        limiter: callable or None
+            Applied to the mix before it is clipped to full scale, e.g. a
+            playback.SoftLimiter.
+        automation: automation.GainAutomation or None
+            If given, recorded takes play their swarm back from this
+            pre-rendered automation rather than modelling it.
+        mix_workers: int
+            The number of worker processes to mix sources in, alongside the
+            sources mixed by the producer. See mixpool.MixPool.
+        worker_source_bank_factory: callable or None
+            With mix_workers, called as factory(worker, mix_workers) in each
+            worker to build the SourceBank of its sources.
+        """
 
         self.n_channels = n_channels
         self.sample_rate = sample_rate
-        self.sample_width = sample_width
-
-        self.source_bank = SourceBank()
+        if sample_format is None:
+            sample_format = {2: "int16", 4: "int32"}[sample_width]
+        self.sample_format = sample_format
+        self.sample_dtype = SAMPLE_FORMATS[sample_format]
+        self.sample_width = self.sample_dtype.itemsize
+        self.layout = layout
+        self.gain_threshold = gain_threshold
+        self.automation = automation
 
         self.chunks_queue_size = 100
 
         ctx = multiprocessing.get_context('spawn')
 
-        self.playback_queue = ctx.Queue(self.chunks_queue_size)
         self.recording_queue = ctx.Queue(self.chunks_queue_size)
 
-        self.n_frames_per_chunk = 1024
+        # Takes segmented by the recording process are added to the source
+        # bank by the playback producer as they arrive.
+        self.take_queue = ctx.Queue(8)
+        self.source_bank = SourceBank(
+            take_queue=self.take_queue,
+            take_source_factory=self.create_take_source)
 
-        self.playback_producer = PlaybackQueueProducer(
-            self.source_bank,
-            self.playback_queue,
-            self.n_channels,
-            self.sample_rate,
-            self.n_frames_per_chunk,
-            master_volume=master_volume)
+        # Commands to add, remove and change sources at exact frames, from
+        # this or any other process. See scheduler.Scheduler.
+        self.command_queue = ctx.Queue()
+        self.scheduler = Scheduler(
+            self.source_bank, command_queue=self.command_queue)
 
-        self.audio_interface_process = ctx.Process(
-            target=playback_consumer,
-            args=(
-                self.playback_queue,
-                None, #self.recording_queue,
+        self.n_frames_per_chunk = n_frames_per_chunk
+
+        # Each output device gets its own slice of the channels, its own
+        # audio interface process, and its own ring buffer.
+        if isinstance(output_device_id, (list, tuple)):
+            output_device_ids = list(output_device_id)
+        else:
+            output_device_ids = [output_device_id]
+        channel_slices = split_channels(
+            self.n_channels, device_channels, len(output_device_ids))
+
+        # Rendered chunks are handed to the audio interface process through
+        # shared memory rather than pickled through a Queue.
+        self.playback_buffers = [
+            SharedRingBuffer(
+                self.chunks_queue_size,
+                self.n_frames_per_chunk,
+                channels.stop - channels.start,
+                dtype=self.sample_dtype,
+                poll_interval=self.n_frames_per_chunk / self.sample_rate / 4)
+            for channels in channel_slices]
+        self.playback_buffer = self.playback_buffers[0]
+
+        producer_metrics = Metrics(
+            metrics_path, metrics_interval, "playback_producer")
+
+        # Sources mixed in worker processes, summed into the mix by the
+        # producer as one more source.
+        self.mix_pool = None
+        if mix_workers > 0:
+            self.mix_pool = MixPool(
+                worker_source_bank_factory,
+                mix_workers,
+                self.n_channels,
+                self.sample_rate,
+                self.n_frames_per_chunk,
+                playback_buffer=self.playback_buffer,
+                metrics=producer_metrics,
+                metrics_path=metrics_path,
+                metrics_interval=metrics_interval,
+                context=ctx)
+            self.source_bank.add_source(self.mix_pool)
+        if len(self.playback_buffers) == 1:
+            self.playback_producer = PlaybackQueueProducer(
+                self.source_bank,
+                self.playback_buffer,
                 self.n_channels,
                 self.sample_rate,
-                self.sample_width,
                 self.n_frames_per_chunk,
-                output_device_id,
-                input_device_id))
+                master_volume=master_volume,
+                metrics=producer_metrics,
+                limiter=limiter,
+                scheduler=self.scheduler)
+        else:
+            self.playback_producer = FanoutQueueProducer(
+                self.source_bank,
+                self.playback_buffers,
+                self.n_channels,
+                self.sample_rate,
+                self.n_frames_per_chunk,
+                master_volume=master_volume,
+                metrics=producer_metrics,
+                limiter=limiter,
+                scheduler=self.scheduler)
+
+        self.audio_interface_processes = []
+        for i, (playback_buffer, device_id) in enumerate(
+                zip(self.playback_buffers, output_device_ids)):
+            name = "playback_consumer"
+            if len(output_device_ids) > 1:
+                name += "_{}".format(i)
+            self.audio_interface_processes.append(ctx.Process(
+                name=name,
+                target=playback_consumer,
+                args=(
+                    playback_buffer,
+                    None, #self.recording_queue,
+                    playback_buffer.n_channels,
+                    self.sample_rate,
+                    self.sample_width,
+                    self.n_frames_per_chunk,
+                    device_id,
+                    input_device_id,
+                    metrics_path,
+                    metrics_interval,
+                    audio_backend,
+                    period_size,
+                    periods,
+                    input_channels)))
+        self.audio_interface_process = self.audio_interface_processes[0]
 
         self.recording_process = ctx.Process(
             target=recording_consumer,
             args=(
                 self.recording_queue,
-                self.sample_rate))
+                self.take_queue,
+                self.sample_rate,
+                metrics_path,
+                metrics_interval))
 
         print("Launching processes")
-        self.audio_interface_process.daemmon = True
-        self.audio_interface_process.start()
+        for process in self.audio_interface_processes:
+            process.daemmon = True
+            process.start()
 
         self.recording_process.daemmon = True
         self.recording_process.start()
 
+        if self.mix_pool is not None:
+            self.mix_pool.start()
+
+
+
+    def create_take_source(self, take):
+        """
+        Creates the source that plays a recorded take.
+        """
+        return SwarmSource(
+            take, self.n_channels, self.sample_rate, layout=self.layout,
+            gain_threshold=self.gain_threshold, automation=self.automation)
 
+    def playback_fill_level(self):
+        """
+        Returns the number of rendered chunks waiting to be played. Useful for
+        watching the headroom between the producer and the audio device.
+        With several output devices, returns the lowest fill level.
+        """
+        return min(ring.fill_level() for ring in self.playback_buffers)
 
     def run(self):
         """
         Enter main HumanHive loop.
         """
+        if self.mix_pool is not None:
+            # Start with a stem from every worker rather than a silent gap
+            self.mix_pool.wait_ready()
         self.playback_producer.run()
@@ -0,0 +1,168 @@
+"""
+metrics module
+
+Lightweight counters and histograms for instrumenting the audio pipeline.
+Each process keeps its own Metrics object, updated only from its audio loop,
+so no locks are needed. The metrics are exported periodically as JSON lines
+to a file or a local UDP socket.
+"""
+import bisect
+import json
+import multiprocessing
+import os
+import socket
+import time
+
+
+# Bin edges in seconds for timing histograms, from 10us to 1s
+LATENCY_BIN_EDGES = [
+    1e-5, 2e-5, 5e-5,
+    1e-4, 2e-4, 5e-4,
+    1e-3, 2e-3, 5e-3,
+    1e-2, 2e-2, 5e-2,
+    1e-1, 2e-1, 5e-1,
+    1.]
+
+
+class Histogram:
+    """
+    Counts values into fixed bins. bin_edges are the upper edges of each
+    bin; values above the last edge are counted in an overflow bin.
+    """
+
+    def __init__(self, bin_edges=LATENCY_BIN_EDGES):
+        self.bin_edges = list(bin_edges)
+        self.counts = [0] * (len(self.bin_edges) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = None
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bin_edges, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """
+        Returns the upper edge of the bin containing the q'th percentile,
+        or None if the percentile is in the overflow bin or no values have
+        been recorded.
+        """
+        if self.count == 0:
+            return None
+        target = q / 100 * self.count
+        cumulative = 0
+        for edge, count in zip(self.bin_edges, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return edge
+        return None
+
+    def snapshot(self):
+        return {
+            "bin_edges": self.bin_edges,
+            "counts": list(self.counts),
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+        }
+
+
+class Metrics:
+    """
+    Counters and histograms for one process, exported periodically.
+
+    Only the process that owns a Metrics object updates it, from a single
+    thread, so updates are plain integer and list operations with no locks.
+    Call maybe_export() from the process's main loop.
+    """
+
+    def __init__(self, destination=None, interval=5.0, process_name=None):
+        """
+        Parameters
+        ----------
+        destination: str or None
+            Where to export metrics. Either a file path, to which JSON lines
+            are appended, or "udp://host:port" to send each export as a JSON
+            datagram. If None, metrics are collected but not exported.
+        interval: float
+            Time in seconds between exports.
+        process_name: str or None
+            Identifies the process in the exported metrics. Defaults to the
+            multiprocessing process name.
+        """
+        self.destination = destination
+        self.interval = interval
+        if process_name is None:
+            process_name = multiprocessing.current_process().name
+        self.process_name = process_name
+
+        self.counters = {}
+        self.histograms = {}
+
+        self.last_export = time.monotonic()
+        self._socket = None
+        self._address = None
+        if destination is not None and destination.startswith("udp://"):
+            host, port = destination[len("udp://"):].rsplit(":", 1)
+            self._address = (host, int(port))
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+
+    def increment(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def histogram(self, name, bin_edges=LATENCY_BIN_EDGES):
+        """
+        Returns the named histogram, creating it with bin_edges if needed.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(bin_edges)
+        return histogram
+
+    def record(self, name, value):
+        """
+        Records a value in the named histogram, which uses the latency bins
+        unless it was created beforehand with histogram().
+        """
+        self.histogram(name).record(value)
+
+    def snapshot(self):
+        return {
+            "time": time.time(),
+            "process": self.process_name,
+            "pid": os.getpid(),
+            "counters": dict(self.counters),
+            "histograms": {
+                name: histogram.snapshot()
+                for name, histogram in self.histograms.items()},
+        }
+
+    def maybe_export(self):
+        """
+        Exports the metrics if the export interval has passed.
+        """
+        if self.destination is None:
+            return
+        now = time.monotonic()
+        if now - self.last_export >= self.interval:
+            self.last_export = now
+            self.export()
+
+    def export(self):
+        line = json.dumps(self.snapshot())
+        if self._socket is not None:
+            try:
+                self._socket.sendto(line.encode(), self._address)
+            except OSError:
+                # Nobody listening or the socket buffer is full; metrics
+                # must never stall the audio loop.
+                self.increment("metrics_export_errors")
+        else:
+            with open(self.destination, "a") as f:
+                f.write(line + "\n")
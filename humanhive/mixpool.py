@@ -0,0 +1,259 @@
+"""
+mixpool module
+
+Spreads the mixing of many sources over several processes. Each worker
+process owns a partition of the sources and renders their partial mix, its
+stem, a chunk at a time into a float32 SharedRingBuffer. The MixPool sits in
+the producer's SourceBank like any other source and sums the workers' stems
+into the bus each chunk, so the scheduler, limiter and output stages are
+unchanged.
+
+Workers render ahead by up to the capacity of their stem rings, so a stem is
+normally waiting by the time the producer needs it. If a worker falls behind,
+the producer waits for its stem only as long as the audio already queued for
+the device allows, then reuses the worker's previous stem, or leaves it out,
+rather than letting the device underrun. The worker's late stem is dropped
+once it arrives, so its sources stay in time with the rest of the mix.
+"""
+import multiprocessing
+import time
+import numpy as np
+from .metrics import Metrics
+from .playback import Mixer
+from .ringbuffer import SharedRingBuffer
+
+
+def partition(items, worker, n_workers):
+    """
+    Returns the items that worker, of n_workers, is responsible for: every
+    n_workers'th item starting at worker.
+    """
+    return items[worker::n_workers]
+
+
+def mix_worker(stem_buffer,
+               source_bank_factory,
+               worker,
+               n_workers,
+               stop_event,
+               metrics_path=None,
+               metrics_interval=5.0):
+    """
+    Renders the stem of one worker's sources into stem_buffer until
+    stop_event is set. Runs in its own process.
+    """
+    proc_name = multiprocessing.current_process().name
+    print("mix_worker: Running on {}".format(proc_name))
+
+    metrics = Metrics(metrics_path, metrics_interval, proc_name)
+    render_time = metrics.histogram("render_time")
+
+    source_bank = source_bank_factory(worker, n_workers)
+    mixer = Mixer(source_bank, stem_buffer.n_channels, stem_buffer.n_frames)
+
+    while not stop_event.is_set():
+        slot = stem_buffer.write_chunk(block=False)
+        if slot is None:
+            # Far enough ahead of the producer
+            time.sleep(stem_buffer.poll_interval)
+            continue
+        st = time.perf_counter()
+        np.copyto(slot, mixer.render())
+        stem_buffer.commit_write()
+        render_time.record(time.perf_counter() - st)
+        metrics.maybe_export()
+
+
+class MixPool:
+    """
+    A source whose frames are the summed stems of a pool of worker
+    processes, each mixing its own partition of the sources.
+
+    The stem for chunk c of the mix is the c'th chunk written to a worker's
+    stem ring, so the ring's read index is the stem's sequence number. The
+    newest stem the producer has passed from each worker is held in its
+    ring, rather than copied, until a newer one arrives, so it can be reused
+    if the next one is late. Older stems are released as soon as they are
+    passed, so a worker that falls behind always has room to catch up.
+    """
+
+    def __init__(self,
+                 source_bank_factory,
+                 n_workers,
+                 n_channels,
+                 sample_rate,
+                 n_frames_per_chunk,
+                 n_stem_chunks=4,
+                 max_wait=None,
+                 reuse_late_stems=True,
+                 playback_buffer=None,
+                 metrics=None,
+                 metrics_path=None,
+                 metrics_interval=5.0,
+                 context=None):
+        """
+        Parameters
+        ----------
+        source_bank_factory: callable
+            Called as source_bank_factory(worker, n_workers) in each worker
+            process, and returns the SourceBank of that worker's sources,
+            e.g. with partition(). Must be picklable.
+        n_workers: int
+            The number of worker processes.
+        n_stem_chunks: int
+            The capacity of each worker's stem ring, i.e. how many chunks
+            a worker can render ahead of the producer. Must be at least 2,
+            as one slot holds the last stem mixed.
+        max_wait: float or None
+            The longest time in seconds to wait for a late stem. Defaults to
+            half a chunk. With playback_buffer, the wait is also limited to
+            leave a chunk of the audio queued for the device.
+        reuse_late_stems: bool
+            If True, a late stem is replaced by the worker's previous stem.
+            Otherwise it is left out of the mix.
+        playback_buffer: SharedRingBuffer or None
+            The ring the mix is played from, whose fill level is the time
+            left before the device underruns.
+        metrics: Metrics or None
+            Counts late stems and records the time spent waiting for stems,
+            in the producer's process.
+        metrics_path, metrics_interval:
+            Where and how often the workers export their own metrics.
+        context: multiprocessing context or None
+            The context to start the workers with, e.g. spawn.
+        """
+        if n_stem_chunks < 2:
+            raise ValueError("A MixPool needs at least 2 stem chunks")
+        if context is None:
+            context = multiprocessing.get_context()
+        self.n_workers = n_workers
+        self.n_channels = n_channels
+        self.sample_rate = sample_rate
+        self.n_frames_per_chunk = n_frames_per_chunk
+        self.chunk_duration = n_frames_per_chunk / sample_rate
+        if max_wait is None:
+            max_wait = self.chunk_duration / 2
+        self.max_wait = max_wait
+        self.reuse_late_stems = reuse_late_stems
+        self.playback_buffer = playback_buffer
+
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.stem_wait = metrics.histogram("stem_wait")
+        metrics.increment("late_stems", 0)
+
+        self.stem_buffers = [
+            SharedRingBuffer(
+                n_stem_chunks, n_frames_per_chunk, n_channels,
+                dtype=np.float32, poll_interval=self.chunk_duration / 16)
+            for i in range(n_workers)]
+        # Whether the stem at each ring's read index is one the producer has
+        # passed, held for reuse.
+        self.holding = [False] * n_workers
+        # The number of chunks mixed, i.e. the sequence number of the next
+        # stem to mix.
+        self.chunk = 0
+
+        self.stop_event = context.Event()
+        self.processes = [
+            context.Process(
+                name="mix_worker_{}".format(worker),
+                target=mix_worker,
+                args=(
+                    stem_buffer,
+                    source_bank_factory,
+                    worker,
+                    n_workers,
+                    self.stop_event,
+                    metrics_path,
+                    metrics_interval),
+                daemon=True)
+            for worker, stem_buffer in enumerate(self.stem_buffers)]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def wait_ready(self, timeout=None):
+        """
+        Waits until every worker has rendered its first stem, or timeout
+        seconds have passed. Returns True if they all have.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for stem_buffer in self.stem_buffers:
+            while stem_buffer.write_index == 0:
+                if deadline is not None and time.monotonic() > deadline:
+                    return False
+                time.sleep(stem_buffer.poll_interval)
+        return True
+
+    def stop(self):
+        """
+        Stops the workers and releases the stem rings.
+        """
+        self.stop_event.set()
+        for process in self.processes:
+            if process.pid is not None:
+                process.join()
+        for stem_buffer in self.stem_buffers:
+            stem_buffer.close()
+
+    def _deadline(self):
+        wait = self.max_wait
+        if self.playback_buffer is not None:
+            # Leave a chunk of queued audio to render and write this chunk.
+            queued = self.playback_buffer.fill_level() - 1
+            wait = min(wait, max(queued, 0) * self.chunk_duration)
+        return time.monotonic() + wait
+
+    def _next_stem(self, worker, deadline):
+        """
+        Returns the stem of worker for the current chunk, waiting for it
+        until deadline, or its previous stem or None if it is late.
+        """
+        stem_buffer = self.stem_buffers[worker]
+        while stem_buffer.write_index <= self.chunk:
+            if time.monotonic() > deadline:
+                self.metrics.increment("late_stems")
+                # Release the stems the producer has passed, keeping only the
+                # newest to reuse, so the worker has room to catch up.
+                newest = stem_buffer.write_index - 1
+                while stem_buffer.read_index < newest:
+                    stem_buffer.commit_read()
+                if stem_buffer.read_index == newest:
+                    self.holding[worker] = True
+                if self.holding[worker] and self.reuse_late_stems:
+                    return stem_buffer.read_chunk(block=False)
+                return None
+            time.sleep(stem_buffer.poll_interval)
+
+        # Release the held stem and any that arrived too late to be mixed.
+        while stem_buffer.read_index < self.chunk:
+            stem_buffer.commit_read()
+        self.holding[worker] = True
+        return stem_buffer.read_chunk(block=False)
+
+    def mix_into(self, bus, scratch):
+        """
+        Adds the workers' stems for the next chunk to bus.
+        """
+        if len(bus) != self.n_frames_per_chunk:
+            raise ValueError(
+                "MixPool renders chunks of {} frames, not {}".format(
+                    self.n_frames_per_chunk, len(bus)))
+        st = time.perf_counter()
+        deadline = self._deadline()
+        for worker in range(self.n_workers):
+            stem = self._next_stem(worker, deadline)
+            if stem is not None:
+                bus += stem
+        self.stem_wait.record(time.perf_counter() - st)
+        self.chunk += 1
+
+    def get_frames(self, n_frames, out=None):
+        if out is None:
+            out = np.empty((n_frames, self.n_channels), dtype=np.float32)
+        out.fill(0)
+        self.mix_into(out, None)
+        return out
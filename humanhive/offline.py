@@ -0,0 +1,306 @@
+"""
+offline module
+
+Renders the HumanHive mix to a file without a sound card, as fast as the CPU
+allows. Used to benchmark mixing throughput on headless machines and to
+pre-render soundtracks for an installation.
+
+render_offline() renders in a single process. render_parallel() splits a
+long timeline into windows and renders them on every core at once.
+"""
+import concurrent.futures
+import os
+import stat
+import struct
+import time
+import numpy as np
+from .audio_interface_file import AudioInterface
+from .metrics import Metrics
+from .playback import Mixer, PlaybackQueueProducer, SAMPLE_FORMATS
+from .ringbuffer import SharedRingBuffer
+
+
+def render_offline(source_bank,
+                   output_path,
+                   n_channels,
+                   sample_rate,
+                   duration,
+                   n_frames_per_chunk=1024,
+                   master_volume=1.0,
+                   sample_format="int16",
+                   limiter=None,
+                   metrics=None):
+    """
+    Renders duration seconds of the mix of source_bank to output_path.
+
+    Runs the same PlaybackQueueProducer and ring buffer as live playback, but
+    in a single process: the producer fills the ring and the file audio
+    interface drains it, in turn, with no waiting for a device.
+
+    Parameters
+    ----------
+    source_bank: SourceBank
+        The sources to mix.
+    output_path: str or None
+        A .wav file, a raw file of interleaved samples, or None to discard
+        the output and only measure the render speed.
+    n_channels: int
+        The number of output channels.
+    sample_rate: int
+        The output sample rate.
+    duration: float
+        The length of audio to render in seconds. Rounded up to a whole
+        number of chunks.
+    n_frames_per_chunk: int
+        The number of frames rendered per chunk.
+    master_volume: float
+        The master volume of the mix.
+    sample_format: str
+        The output sample format, one of playback.SAMPLE_FORMATS. WAV files
+        must be "int16" or "int32".
+    limiter: callable or None
+        Applied to the mix before it is clipped, e.g. a SoftLimiter.
+    metrics: Metrics or None
+        Collects the render and write times. A new, unexported Metrics is
+        used if None.
+
+    Returns
+    -------
+    stats: dict
+        The number of frames rendered, the wall clock time taken and the
+        real-time factor, i.e. the number of seconds of audio rendered per
+        second of wall clock time.
+    """
+    if metrics is None:
+        metrics = Metrics(process_name="render_offline")
+
+    n_chunks = int(np.ceil(duration * sample_rate / n_frames_per_chunk))
+    # Enough slots to amortise the hand over between producer and consumer
+    # without the ring growing beyond a few MB.
+    ring_chunks = max(1, min(n_chunks, 16))
+
+    dtype = SAMPLE_FORMATS[sample_format]
+    playback_buffer = SharedRingBuffer(
+        ring_chunks, n_frames_per_chunk, n_channels, dtype=dtype)
+    try:
+        producer = PlaybackQueueProducer(
+            source_bank,
+            playback_buffer,
+            n_channels,
+            sample_rate,
+            n_frames_per_chunk,
+            master_volume=master_volume,
+            metrics=metrics,
+            limiter=limiter)
+        audio_interface = AudioInterface(
+            playback_buffer,
+            None,
+            n_channels,
+            sample_rate,
+            dtype.itemsize,
+            output_path,
+            frame_count=n_frames_per_chunk,
+            metrics=metrics)
+
+        st = time.perf_counter()
+        remaining = n_chunks
+        while remaining > 0:
+            batch = min(remaining, ring_chunks)
+            producer.run(n_chunks=batch)
+            audio_interface.run(n_chunks=batch)
+            remaining -= batch
+        audio_interface.close_stream()
+        elapsed = time.perf_counter() - st
+    finally:
+        playback_buffer.close()
+
+    n_frames = n_chunks * n_frames_per_chunk
+    return {
+        "n_frames": n_frames,
+        "duration": n_frames / sample_rate,
+        "elapsed": elapsed,
+        "real_time_factor": n_frames / sample_rate / elapsed,
+    }
+
+
+def wav_header(n_channels, sample_rate, sample_width, n_frames):
+    """
+    Returns the 44 byte header of a PCM WAV file of n_frames frames, as the
+    wave module writes it, so that the file can be laid out in advance and
+    its data written at any offset. Raises ValueError if the data is too
+    big for the header's 32 bit sizes, i.e. over 4 GiB.
+    """
+    data_size = n_frames * n_channels * sample_width
+    if 36 + data_size > 0xFFFFFFFF:
+        raise ValueError(
+            "{} bytes of audio is too much for a WAV file, which holds at "
+            "most 4 GiB. Render to a raw file instead.".format(data_size))
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, n_channels, sample_rate,
+        sample_rate * n_channels * sample_width, n_channels * sample_width,
+        8 * sample_width,
+        b"data", data_size)
+
+
+def _render_window(source_bank_factory,
+                   output_path,
+                   data_offset,
+                   start_frame,
+                   n_frames,
+                   n_channels,
+                   n_frames_per_chunk,
+                   master_volume,
+                   sample_format,
+                   limiter,
+                   write_chunks=64):
+    """
+    Renders n_frames of the mix from start_frame, in a worker process, and
+    writes them into their place in output_path. Returns the time taken.
+    """
+    st = time.perf_counter()
+    source_bank = source_bank_factory()
+    for source in source_bank.sources:
+        if not hasattr(source, "seek"):
+            raise ValueError(
+                "{} can't seek, so can't be rendered in parallel".format(
+                    type(source).__name__))
+        source.seek(start_frame)
+    mixer = Mixer(
+        source_bank, n_channels, n_frames_per_chunk,
+        master_volume=master_volume, limiter=limiter)
+
+    # Chunks are gathered into a block and written a block at a time.
+    dtype = SAMPLE_FORMATS[sample_format]
+    block = np.empty(
+        (write_chunks, n_frames_per_chunk, n_channels), dtype=dtype)
+    frame_size = n_channels * dtype.itemsize
+
+    f = None if output_path is None else open(output_path, "r+b")
+    try:
+        n_chunks = n_frames // n_frames_per_chunk
+        for first in range(0, n_chunks, write_chunks):
+            n = min(write_chunks, n_chunks - first)
+            for chunk in block[:n]:
+                mixer.render(out=chunk)
+            if f is not None:
+                f.seek(data_offset +
+                       (start_frame + first * n_frames_per_chunk) * frame_size)
+                f.write(block[:n].tobytes())
+    finally:
+        if f is not None:
+            f.close()
+    return time.perf_counter() - st
+
+
+def render_parallel(source_bank_factory,
+                    output_path,
+                    n_channels,
+                    sample_rate,
+                    duration,
+                    n_frames_per_chunk=1024,
+                    window_duration=60.,
+                    max_workers=None,
+                    master_volume=1.0,
+                    sample_format="int16",
+                    limiter=None):
+    """
+    Renders duration seconds of a mix to output_path, split into windows
+    that are rendered in parallel by a pool of processes.
+
+    The output file is laid out in full before rendering starts, and each
+    worker writes its window straight into its place in the file, so the
+    windows need no stitching. Each worker builds its own sources with
+    source_bank_factory and seeks them to the start of its window, so the
+    sources must be repeatable, e.g. SwarmSources with a seed. Windows start
+    on chunk boundaries, so the output is the same as render_offline()'s
+    for the same sources.
+
+    Parameters
+    ----------
+    source_bank_factory: callable
+        Returns the SourceBank to mix. Called once in each worker, so must
+        be picklable, e.g. a module level function or a functools.partial
+        of one. Every source must support seek().
+    output_path: str or None
+        A .wav file, a raw file of interleaved samples, or None to discard
+        the output and only measure the render speed, as does /dev/null.
+        A WAV file holds at most 4 GiB of audio, e.g. about 1.5 hours of 16
+        bit, 48kHz audio on 8 channels, so longer renders must be raw.
+    window_duration: float
+        The length of each window in seconds, rounded up to a whole number
+        of chunks. Smaller windows spread the work more evenly over the
+        workers, at the cost of more setup per window.
+    max_workers: int or None
+        The number of worker processes. Defaults to the number of CPUs.
+
+    Other parameters are as for render_offline().
+
+    Returns
+    -------
+    stats: dict
+        As for render_offline(), plus the number of windows and workers and
+        the summed time spent rendering in the workers.
+    """
+    n_chunks = int(np.ceil(duration * sample_rate / n_frames_per_chunk))
+    n_frames = n_chunks * n_frames_per_chunk
+    window_chunks = max(
+        1, int(np.ceil(window_duration * sample_rate / n_frames_per_chunk)))
+    window_frames = window_chunks * n_frames_per_chunk
+    windows = [(start, min(window_frames, n_frames - start))
+               for start in range(0, n_frames, window_frames)]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(windows))
+
+    dtype = SAMPLE_FORMATS[sample_format]
+    data_offset = 0
+    if output_path is not None:
+        header = b""
+        if str(output_path).lower().endswith(".wav"):
+            if dtype.kind != "i":
+                raise ValueError(
+                    "WAV output needs an integer sample format, not {}".format(
+                        dtype))
+            header = wav_header(
+                n_channels, sample_rate, dtype.itemsize, n_frames)
+        data_offset = len(header)
+        # Allocate the whole file up front, so that workers can write their
+        # windows in any order. Devices such as /dev/null can't be resized,
+        # and don't need to be.
+        with open(output_path, "wb") as f:
+            f.write(header)
+            if stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                f.truncate(
+                    data_offset + n_frames * n_channels * dtype.itemsize)
+
+    st = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _render_window,
+                source_bank_factory,
+                output_path,
+                data_offset,
+                start_frame,
+                window_n_frames,
+                n_channels,
+                n_frames_per_chunk,
+                master_volume,
+                sample_format,
+                limiter)
+            for start_frame, window_n_frames in windows]
+        render_time = sum(future.result() for future in futures)
+    elapsed = time.perf_counter() - st
+
+    return {
+        "n_frames": n_frames,
+        "duration": n_frames / sample_rate,
+        "elapsed": elapsed,
+        "real_time_factor": n_frames / sample_rate / elapsed,
+        "n_windows": len(windows),
+        "n_workers": max_workers,
+        "render_time": render_time,
+    }
@@ -1,4 +1,183 @@
+import time
 import numpy as np
+from .metrics import Metrics
+
+
+# The sample formats the mix can be output in, by name. The mix bus is
+# float32 in int16 units, i.e. full scale is 32768, whatever the format.
+SAMPLE_FORMATS = {
+    "int16": np.dtype(np.int16),
+    "int32": np.dtype(np.int32),
+    "float32": np.dtype(np.float32),
+}
+
+# The scale from the bus to each format's full scale.
+_OUTPUT_SCALES = {
+    np.dtype(np.int16): 1.,
+    np.dtype(np.int32): 65536.,
+    np.dtype(np.float32): 1. / 32768,
+}
+
+
+def clip_and_cast(bus, out):
+    """
+    Clips the float32 bus to full scale and writes it into out, converting
+    it to out's sample format. The clip is done in place on bus, so no
+    temporaries are created. Casting without clipping wraps loud samples
+    around to the opposite sign, which is heard as a pop.
+
+    Parameters
+    ----------
+    bus: array_like, float32
+        The mix, in int16 units. Overwritten with the clipped mix.
+    out: array_like
+        The buffer to write, e.g. a slot of the playback ring buffer, of one
+        of the SAMPLE_FORMATS.
+    """
+    # 32767 rather than 32767.5 so that every format stays in range after
+    # scaling: 32767 * 65536 fits in an int32, and 32767 / 32768 is below
+    # 1 for float32.
+    np.clip(bus, -32768, 32767, out=bus)
+    scale = _OUTPUT_SCALES[out.dtype]
+    if scale == 1.:
+        np.copyto(out, bus, casting='unsafe')
+    else:
+        np.multiply(bus, np.float32(scale), out=out, casting='unsafe')
+    return out
+
+
+class SoftLimiter:
+    """
+    Bends the mix smoothly towards full scale rather than letting it clip
+    hard. Samples below threshold pass unchanged; above it, the excess is
+    compressed with a tanh curve that approaches the ceiling but never
+    reaches it, e.g.
+
+        y = threshold + (ceiling - threshold) *
+            tanh((x - threshold) / (ceiling - threshold))
+
+    for a positive sample x. The curve has unit slope at the threshold, so
+    quiet mixes are untouched and loud ones are rounded off rather than
+    squared off.
+
+    The limiter has no memory, so it works in place on each chunk and adds
+    no latency.
+    """
+
+    def __init__(self, threshold=0.8, ceiling=1.0):
+        """
+        Parameters
+        ----------
+        threshold: float
+            The level, as a fraction of full scale, above which samples are
+            compressed.
+        ceiling: float
+            The level, as a fraction of full scale, that loud samples
+            approach.
+        """
+        if not 0 < threshold < ceiling:
+            raise ValueError(
+                "Threshold must be between 0 and the ceiling {}".format(
+                    ceiling))
+        self.threshold = threshold
+        self.ceiling = ceiling
+        # In the int16 units of the bus
+        self._threshold = np.float32(threshold * 32768)
+        self._knee = np.float32((ceiling - threshold) * 32768)
+
+        # Reusable scratch buffers, allocated on first use and whenever the
+        # bus shape changes.
+        self._magnitude = None
+        self._over = None
+
+    def __call__(self, bus):
+        """
+        Limits bus in place and returns it.
+        """
+        if self._magnitude is None or self._magnitude.shape != bus.shape:
+            self._magnitude = np.empty(bus.shape, dtype=np.float32)
+            self._over = np.empty(bus.shape, dtype=bool)
+
+        magnitude = self._magnitude
+        over = self._over
+        np.abs(bus, out=magnitude)
+        np.greater(magnitude, self._threshold, out=over)
+        if not over.any():
+            return bus
+
+        magnitude -= self._threshold
+        magnitude /= self._knee
+        np.tanh(magnitude, out=magnitude)
+        magnitude *= self._knee
+        magnitude += self._threshold
+        np.copysign(magnitude, bus, out=magnitude)
+        np.copyto(bus, magnitude, where=over)
+        return bus
+
+
+class Mixer:
+    """
+    Mixes the sources of a SourceBank into a preallocated float32 bus. The
+    bus and the per-source scratch buffer are reused for every chunk, and
+    sources render into the scratch buffer in place, so a steady-state chunk
+    does not allocate any new buffers in the mixer.
+
+    The mix is optionally passed through a limiter, e.g. a SoftLimiter, and
+    is clipped to full scale as it is written out.
+    """
+    def __init__(self,
+                 source_bank,
+                 n_channels,
+                 n_frames,
+                 master_volume=1.0,
+                 limiter=None):
+
+        self.source_bank = source_bank
+
+        self.n_channels = n_channels
+        self.n_frames = n_frames
+        self.master_volume = master_volume
+        self.limiter = limiter
+
+        self.bus = np.zeros((n_frames, n_channels), dtype=np.float32)
+        self.scratch = np.zeros((n_frames, n_channels), dtype=np.float32)
+
+    def render(self, out=None):
+        """
+        Renders the next chunk of all sources.
+
+        Parameters
+        ----------
+        out: array_like, (n_frames, n_channels) or None
+            If given, the mixed chunk is clipped and cast into this array,
+            e.g. a slot of the playback ring buffer, in any of the
+            SAMPLE_FORMATS.
+
+        Returns
+        -------
+        bus: array_like, (n_frames, n_channels) float32
+            The mix bus. This is overwritten by the next call to render().
+        """
+        bus = self.bus
+        bus.fill(0)
+        for source in self.source_bank.sources:
+            # Sources that can mix themselves into the bus, e.g. into only
+            # some of its channels, do so.
+            mix_into = getattr(source, "mix_into", None)
+            if mix_into is not None:
+                mix_into(bus, self.scratch)
+            else:
+                bus += source.get_frames(self.n_frames, out=self.scratch)
+
+        if self.master_volume != 1.0:
+            bus *= self.master_volume
+        if self.limiter is not None:
+            self.limiter(bus)
+
+        if out is not None:
+            clip_and_cast(bus, out)
+        return bus
+
 
 class Playback:
     """
@@ -17,50 +196,123 @@ class Playback:
         self.sample_rate = sample_rate
         self.master_volume = master_volume
 
+        # Created on the first call to retrieve_samples() and whenever the
+        # chunk size changes.
+        self.mixer = None
+        self.samples_int16 = None
 
     def retrieve_samples(self, n_frames):
-        samples = np.zeros(
-            (n_frames, self.n_channels), dtype=np.float)
-        for source in self.source_bank.sources:
-            samples += source.get_frames(n_frames)
+        """
+        Returns the next n_frames of the mix as int16. The returned array is
+        reused and overwritten by the next call.
+        """
+        if self.mixer is None or self.mixer.n_frames != n_frames:
+            self.mixer = Mixer(
+                self.source_bank,
+                self.n_channels,
+                n_frames,
+                master_volume=self.master_volume)
+            self.samples_int16 = np.empty(
+                (n_frames, self.n_channels), dtype=np.int16)
 
-        samples *= self.master_volume
-        return np.asarray(samples, np.int16)
+        self.mixer.master_volume = self.master_volume
+        self.mixer.render(out=self.samples_int16)
+        return self.samples_int16
 
 
 class PlaybackQueueProducer:
     """
-    Keeps a queue filled with audio samples.
+    Keeps the shared playback ring buffer filled with audio samples.
     """
     def __init__(self,
                  source_bank,
-                 chunks_queue,
+                 playback_buffer,
                  n_channels,
                  sample_rate,
                  n_samples_per_chunk,
-                 master_volume=1.0):
+                 master_volume=1.0,
+                 metrics=None,
+                 limiter=None,
+                 scheduler=None):
+        """
+        The mix is written in the sample format of playback_buffer, any of
+        the SAMPLE_FORMATS. limiter, e.g. a SoftLimiter, is applied to the
+        mix before it is clipped to full scale. If a scheduler.Scheduler is
+        given, its commands are dispatched before each chunk is rendered.
+        """
 
         self.source_bank = source_bank
-        self.chunks_queue = chunks_queue
+        self.playback_buffer = playback_buffer
+
+        # Metrics are always collected; they are only exported if the
+        # caller passes a Metrics object with a destination.
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
 
         self.n_channels = n_channels
         self.sample_rate = sample_rate
         self.n_samples_per_chunk = n_samples_per_chunk
-        self.master_volume = master_volume
+        self.scheduler = scheduler
+        # The frame of the mix at the start of the next chunk
+        self.frame = 0
 
+        self.mixer = Mixer(
+            source_bank,
+            n_channels,
+            n_samples_per_chunk,
+            master_volume=master_volume,
+            limiter=limiter)
 
-    def run(self):
+    @property
+    def master_volume(self):
+        return self.mixer.master_volume
+
+    @master_volume.setter
+    def master_volume(self, value):
+        self.mixer.master_volume = value
+
+    def render_chunk(self, slot):
         """
-        Generates samples and inserts them into queue.
+        Mixes the next chunk straight into slot, a free slot of the playback
+        ring buffer, and publishes it.
+        """
+        self.mixer.render(out=slot)
+        self.playback_buffer.commit_write()
+
+    def run(self, n_chunks=None):
         """
-        while True:
-            samples = np.zeros(
-                (self.n_samples_per_chunk, self.n_channels), dtype=np.float)
-            for source in self.source_bank.sources:
-                samples += source.get_frames(self.n_samples_per_chunk)
+        Generates samples and renders them into the playback ring buffer. If
+        n_chunks is given, returns after rendering that many chunks, otherwise
+        runs forever.
+        """
+        metrics = self.metrics
+        render_time = metrics.histogram("render_time")
+        queue_depth = metrics.histogram(
+            "queue_depth", range(self.playback_buffer.n_chunks + 1))
+
+        while n_chunks is None or n_chunks > 0:
+            # Wait for a free slot, blocking if the ring is full, and mix
+            # straight into it.
+            slot = self.playback_buffer.write_chunk(block=True)
+            st = time.perf_counter()
+            if self.scheduler is not None:
+                n_commands = self.scheduler.dispatch(
+                    self.frame, self.n_samples_per_chunk)
+                if n_commands:
+                    metrics.increment("scheduled_commands", n_commands)
+            self.render_chunk(slot)
+            te = time.perf_counter() - st
+            self.frame += self.n_samples_per_chunk
+
+            render_time.record(te)
+            queue_depth.record(self.playback_buffer.fill_level())
 
-            samples *= self.master_volume
+            # Pick up any new recordings between chunks.
+            n_takes = self.source_bank.poll_takes()
+            if n_takes:
+                metrics.increment("takes_added", n_takes)
+            metrics.maybe_export()
 
-            samples_int16 = np.asarray(samples, np.int16)
-            # Insert into queue, block if queue fills up.
-            self.chunks_queue.put(samples_int16, block=True)
+            if n_chunks is not None:
+                n_chunks -= 1
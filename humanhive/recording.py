@@ -1,116 +1,306 @@
+import queue
 import numpy as np
-import wave
+from .metrics import Metrics
 
 
-class Recording:
-    """
-    Takes the input data from the sound interface, segments them into samples
-    and then directs these samples to a sample bank.
+class StreamingSegmenter:
     """
+    Segments a live audio stream into takes of voice activity.
 
-    def __init__(self, source_bank, recording_queue, n_samples_buffer):
-        self.source_bank = source_bank
-        self.recording_queue = recording_queue
+    Each chunk is processed in constant time with respect to the length of
+    the stream, and all buffers are preallocated:
 
-        # Stores a list of frames which make up the current sample. Initialised
-        # to None to indicate that there is no current sample being recorded.
-        self.current_sample = None
+    - The volume envelope is the RMS over the last envelope_chunks chunks,
+      kept as running sums over a ring of per-chunk energies.
+    - The ambient volume is an exponential moving average of the envelope,
+      updated only while no take is being recorded.
+    - A take starts when the envelope rises above start_ratio times the
+      ambient volume and ends once it has stayed below stop_ratio times the
+      ambient volume for release_time seconds, or after max_take_time.
+    - The last pre_roll_time seconds of audio are kept in a ring so that the
+      onset of a take, from before the threshold was crossed, is captured.
+    """
 
-        # Stores the volume of the last sub-frame picked up by process_audio()
-        # Used to threshold volume when segmenting audio. Initialise to None
-        # to allow setting at initial levels. n_ambient_chunks stores the
-        # number of ambient chunks used to compute the average
-        self.ambient_volume = None
-        self.n_ambient_chunks = 0
+    def __init__(self,
+                 sample_rate,
+                 envelope_chunks=4,
+                 ambient_time_constant=10.,
+                 start_ratio=4.,
+                 stop_ratio=2.,
+                 min_level=100.,
+                 release_time=0.5,
+                 pre_roll_time=0.5,
+                 min_take_time=0.5,
+                 max_take_time=20.):
+        """
+        Parameters
+        ----------
+        sample_rate: int
+            The sample rate of the stream.
+        envelope_chunks: int
+            The number of chunks the RMS envelope is computed over.
+        ambient_time_constant: float
+            Time constant in seconds of the ambient volume estimate.
+        start_ratio: float
+            A take starts when the envelope exceeds this multiple of the
+            ambient volume.
+        stop_ratio: float
+            A take ends when the envelope falls below this multiple of the
+            ambient volume. Lower than start_ratio, so that a take does not
+            flicker on and off around a single threshold.
+        min_level: float
+            The lowest ambient volume used for the thresholds, in int16
+            units, so that a take is not started by noise in a silent room.
+        release_time: float
+            Time in seconds the envelope must stay below the stop threshold
+            before a take ends.
+        pre_roll_time: float
+            Time in seconds of audio before the start of a take to include.
+        min_take_time: float
+            Takes shorter than this, in seconds and excluding the pre-roll,
+            are discarded.
+        max_take_time: float
+            Takes are ended after this time in seconds.
+        """
+        self.sample_rate = sample_rate
+        self.start_ratio = start_ratio
+        self.stop_ratio = stop_ratio
+        self.min_level = min_level
+        self.ambient_time_constant = ambient_time_constant
+        self.n_release_samples = int(release_time * sample_rate)
+        self.n_min_take_samples = int(min_take_time * sample_rate)
+        self.n_max_take_samples = int(max_take_time * sample_rate)
 
-        self.n_samples_buffer = n_samples_buffer
+        # Ring of per-chunk sums of squares and sample counts, and their
+        # running totals over the ring.
+        self.chunk_energies = np.zeros(envelope_chunks)
+        self.chunk_sizes = np.zeros(envelope_chunks, dtype=np.int64)
+        self.energy_sum = 0.
+        self.size_sum = 0
+        self.envelope_index = 0
 
-        # Stores past samples for capturing recorded data when threshold
-        # lies between calls to process_audio
-        self.sample_buffer = []
+        self.envelope = 0.
+        self.ambient_volume = None
 
-        # Stores changing volumes over time for analysis
-        self.volume_buffer = []
+        # Ring of the most recent audio, for the pre-roll.
+        self.pre_roll = np.zeros(int(pre_roll_time * sample_rate), np.int16)
+        self.pre_roll_position = 0
+        self.pre_roll_filled = 0
 
+        # The take currently being recorded. n_take_samples is None when no
+        # take is being recorded.
+        self.take = np.zeros(
+            self.pre_roll.size + self.n_max_take_samples, np.int16)
+        self.n_take_samples = None
+        self.n_pre_roll_samples = 0
+        self.n_quiet_samples = 0
 
-        self.wf = wave.open("/tmp/test.wav", "wb")
-        self.wf.setnchannels(2)
-        self.wf.setsampwidth(2)
-        self.wf.setframerate(48000)
-        self.chunks_count = 0
+        self._mono = np.zeros(0, dtype=np.float32)
 
+    @property
+    def recording(self):
+        return self.n_take_samples is not None
 
-    def run(self):
+    def _to_mono(self, in_data):
         """
-        Puts the recording module into a running mode. Consumes data from
-        recording queue and processes it.
+        Mixes a chunk down to mono float32, in a reused buffer.
         """
-        while True:
-            in_data = self.recording_queue.get()
-            self.process_audio(in_data)
+        n_samples = len(in_data)
+        if self._mono.size < n_samples:
+            self._mono = np.zeros(n_samples, dtype=np.float32)
+        mono = self._mono[:n_samples]
+        if in_data.ndim == 1:
+            np.copyto(mono, in_data, casting='unsafe')
+        else:
+            np.mean(in_data, axis=1, out=mono)
+        return mono
 
-    def process_audio(self, in_data):
-        """
-        Processes incoming audio data. Segments when a voice is detected and
-        records sample. This is then saved to the sample_bank.
-        """
-        print("in_data shape: {}".format(in_data.shape))
-        print("chunks count: {}".format(self.chunks_count))
+    def _update_envelope(self, mono):
+        i = self.envelope_index
+        energy = float(np.dot(mono, mono))
+        self.energy_sum += energy - self.chunk_energies[i]
+        self.size_sum += mono.size - int(self.chunk_sizes[i])
+        self.chunk_energies[i] = energy
+        self.chunk_sizes[i] = mono.size
+        self.envelope_index = (i + 1) % self.chunk_energies.size
 
-        if self.chunks_count < 1000:
-            self.wf.writeframes(in_data)
-        elif self.chunks_count == 1000:
-            self.wf.close()
-            print("Closing file")
-        self.chunks_count += 1
+        # Guard against the running sum drifting below zero through rounding.
+        self.envelope = np.sqrt(max(self.energy_sum, 0.) / self.size_sum)
 
-        print("channel max: {}".format(np.abs(in_data).max()))
+    def _update_ambient(self, n_samples):
+        if self.ambient_volume is None:
+            self.ambient_volume = self.envelope
+        else:
+            alpha = 1 - np.exp(
+                -n_samples / self.sample_rate / self.ambient_time_constant)
+            self.ambient_volume += alpha * (self.envelope - self.ambient_volume)
 
+    def _write_pre_roll(self, mono):
+        size = self.pre_roll.size
+        if size == 0:
+            return
+        # Only the last size samples of a long chunk are kept.
+        mono = mono[-size:]
+        start = self.pre_roll_position
+        n_first = min(mono.size, size - start)
+        np.copyto(self.pre_roll[start:start + n_first], mono[:n_first],
+                  casting='unsafe')
+        np.copyto(self.pre_roll[:mono.size - n_first], mono[n_first:],
+                  casting='unsafe')
+        self.pre_roll_position = (start + mono.size) % size
+        self.pre_roll_filled = min(self.pre_roll_filled + mono.size, size)
 
-        #
-        # if self.current_sample is None:
-        #     self.update_ambient_volume(in_data)
-        #
-        # print(self.ambient_volume)
-        #
-        # self.update_sample_buffers(in_data, frame_count)
+    def _start_take(self):
+        # Copy the pre-roll ring into the take, oldest sample first.
+        n = self.pre_roll_filled
+        start = (self.pre_roll_position - n) % max(self.pre_roll.size, 1)
+        n_first = min(n, self.pre_roll.size - start)
+        self.take[:n_first] = self.pre_roll[start:start + n_first]
+        self.take[n_first:n] = self.pre_roll[:n - n_first]
 
-        # Turn volumes into threshold crossings
+        self.n_pre_roll_samples = n
+        self.n_take_samples = n
+        self.n_quiet_samples = 0
 
-        # If there's a threshold crossing with no opposing return within the
-        # specified time limit, start recording.
+    def _append_take(self, mono):
+        n = min(mono.size, self.take.size - self.n_take_samples)
+        np.copyto(self.take[self.n_take_samples:self.n_take_samples + n],
+                  mono[:n], casting='unsafe')
+        self.n_take_samples += n
 
-        # If the recording has passed a minimum length, and there is a down
-        # threshold which stays down for a specified time stop recording.
+    def _end_take(self):
+        """
+        Ends the current take and returns a copy of it, or None if it is too
+        short.
+        """
+        n_voiced = (
+            self.n_take_samples - self.n_pre_roll_samples -
+            self.n_quiet_samples)
+        take = None
+        if n_voiced >= self.n_min_take_samples:
+            take = self.take[:self.n_take_samples].copy()
+        self.n_take_samples = None
+        # The pre-roll for the next take starts afresh.
+        self.pre_roll_filled = 0
+        return take
 
-        # Save the recorded data somewhere
+    def process(self, in_data):
+        """
+        Processes the next chunk of the stream.
 
-        # Send this off to the SourceBank for adding into the mix.
+        Parameters
+        ----------
+        in_data: array_like, (n_frames,) or (n_frames, n_channels)
+            The next chunk of audio. Multichannel audio is mixed to mono.
 
+        Returns
+        -------
+        take: array_like int16 or None
+            A mono take, if one finished with this chunk.
+        """
+        mono = self._to_mono(in_data)
+        self._update_envelope(mono)
 
+        take = None
+        if not self.recording:
+            self._update_ambient(mono.size)
+            level = max(self.ambient_volume, self.min_level)
+            if self.envelope > self.start_ratio * level:
+                self._start_take()
+                self._append_take(mono)
+            else:
+                self._write_pre_roll(mono)
+        else:
+            level = max(self.ambient_volume, self.min_level)
+            self._append_take(mono)
+            if self.envelope < self.stop_ratio * level:
+                self.n_quiet_samples += mono.size
+            else:
+                self.n_quiet_samples = 0
 
-    def update_sample_buffers(self, in_data, frame_count):
+            if (self.n_quiet_samples >= self.n_release_samples or
+                    self.n_take_samples >= self.take.size):
+                take = self._end_take()
+        return take
 
-        # Check whether to discard oldest audio and volume samples. This assumes
-        # that the frame_count is always consistent
-        if len(sample_buffer) > (self.n_samples_buffer / frame_count):
-            self.sample_buffer.pop(0)
-            self.volume_buffer.pop(0)
 
-        self.sample_buffer.append(in_data)
-        self.volume_buffer.append(
-            utils.compute_audio_volume_per_frame(in_data))
+class Recording:
+    """
+    Takes the input data from the sound interface, segments them into samples
+    and then directs these samples to a sample bank.
 
-    def update_ambient_volume(self, in_data):
+    Finished takes are put on take_queue without blocking, from where the
+    SourceBank in the playback process picks them up and adds them as new
+    sources. See SourceBank.poll_takes().
+    """
+
+    def __init__(self,
+                 take_queue,
+                 recording_queue,
+                 sample_rate,
+                 metrics=None,
+                 **segmenter_args):
         """
-        Updates the ambient volume
+        Parameters
+        ----------
+        take_queue: Queue or None
+            Finished takes are put on this queue. If None, takes are
+            discarded.
+        recording_queue: Queue
+            The queue of input chunks from the audio interface.
+        sample_rate: int
+            The sample rate of the input.
+        metrics: Metrics or None
+            Collects the number of chunks and takes.
+        segmenter_args:
+            Passed on to the StreamingSegmenter.
         """
-        if self.ambient_volume is None:
-            self.ambient_volume = utils.compute_audio_volume(in_data)
-        else:
-            existing_ambient_volume = (
-                self.ambient_volume *
-                (self.n_ambient_chunks / (self.n_ambient_chunks + 1)))
-            current_contribution = (
-                utils.compute_audio_volume(in_data) / (self.n_ambient_chunks + 1))
-            self.ambient_volume = existing_ambient_volume + current_contribution
+        self.take_queue = take_queue
+        self.recording_queue = recording_queue
+
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+
+        self.segmenter = StreamingSegmenter(sample_rate, **segmenter_args)
+
+    def run(self):
+        """
+        Puts the recording module into a running mode. Consumes data from
+        recording queue and processes it.
+        """
+        queue_depth = self.metrics.histogram(
+            "recording_queue_depth", range(101))
+        while True:
+            in_data = self.recording_queue.get()
+            try:
+                queue_depth.record(self.recording_queue.qsize())
+            except NotImplementedError:
+                # qsize() is not available on macOS.
+                pass
+            self.process_audio(in_data)
+            self.metrics.increment("recorded_chunks")
+            self.metrics.maybe_export()
+
+    def process_audio(self, in_data):
+        """
+        Processes incoming audio data. Segments when a voice is detected and
+        sends each finished take to the take queue.
+
+        Returns the finished take, if there is one.
+        """
+        take = self.segmenter.process(in_data)
+        if take is not None:
+            self.metrics.increment("takes")
+            self.emit_take(take)
+        return take
+
+    def emit_take(self, take):
+        if self.take_queue is None:
+            return
+        try:
+            self.take_queue.put(take, block=False)
+        except queue.Full:
+            # The playback process is not keeping up. Drop the take rather
+            # than stall the input.
+            self.metrics.increment("dropped_takes")
@@ -0,0 +1,250 @@
+"""
+ringbuffer module
+
+A single-producer/single-consumer ring buffer of audio chunks living in
+shared memory. Used to hand rendered audio from the playback producer to the
+audio interface process without pickling or copying chunks through a pipe.
+"""
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+
+# Layout of the header at the start of the shared memory block. The indices
+# are monotonic chunk counters; the slot for a counter is counter % n_chunks.
+# The header is followed by a float64 timestamp per slot, then the chunks.
+_WRITE_INDEX = 0
+_READ_INDEX = 1
+_HEADER_SIZE = 8 * 8
+
+
+class SharedRingBuffer:
+    """
+    Lock-free single-producer/single-consumer ring buffer of fixed size
+    chunks of shape (n_frames, n_channels).
+
+    The producer calls write_chunk() to get a view of the next free slot,
+    renders straight into it and then publishes it with commit_write(). The
+    consumer calls read_chunk() to get a view of the oldest published slot,
+    hands it to the device and then releases it with commit_read(). Each
+    index is only ever written by one side, so no lock is required.
+
+    Instances can be passed to a spawned process, which attaches to the same
+    shared memory block.
+    """
+
+    def __init__(self,
+                 n_chunks,
+                 n_frames,
+                 n_channels,
+                 dtype=np.int16,
+                 poll_interval=None,
+                 name=None):
+        """
+        Parameters
+        ----------
+        n_chunks: int
+            The number of chunk slots in the ring.
+        n_frames: int
+            The number of frames in each chunk.
+        n_channels: int
+            The number of channels in each frame.
+        dtype: numpy dtype
+            The sample format stored in the ring.
+        poll_interval: float or None
+            Time in seconds to sleep while waiting for a free or filled slot.
+            Defaults to a quarter of a 48kHz chunk.
+        name: str or None
+            Name of an existing shared memory block to attach to. If None, a
+            new block is created and owned by this object.
+        """
+        self.n_chunks = n_chunks
+        self.n_frames = n_frames
+        self.n_channels = n_channels
+        self.dtype = np.dtype(dtype)
+        if poll_interval is None:
+            poll_interval = n_frames / 48000 / 4
+        self.poll_interval = poll_interval
+
+        chunk_shape = (n_chunks, n_frames, n_channels)
+        timestamps_size = 8 * n_chunks
+        data_size = int(np.prod(chunk_shape)) * self.dtype.itemsize
+
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=_HEADER_SIZE + timestamps_size + data_size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        self.header = np.ndarray(
+            (_HEADER_SIZE // 8,), dtype=np.int64, buffer=self.shm.buf)
+        self.timestamps = np.ndarray(
+            (n_chunks,), dtype=np.float64, buffer=self.shm.buf,
+            offset=_HEADER_SIZE)
+        self.chunks = np.ndarray(
+            chunk_shape, dtype=self.dtype, buffer=self.shm.buf,
+            offset=_HEADER_SIZE + timestamps_size)
+
+        if self.owner:
+            self.header[:] = 0
+
+    def __getstate__(self):
+        return {
+            "n_chunks": self.n_chunks,
+            "n_frames": self.n_frames,
+            "n_channels": self.n_channels,
+            "dtype": self.dtype.str,
+            "poll_interval": self.poll_interval,
+            "name": self.shm.name,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def write_index(self):
+        return int(self.header[_WRITE_INDEX])
+
+    @property
+    def read_index(self):
+        return int(self.header[_READ_INDEX])
+
+    def fill_level(self):
+        """
+        Returns the number of chunks that have been written but not yet read.
+        """
+        return int(self.header[_WRITE_INDEX] - self.header[_READ_INDEX])
+
+    def headroom(self):
+        """
+        Returns the fill level as a fraction of the ring capacity.
+        """
+        return self.fill_level() / self.n_chunks
+
+    def write_chunk(self, block=True):
+        """
+        Returns a view of the next free slot for the producer to render into,
+        or None if the ring is full and block is False. The slot is not
+        visible to the consumer until commit_write() is called.
+        """
+        while self.fill_level() >= self.n_chunks:
+            if not block:
+                return None
+            time.sleep(self.poll_interval)
+        return self.chunks[self.write_index % self.n_chunks]
+
+    def commit_write(self, timestamp=None):
+        """
+        Publishes the slot returned by the last call to write_chunk().
+
+        The slot is stamped with timestamp, by default the current
+        time.monotonic(), which is comparable between processes. The
+        consumer can read it with read_timestamp() to measure latency.
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self.timestamps[self.write_index % self.n_chunks] = timestamp
+        self.header[_WRITE_INDEX] += 1
+
+    def read_chunk(self, block=True):
+        """
+        Returns a view of the oldest published slot, or None if the ring is
+        empty and block is False. The slot is not handed back to the producer
+        until commit_read() is called.
+        """
+        while self.fill_level() <= 0:
+            if not block:
+                return None
+            time.sleep(self.poll_interval)
+        return self.chunks[self.read_index % self.n_chunks]
+
+    def read_timestamp(self):
+        """
+        Returns the timestamp of the slot returned by the last call to
+        read_chunk().
+        """
+        return float(self.timestamps[self.read_index % self.n_chunks])
+
+    def commit_read(self):
+        """
+        Releases the slot returned by the last call to read_chunk().
+        """
+        self.header[_READ_INDEX] += 1
+
+    def put(self, chunk, block=True):
+        """
+        Copies a chunk into the ring. Provided for compatibility with code
+        written against a Queue; prefer write_chunk()/commit_write().
+        """
+        slot = self.write_chunk(block=block)
+        if slot is None:
+            return False
+        np.copyto(slot, chunk, casting='unsafe')
+        self.commit_write()
+        return True
+
+    def close(self):
+        """
+        Detaches from the shared memory and, if this object created it,
+        removes the block.
+        """
+        # Release the numpy views before closing the underlying buffer.
+        self.header = None
+        self.timestamps = None
+        self.chunks = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class FrameReader:
+    """
+    Reads any number of frames from a SharedRingBuffer without blocking, so
+    that a device can consume the ring in periods that differ from the chunk
+    size, e.g. from an audio callback.
+    """
+
+    def __init__(self, ring, latency=None):
+        """
+        Parameters
+        ----------
+        ring: SharedRingBuffer
+            The ring to read from.
+        latency: metrics.Histogram or None
+            If given, records the time between each chunk being committed by
+            the producer and its first frame being read.
+        """
+        self.ring = ring
+        self.latency = latency
+        # The chunk currently being read and the next frame to read from it.
+        self.chunk = None
+        self.position = 0
+
+    def read_frames(self, out):
+        """
+        Copies the next frames of the ring into out, releasing each chunk
+        once it has been read. Returns the number of frames copied, which is
+        less than len(out) if the ring ran empty.
+        """
+        n_read = 0
+        n_frames = len(out)
+        while n_read < n_frames:
+            if self.chunk is None:
+                self.chunk = self.ring.read_chunk(block=False)
+                if self.chunk is None:
+                    break
+                self.position = 0
+                if self.latency is not None:
+                    self.latency.record(
+                        time.monotonic() - self.ring.read_timestamp())
+
+            n = min(n_frames - n_read, len(self.chunk) - self.position)
+            out[n_read:n_read + n] = self.chunk[self.position:self.position + n]
+            n_read += n
+            self.position += n
+
+            if self.position == len(self.chunk):
+                self.chunk = None
+                self.ring.commit_read()
+        return n_read
@@ -5,13 +5,94 @@ Functionality for loading audio samples and looping them in a stream-friendly
 manner.
 """
 import os
-import wave
+import struct
 import numpy as np
 
+
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+class WaveMap(np.memmap):
+    """
+    A memory map of the PCM data in a WAV file, as returned by
+    load_wave_file(). When pickled, e.g. when passed to a spawned process,
+    the file is mapped again rather than its samples copied, so that all
+    processes share the same pages.
+    """
+
+    def __array_finalize__(self, obj):
+        super().__array_finalize__(obj)
+        # Arguments to load_wave_file() that reproduce this array. Only set
+        # on arrays returned by load_wave_file(), not on views of them.
+        self.wave_args = None
+
+    def __reduce__(self):
+        if self.wave_args is None:
+            return np.asarray(self).__reduce__()
+        return (load_wave_file, self.wave_args)
+
+
+def read_wave_header(filename):
+    """
+    Reads the format and the location of the PCM data from a WAV file.
+
+    Returns
+    -------
+    params: dict
+        n_channels, sample_rate, sample_width, data_offset and n_frames.
+    """
+    with open(filename, 'rb') as f:
+        riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError("{} is not a WAV file".format(filename))
+
+        params = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("No data chunk in {}".format(filename))
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+
+            if chunk_id == b'fmt ':
+                (audio_format, n_channels, sample_rate, _, block_align,
+                 bits_per_sample) = struct.unpack('<HHIIHH', f.read(16))
+                if audio_format not in (_WAVE_FORMAT_PCM,
+                                        _WAVE_FORMAT_EXTENSIBLE):
+                    raise ValueError(
+                        "Only PCM WAV files are supported, got format {}".format(
+                            audio_format))
+                params = {
+                    "n_channels": n_channels,
+                    "sample_rate": sample_rate,
+                    "sample_width": bits_per_sample // 8,
+                    "block_align": block_align,
+                }
+                # Skip any extension to the format chunk
+                f.seek(chunk_size - 16 + (chunk_size % 2), os.SEEK_CUR)
+            elif chunk_id == b'data':
+                if params is None:
+                    raise ValueError(
+                        "Data chunk before format chunk in {}".format(filename))
+                params["data_offset"] = f.tell()
+                # Files written while recording may have a truncated data
+                # chunk, so limit it to the size of the file.
+                data_size = min(
+                    chunk_size, os.fstat(f.fileno()).st_size - f.tell())
+                params["n_frames"] = data_size // params["block_align"]
+                return params
+            else:
+                # Chunks are padded to an even size
+                f.seek(chunk_size + (chunk_size % 2), os.SEEK_CUR)
+
+
 def load_wave_file(filename, ensure_sample_rate=None, mono=False):
     """
     Load a WAV file.
 
+    The PCM data is memory mapped rather than read, so samples are only
+    paged in from disk when they are used, and the pages are shared between
+    processes that map the same file.
+
     Parameters
     ----------
     filename: str
@@ -19,45 +100,89 @@ def load_wave_file(filename, ensure_sample_rate=None, mono=False):
     ensure_sample_rate: int or None
         Ensure that the WAV matches the sample rate. If not, raises a
         ValueError
+    mono: bool
+        If True, return only the first channel. This is a view of the
+        mapped file rather than a copy.
 
     Returns
     -------
-    samples: array_like, shape: (n_samples, n_channels)
+    samples: array_like, shape: (n_samples, n_channels) or (n_samples,)
         Returns the audio samples
     """
 
-    wavefile = wave.open(filename, 'rb')
+    params = read_wave_header(filename)
 
     if (ensure_sample_rate is not None and
-            wavefile.getframerate() != ensure_sample_rate):
+            params["sample_rate"] != ensure_sample_rate):
         raise ValueError("Sample rate of audio {} doesn't match {}".format(
-            wavefile.getframerate(), ensure_sample_rate))
-    if wavefile.getsampwidth() != 2:
+            params["sample_rate"], ensure_sample_rate))
+    if params["sample_width"] != 2:
         raise ValueError("Only supports WAV files with sample width of 2")
 
-    n_channels = wavefile.getnchannels()
-    n_samples = wavefile.getnframes()
+    n_channels = params["n_channels"]
+    n_samples = params["n_frames"]
     # print("n_channels: {}, n_samples: {}".format(n_channels, n_samples))
-    samples = np.frombuffer(
-        wavefile.readframes(n_samples), dtype=np.int16)
-    samples = samples.reshape(-1, n_channels)
+    if n_samples == 0:
+        # Empty files can't be memory mapped
+        samples = np.zeros((0, n_channels), dtype=np.int16)
+        return samples[:,0] if mono else samples
 
-    wavefile.close()
+    samples = WaveMap(
+        filename,
+        dtype='<i2',
+        mode='r',
+        offset=params["data_offset"],
+        shape=(n_samples, n_channels))
 
     if mono:
-        # Only take first channel, and flatten
-        samples = samples[:,0].flatten()
+        # Only take first channel, as a strided view
+        samples = samples[:,0]
 
+    samples.wave_args = (filename, ensure_sample_rate, mono)
     return samples
 
 
-def load_samples_from_dir(sample_dir, extensions=(".wav",)):
-    files = os.listdir(sample_dir)
-    wav_files = [fn for fn in files if os.path.splitext(fn)[1] in extensions]
-    samples_list = [
-        load_wave_file(os.path.join(sample_dir, fn), mono=True) for fn in wav_files]
+class SampleDirectory:
+    """
+    A lazily loaded list of the samples in a directory. Each file is only
+    loaded, i.e. memory mapped, the first time it is accessed.
+    """
+
+    def __init__(self, sample_dir, extensions=(".wav",), mono=True):
+        files = sorted(os.listdir(sample_dir))
+        self.filenames = [
+            os.path.join(sample_dir, fn) for fn in files
+            if os.path.splitext(fn)[1] in extensions]
+        self.mono = mono
+        self._samples = [None] * len(self.filenames)
+
+    def __len__(self):
+        return len(self.filenames)
 
-    return samples_list
+    def __getitem__(self, index):
+        if self._samples[index] is None:
+            self._samples[index] = load_wave_file(
+                self.filenames[index], mono=self.mono)
+        return self._samples[index]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getstate__(self):
+        # Don't send loaded samples to other processes, they will be mapped
+        # again on first use.
+        state = self.__dict__.copy()
+        state["_samples"] = [None] * len(self.filenames)
+        return state
+
+
+def load_samples_from_dir(sample_dir, extensions=(".wav",)):
+    """
+    Returns the mono samples of each WAV file in a directory. The files are
+    loaded lazily, on first access.
+    """
+    return SampleDirectory(sample_dir, extensions=extensions, mono=True)
 
 
 def copy_n_channels(audio, n_channels):
@@ -69,6 +194,51 @@ def copy_n_channels(audio, n_channels):
     return np.hstack([audio[:,np.newaxis] for _ in range(n_channels)])
 
 
+def read_looped(buffer, start, n_samples, out=None):
+    """
+    Reads n_samples from a looped buffer, wrapping around to the start of
+    the buffer when the end is reached.
+
+    Parameters
+    ----------
+    buffer: array_like, (M, ...)
+        The buffer to read from, looped along its first axis.
+    start: int
+        The index of the first sample to read, 0 <= start < M.
+    n_samples: int
+        The number of samples to read.
+    out: array_like, (n_samples, ...) or None
+        If given, the samples are copied into this array, casting to its
+        dtype.
+
+    Returns
+    -------
+    samples: array_like, (n_samples, ...)
+        If out is None and the window doesn't cross the end of the buffer,
+        this is a view of the buffer. Otherwise it is out, filled with at
+        most two contiguous copies (more only if n_samples > M).
+    """
+    size = buffer.shape[0]
+    end = start + n_samples
+    if end <= size:
+        if out is None:
+            return buffer[start:end]
+        out[...] = buffer[start:end]
+        return out
+
+    if out is None:
+        out = np.empty((n_samples,) + buffer.shape[1:], dtype=buffer.dtype)
+
+    n_filled = 0
+    position = start
+    while n_filled < n_samples:
+        n_copy = min(size - position, n_samples - n_filled)
+        out[n_filled:n_filled + n_copy] = buffer[position:position + n_copy]
+        n_filled += n_copy
+        position = 0
+    return out
+
+
 class SampleStream():
     """
     Provides access to an audio buffer chunk by chunk.
@@ -82,12 +252,28 @@ class SampleStream():
         self.audio_buffer = audio_buffer
         self.next_sample = 0
 
-    def retrieve_samples(self, n_samples):
-        end_sample = self.next_sample + n_samples
-        samples = np.take(
-            self.audio_buffer,
-            range(self.next_sample, end_sample),
-            mode='wrap')
-        self.next_sample = end_sample % self.audio_buffer.size
+        # Reused for chunks that cross the loop point when no out buffer is
+        # given.
+        self._wrap_buffer = np.empty(0, dtype=audio_buffer.dtype)
+
+    def retrieve_samples(self, n_samples, out=None):
+        """
+        Returns the next n_samples, looping back to the start of the audio
+        at the end.
+
+        If out is given, the samples are copied into it. Otherwise the result
+        is a view of the audio, or of an internal buffer if the chunk crosses
+        the loop point, and must not be modified or kept beyond the next
+        call.
+        """
+        if out is None and self.next_sample + n_samples > self.audio_buffer.size:
+            if self._wrap_buffer.size < n_samples:
+                self._wrap_buffer = np.empty(
+                    n_samples, dtype=self.audio_buffer.dtype)
+            out = self._wrap_buffer[:n_samples]
+
+        samples = read_looped(
+            self.audio_buffer, self.next_sample, n_samples, out=out)
+        self.next_sample = (self.next_sample + n_samples) % self.audio_buffer.size
 
         return samples
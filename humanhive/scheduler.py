@@ -0,0 +1,283 @@
+"""
+scheduler module
+
+Adds, removes and changes sources at exact frames of the mix while it plays.
+Commands are posted to a Scheduler, directly or through a command queue from
+another thread or process, each for a frame of the mix timeline. The
+PlaybackQueueProducer dispatches the commands that fall within each chunk
+before rendering it, and each is applied at its offset within the chunk.
+Gain changes are ramped, so sources fade in and out rather than clicking.
+
+Pending commands are kept in a heap ordered by frame, and sources only do
+extra work while one of their ramps is running, so the scheduling cost of a
+chunk depends on the number of events in it rather than the number of
+sources playing.
+"""
+import collections
+import heapq
+import itertools
+import queue
+import numpy as np
+
+
+# A command for the scheduler.
+#
+# frame: the frame of the mix at which to apply the command, or None for the
+#     start of the next chunk.
+# action: one of "add", "remove", "set_volume" or "retarget".
+# source_id: a hashable name for the source the command applies to.
+# value: the source to add, the volume to ramp to, or the hive to retarget
+#     the source's swarm to. Unused for "remove".
+# ramp_frames: the length of the fade in, fade out or volume ramp.
+Command = collections.namedtuple(
+    "Command", ["frame", "action", "source_id", "value", "ramp_frames"])
+
+
+def add_command(source_id, source, frame=None, ramp_frames=256):
+    return Command(frame, "add", source_id, source, ramp_frames)
+
+
+def remove_command(source_id, frame=None, ramp_frames=256):
+    return Command(frame, "remove", source_id, None, ramp_frames)
+
+
+def set_volume_command(source_id, volume, frame=None, ramp_frames=256):
+    return Command(frame, "set_volume", source_id, volume, ramp_frames)
+
+
+def retarget_command(source_id, hive, frame=None):
+    return Command(frame, "retarget", source_id, hive, 0)
+
+
+class ScheduledSource:
+    """
+    Wraps a source in the mix with a gain that can be ramped, and an offset
+    within the current chunk at which it starts playing.
+
+    While the gain is steady at one, the wrapped source mixes itself into the
+    bus as it would outside the scheduler, through its own mix_into() if it
+    has one. Otherwise it is rendered into the scratch buffer and scaled by a
+    constant, or while a ramp is running, by a per-frame gain curve.
+    """
+
+    def __init__(self, source, gain=1.):
+        self.source = source
+        # The gain at the start of the next chunk
+        self.gain = gain
+        # Frames into the next chunk before the source starts playing
+        self.start_offset = 0
+
+        # The running ramps, as breakpoints (frames into the next chunk,
+        # gain) that the gain is interpolated linearly between, starting at
+        # the current gain and holding the last. Empty while the gain is
+        # steady.
+        self.ramp = []
+
+    def ramp_to(self, target, ramp_frames, delay=0):
+        """
+        Ramps the gain linearly from its value at delay frames into the next
+        chunk to target, over ramp_frames frames. With no ramp, the gain
+        steps to target at delay frames. Replaces any ramp from delay on.
+        """
+        ramp_frames = max(int(ramp_frames), 0)
+        if ramp_frames == 0 and delay <= 0:
+            self.gain = target
+            self.ramp = []
+            return
+        if ramp_frames == 0:
+            # A step is a one frame ramp ending on the frame of the step.
+            delay -= 1
+            ramp_frames = 1
+        # Start from wherever a running ramp will have reached by then
+        start = self._gain_at(delay)
+        self.ramp = [point for point in self.ramp if point[0] < delay]
+        self.ramp += [(delay, start), (delay + ramp_frames, target)]
+
+    def _gain_at(self, offset):
+        if not self.ramp:
+            return self.gain
+        offsets, gains = zip(*self.ramp)
+        return float(np.interp(offset, offsets, gains))
+
+    def _advance(self, n_frames):
+        """
+        Moves the ramps on by n_frames frames.
+        """
+        if not self.ramp:
+            return
+        self.gain = self._gain_at(n_frames)
+        self.ramp = [(offset - n_frames, gain)
+                     for offset, gain in self.ramp if offset > n_frames]
+        if self.ramp:
+            self.ramp.insert(0, (0, self.gain))
+
+    def _gain_curve(self, n_frames):
+        """
+        Returns the gain at each of the next n_frames frames, (n_frames, 1),
+        and advances the ramps.
+        """
+        offsets, gains = zip(*self.ramp)
+        curve = np.interp(
+            np.arange(n_frames, dtype=np.float32),
+            offsets, gains).astype(np.float32)
+        self._advance(n_frames)
+        return curve[:,np.newaxis]
+
+    def get_frames(self, n_frames, out=None):
+        return self.source.get_frames(n_frames, out=out)
+
+    def mix_into(self, bus, scratch):
+        start = self.start_offset
+        self.start_offset = 0
+        if start > 0:
+            # Added part way through the chunk. The ramp was scheduled
+            # relative to the start of the chunk, so shift it to match.
+            bus = bus[start:]
+            scratch = scratch[start:]
+            self._advance(start)
+        n_frames = len(bus)
+        if n_frames == 0:
+            return
+
+        if self.ramp and self.ramp[0][0] < n_frames:
+            frames = self.source.get_frames(n_frames, out=scratch)
+            frames *= self._gain_curve(n_frames)
+            bus += frames
+            return
+        self._advance(n_frames)
+
+        if self.gain == 1.:
+            mix_into = getattr(self.source, "mix_into", None)
+            if mix_into is not None:
+                mix_into(bus, scratch)
+            else:
+                bus += self.source.get_frames(n_frames, out=scratch)
+        elif self.gain != 0.:
+            frames = self.source.get_frames(n_frames, out=scratch)
+            frames *= self.gain
+            bus += frames
+        else:
+            # Silent, but keep the source's playback moving so it stays in
+            # time if it is faded back in.
+            self.source.get_frames(n_frames, out=scratch)
+
+
+class Scheduler:
+    """
+    Applies commands to the sources of a SourceBank at exact frames.
+
+    Commands are posted with post(), or put on command_queue, which may be a
+    multiprocessing queue fed by another process. The PlaybackQueueProducer
+    calls dispatch() with the frame range of each chunk before rendering it.
+    """
+
+    def __init__(self, source_bank, command_queue=None):
+        self.source_bank = source_bank
+        self.command_queue = command_queue
+
+        # The frame of the mix at the start of the next chunk
+        self.frame = 0
+        # Pending commands, as (frame, sequence, command). The sequence
+        # number keeps commands for the same frame in the order they were
+        # posted.
+        self.pending = []
+        self.sequence = itertools.count()
+        # Sources fading out, as (frame the fade ends, sequence, source_id,
+        # scheduled source)
+        self.removals = []
+
+        # The scheduled sources, by id
+        self.sources = {}
+
+    def post(self, command):
+        frame = command.frame
+        if frame is None or frame < self.frame:
+            frame = self.frame
+        heapq.heappush(self.pending, (frame, next(self.sequence), command))
+
+    def poll(self):
+        """
+        Moves any commands waiting on the command queue into the schedule,
+        without blocking.
+        """
+        if self.command_queue is None:
+            return
+        while True:
+            try:
+                command = self.command_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.post(command)
+
+    def dispatch(self, frame, n_frames):
+        """
+        Applies the commands due in the chunk of n_frames frames starting at
+        frame, and removes sources whose fade out has finished. Returns the
+        number of commands applied.
+        """
+        self.frame = frame
+        self.poll()
+
+        # Sources that finished fading out before this chunk
+        while self.removals and self.removals[0][0] <= frame:
+            _, _, source_id, scheduled = heapq.heappop(self.removals)
+            # The id may have been given to a new source during the fade.
+            if self.sources.get(source_id) is scheduled:
+                del self.sources[source_id]
+            if scheduled in self.source_bank.sources:
+                self.source_bank.remove_source(scheduled)
+
+        end_frame = frame + n_frames
+        n_commands = 0
+        while self.pending and self.pending[0][0] < end_frame:
+            command_frame, _, command = heapq.heappop(self.pending)
+            self.apply(command, command_frame - frame)
+            n_commands += 1
+
+        self.frame = end_frame
+        return n_commands
+
+    def _fade_out(self, source_id, scheduled, ramp_frames, offset):
+        """
+        Fades scheduled out from offset frames into the next chunk, and
+        removes it from the source bank once the fade has finished.
+        """
+        scheduled.ramp_to(0., ramp_frames, delay=offset)
+        heapq.heappush(
+            self.removals,
+            (self.frame + offset + max(int(ramp_frames), 0),
+             next(self.sequence), source_id, scheduled))
+
+    def apply(self, command, offset):
+        """
+        Applies command at offset frames into the next chunk.
+        """
+        action = command.action
+        if action == "add":
+            scheduled = ScheduledSource(command.value, gain=0.)
+            scheduled.start_offset = offset
+            scheduled.ramp_to(1., command.ramp_frames, delay=offset)
+            old = self.sources.get(command.source_id)
+            if old is not None:
+                # Crossfade from the source being replaced
+                self._fade_out(
+                    command.source_id, old, command.ramp_frames, offset)
+            self.sources[command.source_id] = scheduled
+            self.source_bank.add_source(scheduled)
+            return
+
+        scheduled = self.sources.get(command.source_id)
+        if scheduled is None:
+            # The source has already gone, e.g. removed twice.
+            return
+
+        if action == "remove":
+            self._fade_out(
+                command.source_id, scheduled, command.ramp_frames, offset)
+        elif action == "set_volume":
+            scheduled.ramp_to(
+                command.value, command.ramp_frames, delay=offset)
+        elif action == "retarget":
+            scheduled.source.retarget(command.value, delay=offset)
+        else:
+            raise ValueError("Unknown command: {}".format(action))
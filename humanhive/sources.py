@@ -2,6 +2,8 @@
 Defines all the sources. Each source controls playback in a different manner.
 They provide chunks of frames for playback.
 """
+import collections
+import queue
 import numpy as np
 from humanhive import utils, hive, swarm, samplestream
 
@@ -9,26 +11,90 @@ class SourceBank:
     """
     Manages the sources that will be played. These are created externally
     and added in.
+
+    Recorded takes can also be added as they arrive on a take queue. Each
+    take is turned into a source by take_source_factory, and once there are
+    more than max_take_sources the oldest take's source is removed.
     """
 
-    def __init__(self):
+    def __init__(self,
+                 take_queue=None,
+                 take_source_factory=None,
+                 max_take_sources=16):
         self.sources = []
 
+        self.take_queue = take_queue
+        self.take_source_factory = take_source_factory
+        self.max_take_sources = max_take_sources
+        self.take_sources = collections.deque()
+
     def add_source(self, source):
         self.sources.append(source)
 
+    def remove_source(self, source):
+        self.sources.remove(source)
+
+    def poll_takes(self):
+        """
+        Adds a source for each take waiting on the take queue, without
+        blocking. Returns the number of takes added.
+        """
+        if self.take_queue is None:
+            return 0
+
+        n_takes = 0
+        while True:
+            try:
+                take = self.take_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            source = self.take_source_factory(take)
+            self.add_source(source)
+            self.take_sources.append(source)
+            if len(self.take_sources) > self.max_take_sources:
+                self.remove_source(self.take_sources.popleft())
+            n_takes += 1
+        return n_takes
+
 
 class SwarmSource:
     """
     This is the source for a normal swarm. Sample plays as if it is moving
     around the space.
+
+    The swarm is evaluated at control rate, once every control_rate_divisor
+    frames, and its volumes are interpolated up to audio rate. Set
+    control_rate_divisor to 1 to evaluate the swarm at every frame.
+
+    By default the hives are spaced evenly around a circle, one per channel.
+    Pass a hive.HiveLayout to place them anywhere.
+
+    Pass gain_threshold to use sparse gains: only the hives near the swarm
+    are evaluated, interpolated and mixed, through mix_into(). This pays off
+    with many hives when the swarm is evaluated at every frame. At control
+    rate the kernel is already cheap, and mixing a few scattered columns of
+    the bus costs more than mixing all of them. See swarm.SparseGainKernel.
+
+    Pass an automation.GainAutomation to play the swarm back from gains
+    rendered in advance rather than modelling it, from a random point in
+    the automation's loop.
+
+    Pass seed to make the swarm's trajectory repeatable. With seek(), any
+    window of the source can then be rendered on its own.
     """
 
     def __init__(self,
                  audio_data,
                  n_channels,
                  sample_rate,
-                 volume=1.0):
+                 volume=1.0,
+                 control_rate_divisor=64,
+                 layout=None,
+                 gain_threshold=None,
+                 max_active_hives=None,
+                 automation=None,
+                 seed=None):
 
         self.sample = samplestream.SampleStream(audio_data)
         self.n_channels=n_channels
@@ -36,27 +102,159 @@ class SwarmSource:
         self.volume = volume
         self.sample_rate = sample_rate
         # Create swarm volume controller
-        self.hive_radius = 3
-        self.n_hives = n_channels
-        self.hives = hive.generate_hive_circle(
-            n_hives=self.n_hives, hive_radius=self.hive_radius)
+        gain_kernel = None
+        if layout is None:
+            self.hive_radius = 3
+            self.n_hives = n_channels
+            self.hives = hive.generate_hive_circle(
+                n_hives=self.n_hives, hive_radius=self.hive_radius)
+        else:
+            if layout.n_hives != n_channels:
+                raise ValueError(
+                    "Layout has {} hives but there are {} channels".format(
+                        layout.n_hives, n_channels))
+            self.n_hives = layout.n_hives
+            self.hives = layout.hives
+            gain_kernel = layout.gain_kernel()
+
+        self.sparse = gain_threshold is not None
+        if self.sparse:
+            gain_kernel = swarm.SparseGainKernel(
+                self.hives, threshold=gain_threshold, k=max_active_hives)
 
-        self.swarm = swarm.SwarmLinear(
-            hives=self.hives,
-            swarm_speed=0.1,
-            sample_rate=self.sample_rate)
+        self.control_rate_divisor = control_rate_divisor
+        self.automation = automation
+        if automation is not None:
+            if automation.n_hives != n_channels:
+                raise ValueError(
+                    "Automation has {} hives but there are {} channels".format(
+                        automation.n_hives, n_channels))
+            if self.sparse:
+                raise ValueError("Sparse gains need a live swarm")
+            # Start on a tick, so that chunks stay aligned with the ticks.
+            rng = np.random.Generator(np.random.Philox(
+                key=swarm.swarm_key(swarm.default_seed(seed))))
+            self.swarm_start_frame = (
+                automation.control_rate_divisor *
+                int(rng.integers(automation.n_ticks)))
+            self.swarm = automation.player(self.swarm_start_frame)
+        else:
+            self.swarm_start_frame = 0
+            self.swarm = swarm.SwarmLinear(
+                hives=self.hives,
+                swarm_speed=0.1,
+                sample_rate=self.sample_rate / control_rate_divisor,
+                gain_kernel=gain_kernel,
+                seed=seed)
+            if control_rate_divisor > 1:
+                self.swarm = swarm.ControlRateSwarm(
+                    self.swarm, control_rate_divisor)
 
+        # Reusable scratch buffers for the mono samples of a chunk and the
+        # volumes of the active channels, allocated on first use and whenever
+        # the chunk size changes.
+        self._samples = None
+        self._volumes = None
 
+    def get_frames(self, n_frames, out=None):
+        """
+        Renders the next n_frames of the source.
 
-    def get_frames(self, n_frames):
+        Parameters
+        ----------
+        n_frames: int
+            The number of frames to render.
+        out: array_like, (n_frames, n_channels) float32 or None
+            If given, the frames are rendered into this array and no new
+            buffers are allocated.
 
-        samples = np.asarray(self.sample.retrieve_samples(n_frames), np.float32)
+        Returns
+        -------
+        frames: array_like, (n_frames, n_channels)
+            The rendered frames.
+        """
+        if out is None:
+            out = np.empty((n_frames, self.n_channels), dtype=np.float32)
+        if self._samples is None or self._samples.shape[0] != n_frames:
+            self._samples = np.empty(n_frames, dtype=np.float32)
 
-        samples_all_channels = samplestream.copy_n_channels(samples, self.n_channels)
-        swarm_volumes = self.swarm.sample_swarm_volumes(n_frames)
-        # print("Swarm volumes: {}".format(swarm_volumes[0]))
-        samples_all_channels *= swarm_volumes
+        self.sample.retrieve_samples(n_frames, out=self._samples)
+
+        # Write the per-channel swarm gains straight into the output, then
+        # scale each channel by the mono sample.
+        self.swarm.sample_swarm_volumes(n_frames, out=out)
+        # print("Swarm volumes: {}".format(out[0]))
+        out *= self._samples[:,np.newaxis]
 
         # Final volume
-        samples_all_channels *= self.volume
-        return samples_all_channels
+        if self.volume != 1.0:
+            out *= self.volume
+        return out
+
+    def seek(self, frame):
+        """
+        Moves the source to frame, as though it had been rendered up to
+        there: the sample to its position in the loop, and the swarm to its
+        position on its trajectory.
+        """
+        self.sample.next_sample = frame % self.sample.audio_buffer.size
+        self.swarm.seek(self.swarm_start_frame + frame)
+
+    def retarget(self, hive, delay=0):
+        """
+        Sends the swarm towards hive, delay frames from now, or as close to
+        that as the control rate allows. Automation plays a fixed
+        trajectory, so a source playing it ignores retargets.
+        """
+        if self.automation is not None:
+            print("SwarmSource: Can't retarget automation, ignoring")
+            return
+        self.swarm.retarget(hive, delay=delay)
+
+    def mix_into(self, bus, scratch):
+        """
+        Renders the next len(bus) frames of the source and adds them to bus.
+        With sparse gains, only the channels of the hives near the swarm are
+        rendered and added; otherwise the frames are rendered into scratch.
+        """
+        n_frames = len(bus)
+        if not self.sparse:
+            bus += self.get_frames(n_frames, out=scratch)
+            return
+
+        if self._samples is None or self._samples.shape[0] != n_frames:
+            self._samples = np.empty(n_frames, dtype=np.float32)
+        if (self._volumes is None or
+                self._volumes.shape[0] != n_frames * self.n_channels):
+            self._volumes = np.empty(
+                n_frames * self.n_channels, dtype=np.float32)
+        self.sample.retrieve_samples(n_frames, out=self._samples)
+
+        if self.control_rate_divisor == 1:
+            # Evaluate the kernel at every frame, for the active hives only.
+            positions = self.swarm.sample_swarm_positions(n_frames)
+            channels, volumes = self.swarm.gain_kernel.sparse(positions)
+        else:
+            channels = self.swarm.active_channels(n_frames)
+            # A contiguous (n_frames, n_active) buffer, so the swarm can
+            # write into it a tick at a time.
+            volumes = self._volumes[:n_frames * len(channels)].reshape(
+                n_frames, len(channels))
+            self.swarm.sample_swarm_volumes(
+                n_frames, out=volumes, channels=channels)
+
+        if len(channels) == 0:
+            # The swarm is out of reach of every hive.
+            return
+        volumes *= self._samples[:,np.newaxis]
+        if self.volume != 1.0:
+            volumes *= self.volume
+        # Neighbouring hives are usually on neighbouring channels, so add
+        # each run of consecutive channels through a slice rather than
+        # scattering every channel with a fancy index.
+        runs = np.flatnonzero(np.diff(channels) != 1) + 1
+        for start, end in zip(
+                np.concatenate(([0], runs)),
+                np.concatenate((runs, [len(channels)]))):
+            bus[:, channels[start]:channels[end - 1] + 1] += (
+                volumes[:, start:end])
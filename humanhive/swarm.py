@@ -1,7 +1,35 @@
 """Module for managing swarm positions"""
 import math
 import numpy as np
-from sklearn.metrics.pairwise import rbf_kernel
+from . import samplestream
+
+
+def default_seed(seed=None):
+    """
+    Returns seed, or if it is None a new seed drawn from numpy's global
+    random state, so that np.random.seed() still makes a run repeatable.
+    """
+    if seed is None:
+        seed = int(np.random.randint(2**63))
+    return seed
+
+
+def swarm_key(seed):
+    """
+    Returns the 128 bit Philox key that a swarm's random streams are drawn
+    from.
+    """
+    return np.random.SeedSequence(seed).generate_state(2, np.uint64)
+
+
+def substream(key, index):
+    """
+    Returns a Generator for substream index of key. Philox is counter based,
+    so each substream starts at its own block of the counter, and any
+    substream can be created directly without drawing the ones before it.
+    """
+    return np.random.Generator(
+        np.random.Philox(key=key, counter=[0, 0, 0, index]))
 
 class CosSinSwarm:
     """
@@ -13,15 +41,18 @@ class CosSinSwarm:
         self.start_theta = 0
         self.period = 20
 
-    def sample_swarm_volumes(self, frame_count):
+    def sample_swarm_volumes(self, frame_count, out=None):
         end_theta = (self.start_theta +
             ((frame_count / (self.sample_rate*self.period)) * 2*math.pi))
         theta = np.linspace(self.start_theta, end_theta, frame_count)
         self.start_theta = end_theta
-        left_vol = np.cos(theta)
-        right_vol = np.sin(theta)
 
-        return np.hstack((left_vol[:,np.newaxis], right_vol[:,np.newaxis]))
+        if out is None:
+            out = np.empty((frame_count, 2), dtype=np.float32)
+        np.cos(theta, out=out[:,0], casting='unsafe')
+        np.sin(theta, out=out[:,1], casting='unsafe')
+
+        return out
 
 
 class SwarmLinear:
@@ -30,10 +61,26 @@ class SwarmLinear:
                  swarm_speed,
                  sample_rate,
                  p_change_direction=0.2,
-                 p_jump_hives=0.1):
+                 p_jump_hives=0.1,
+                 linger_time=3,
+                 sigma=1,
+                 gain_kernel=None,
+                 seed=None):
         """
         Initialise a swarm.
 
+        The swarm moves in straight lines from hive to hive at a constant
+        speed and lingers at each hive it reaches. Its path is planned ahead
+        as a list of knots, (frame, position) pairs, that are joined by
+        straight lines. Positions for any number of samples are then found by
+        linear interpolation between the knots.
+
+        The random choices at the end of each leg are drawn from that leg's
+        own substream of the swarm's seed. The path is then the same however
+        it is sampled, and seek() can plan it up to any frame without
+        evaluating a position, so separate processes can render separate
+        windows of one trajectory.
+
         Parameters
         ----------
         hives: array_like, (H, 2)
@@ -44,9 +91,29 @@ class SwarmLinear:
             where the units are the same as those used for the hive positions.
         sample_rate: int
             The sample rate.
+        p_change_direction: float
+            Probability of reversing direction on reaching a hive.
+        p_jump_hives: float
+            Probability of heading to a random hive on reaching a hive.
+        linger_time: float
+            Time in seconds that the swarm lingers at each hive.
+        sigma: float
+            Width of the gain kernel used to compute hive volumes.
+        gain_kernel: callable or None
+            Computes hive volumes from swarm positions, e.g. a
+            hive.GainTable for the hives. Defaults to a GainKernel with
+            width sigma.
+        seed: int or None
+            Seeds the swarm's random choices. If None, a seed is drawn from
+            numpy's global random state.
         """
         self.hives = np.asarray(hives)
         self.n_hives = len(hives)
+        if gain_kernel is None:
+            gain_kernel = GainKernel(self.hives, sigma=sigma)
+        self.gain_kernel = gain_kernel
+        # Reusable buffer for the positions used to compute volumes.
+        self._positions = None
         self.swarm_speed = swarm_speed
         # Compute how far the swarm should travel per frame
         self.swarm_speed_upf = self.swarm_speed / sample_rate
@@ -54,136 +121,213 @@ class SwarmLinear:
 
         self.p_change_direction = p_change_direction
         self.p_jump_hives = p_jump_hives
+        self.n_linger_frames = linger_time * sample_rate
+
+        self.seed = default_seed(seed)
+        self.key = swarm_key(self.seed)
 
+        self.reset()
+
+    def reset(self):
+        """
+        Puts the swarm back at the start of its trajectory.
+        """
         # Initialise movement. Set initial position to hive 0, and set them off
         # towards hive 1
         self.swarm_position = self.hives[0]
         self.destination_hive = 1
 
-        # n_linger_frames stores the number of frames that the swarm has remaining
-        # to linger at the current position.
-        self.n_linger_frames = 0
-
         # Stores the direction of the swarm movement as +1 or -1. This is
         # randomly sampled from p_change_direction
         self.swarm_direction = 1
 
-    def sample_swarm_positions(self, n_samples):
-        """
-        Samples the position of a swarm as it moves around the
-        circle at random for a given duration and sample rate.
-        Updates the internal state of the object with the new
-        swarm position such that subsequent calls will progress
-        the swarm on its path.
-
-        Parameters
-        ----------
-        duration: float
-            The duration in seconds for which to generate the samples.
-        n_samples: int
-            The number of samples to generate.
-
-        Returns
-        -------
-        positions: array_like, (N, 2)
-            Returns N = duration * sample_rate samples for the position
-            of the swarm. Position is given by the angle of the swarm
-        """
-
-        # Compute the frame index that movement will start at.
-        if self.n_linger_frames > n_samples:
-            # Still lingering, set movement_start_frame to n_samples
-            movement_start_frame = n_samples
-        else:
-            movement_start_frame = self.n_linger_frames
-
-
-        # Compute the frame index that movement will end at
-        swarm_destination_position = self.hives[self.destination_hive]
-        destination_vector = (
-            swarm_destination_position - self.swarm_position)
-
-        # movement_per_frame_vector gives the offset for each frame of
-        # movement.
-        movement_per_frame_vector = (
-            (destination_vector / np.linalg.norm(destination_vector)) *
-            self.swarm_speed_upf)
-
-        # Compute the frame that we would reach destination by projecting
-        # the destination point onto the movement vector
-        destination_frame = int(np.ceil(
-            (swarm_destination_position[0] - self.swarm_position[0]) /
-            movement_per_frame_vector[0]))
+        # The frame index of the next sample to be generated.
+        self.frame = 0
 
+        # The planned path. Knot frames are increasing and the path is
+        # planned at least as far as the last frame that has been sampled.
+        self.knot_frames = [0.]
+        self.knot_positions = [self.hives[0].astype(np.float64)]
 
+        # The number of legs planned, which is also the substream the next
+        # leg's random choices are drawn from.
+        self.leg = 0
 
-        n_remaining_frames = n_samples - movement_start_frame
-
-        if destination_frame > n_remaining_frames:
-            movement_end_frame = n_samples
-        else:
-            movement_end_frame = movement_start_frame + destination_frame
-
-        # Now set the positions
-        positions = np.zeros((n_samples, 2), dtype=np.float32)
-
-        # Movement start
-        positions[:movement_start_frame] = self.swarm_position[np.newaxis,:]
-
-        # Movement middle
-        frame_indices = np.arange(1, (movement_end_frame - movement_start_frame) + 1)
-        relative_positions = (
-            movement_per_frame_vector[np.newaxis,:] * frame_indices[:,np.newaxis])
-        positions[movement_start_frame:movement_end_frame] = (
-            relative_positions + self.swarm_position)
-
-        # Movement end, copy last movement position to finish
-        positions[movement_end_frame:] = positions[movement_end_frame-1]
-
-        ###
-        # Now update internal state
-        ###
-        self.swarm_position = positions[-1]
-        if movement_end_frame < n_samples:
-            # We reached destination, sample new destination hive
+    def seek(self, frame):
+        """
+        Moves the swarm to frame of its trajectory, as though it had been
+        sampled up to there. Retargets are forgotten. Only the knots of the
+        path before frame are planned, so this is cheap for any frame.
+        """
+        self.reset()
+        self.plan_path(frame)
+        self._forget_knots(frame)
+        self.frame = frame
+        knot_frames = np.asarray(self.knot_frames)
+        knot_positions = np.asarray(self.knot_positions)
+        self.swarm_position = np.array([
+            np.interp(frame, knot_frames, knot_positions[:,dim])
+            for dim in range(knot_positions.shape[1])])
+
+    def get_state(self):
+        """
+        Returns a checkpoint of the swarm, for set_state(). Restoring it
+        carries on the same trajectory, including any retargets.
+        """
+        return {
+            "seed": self.seed,
+            "frame": self.frame,
+            "leg": self.leg,
+            "destination_hive": self.destination_hive,
+            "swarm_direction": self.swarm_direction,
+            "swarm_position": np.array(self.swarm_position),
+            "knot_frames": list(self.knot_frames),
+            "knot_positions": [np.array(p) for p in self.knot_positions],
+        }
+
+    def set_state(self, state):
+        self.seed = state["seed"]
+        self.key = swarm_key(self.seed)
+        self.frame = state["frame"]
+        self.leg = state["leg"]
+        self.destination_hive = state["destination_hive"]
+        self.swarm_direction = state["swarm_direction"]
+        self.swarm_position = np.array(state["swarm_position"])
+        self.knot_frames = list(state["knot_frames"])
+        self.knot_positions = [np.array(p) for p in state["knot_positions"]]
+
+    def plan_path(self, end_frame):
+        """
+        Extends the planned path until it covers end_frame. Each leg of the
+        path is a move to the destination hive followed by a linger there,
+        after which the next destination is chosen.
+        """
+        while self.knot_frames[-1] < end_frame:
+            start_frame = self.knot_frames[-1]
+            start_position = self.knot_positions[-1]
+            destination = self.hives[self.destination_hive]
+
+            # Move. The arrival frame is the distance travelled over the speed,
+            # which holds for movement in any direction.
+            distance = np.linalg.norm(destination - start_position)
+            arrival_frame = start_frame + distance / self.swarm_speed_upf
+            if arrival_frame > start_frame:
+                self.knot_frames.append(arrival_frame)
+                self.knot_positions.append(destination)
+
+            # Linger. Always advance by at least one frame so that the
+            # planning terminates.
+            leave_frame = max(
+                arrival_frame + self.n_linger_frames, start_frame + 1)
+            self.knot_frames.append(leave_frame)
+            self.knot_positions.append(destination)
+
+            # Choose the next destination hive, from this leg's substream.
+            rng = substream(self.key, self.leg)
+            self.leg += 1
 
             # Change direction?
-            if np.random.rand(1)[0] < self.p_change_direction:
+            if rng.random() < self.p_change_direction:
                 # Yes, change direction
                 self.swarm_direction *= -1
-                print("Swapping direction: {}".format(self.swarm_direction))
             self.destination_hive = (self.destination_hive + self.swarm_direction) % self.n_hives
 
             # Jump hives?
-            if np.random.rand(1)[0] < self.p_jump_hives:
+            if rng.random() < self.p_jump_hives:
                 # Yes, generate a random destination hive
-                self.destination_hive = np.random.randint(self.n_hives)
-                print("Jumping hives, new destination: {}".format(
-                    self.destination_hive))
+                self.destination_hive = int(rng.integers(self.n_hives))
 
-            # Sample a linger time
-            self.n_linger_frames = (
-                3 * self.sample_rate - (n_samples - movement_end_frame))
+    def retarget(self, hive, delay=0):
+        """
+        Sends the swarm straight towards hive, starting delay samples from
+        now. The planned path beyond that point is discarded.
+        """
+        frame = self.frame + delay
+        self.plan_path(frame)
+        knot_frames = np.asarray(self.knot_frames)
+        knot_positions = np.asarray(self.knot_positions)
+        position = np.array([
+            np.interp(frame, knot_frames, knot_positions[:,dim])
+            for dim in range(knot_positions.shape[1])])
+
+        n_keep = np.searchsorted(knot_frames, frame, side='right')
+        del self.knot_frames[n_keep:]
+        del self.knot_positions[n_keep:]
+        if self.knot_frames[-1] < frame:
+            self.knot_frames.append(float(frame))
+            self.knot_positions.append(position)
+        self.destination_hive = hive
+
+    def sample_swarm_positions(self, n_samples, out=None):
+        """
+        Samples the position of the swarm as it moves between the hives.
+        Updates the internal state of the object such that subsequent calls
+        will progress the swarm on its path. Any number of samples can be
+        requested, covering any number of moves and lingers.
 
-            print("swarm_position: {}, destination_hive: {}, n_linger_frames: {}".format(
-                self.swarm_position, self.destination_hive, self.n_linger_frames))
+        Parameters
+        ----------
+        n_samples: int
+            The number of samples to generate.
+        out: array_like, (N, 2) or None
+            If given, the positions are written into this array.
 
-        if movement_start_frame > 0:
-            self.n_linger_frames -= movement_start_frame
+        Returns
+        -------
+        positions: array_like, (N, 2)
+            The position of the swarm at each sample.
+        """
+        end_frame = self.frame + n_samples
+        self.plan_path(end_frame)
 
+        if out is None:
+            out = np.empty((n_samples, self.hives.shape[1]), dtype=np.float32)
 
-        return positions
+        frames = np.arange(self.frame, end_frame, dtype=np.float64)
+        knot_frames = np.asarray(self.knot_frames)
+        knot_positions = np.asarray(self.knot_positions)
+        for dim in range(out.shape[1]):
+            out[:,dim] = np.interp(frames, knot_frames, knot_positions[:,dim])
 
-    def sample_swarm_volumes(self, n_samples):
-        swarm_positions = self.sample_swarm_positions(n_samples)
+        ###
+        # Now update internal state
+        ###
+        self.frame = end_frame
+        self.swarm_position = out[-1].copy()
+
+        self._forget_knots(self.frame)
+        return out
+
+    def _forget_knots(self, frame):
+        # Forget knots that are entirely in the past, keeping the last knot
+        # at or before frame.
+        first_knot = np.searchsorted(
+            self.knot_frames, frame, side='right') - 1
+        if first_knot > 0:
+            del self.knot_frames[:first_knot]
+            del self.knot_positions[:first_knot]
+
+    def sample_swarm_volumes(self, n_samples, out=None):
+        if self._positions is None or self._positions.shape[0] != n_samples:
+            self._positions = np.empty(
+                (n_samples, self.hives.shape[1]), dtype=np.float32)
+        swarm_positions = self.sample_swarm_positions(
+            n_samples, out=self._positions)
         # print(swarm_positions)
         # print("Position: {}".format(swarm_positions[0]), end=", ")
-        return hive_volumes(self.hives, swarm_positions)
+        return self.gain_kernel(swarm_positions, out=out)
 
 
 class Swarm:
 
-    def __init__(self, hive_radius, hives, swarm_speed, sample_rate):
+    def __init__(self,
+                 hive_radius,
+                 hives,
+                 swarm_speed,
+                 sample_rate,
+                 sigma=1,
+                 gain_kernel=None,
+                 seed=None):
         """
         Initialise a swarm.
 
@@ -199,10 +343,23 @@ class Swarm:
             The speed that the swarm will travel.
         sample_rate: int
             The sample rate.
+        sigma: float
+            Width of the gain kernel used to compute hive volumes.
+        seed: int or None
+            Seeds the swarm's random choices. If None, a seed is drawn from
+            numpy's global random state.
         """
         self.hive_radius = hive_radius
-        self.hives = hives
+        self.hives = np.asarray(hives)
         self.n_hives = len(hives)
+        # The angle of each hive around the circle, in [0, 2pi)
+        self.hive_angles = (
+            np.arctan2(self.hives[:,1], self.hives[:,0]) % (2*np.pi))
+        if gain_kernel is None:
+            gain_kernel = GainKernel(self.hives, sigma=sigma)
+        self.gain_kernel = gain_kernel
+        # Reusable buffer for the positions used to compute volumes.
+        self._positions = None
         self.swarm_speed = swarm_speed
         print(swarm_speed)
         self.swarm_speed_rad = swarm_speed/hive_radius
@@ -214,135 +371,557 @@ class Swarm:
         # from some reference point
         self.swarm_position = 0
 
-    def sample_swarm_positions(self, n_samples):
+        self.seed = default_seed(seed)
+        self.rng = np.random.Generator(
+            np.random.Philox(key=swarm_key(self.seed)))
+
+    def get_state(self):
+        """
+        Returns a checkpoint of the swarm, for set_state().
+        """
+        return {
+            "swarm_position": self.swarm_position,
+            "rng": self.rng.bit_generator.state,
+        }
+
+    def set_state(self, state):
+        self.swarm_position = state["swarm_position"]
+        self.rng.bit_generator.state = state["rng"]
+
+    def sample_swarm_positions(self, n_samples, out=None):
         """
         Samples the position of a swarm as it moves around the
-        circle at random for a given duration and sample rate.
+        circle at random for a given number of samples.
         Updates the internal state of the object with the new
         swarm position such that subsequent calls will progress
         the swarm on its path.
 
+        The path alternates between lingering at a hive and moving around
+        the circle to the next hive. Each linger and each move is generated
+        in bulk from the angles of the swarm along it.
+
         Parameters
         ----------
-        duration: float
-            The duration in seconds for which to generate the samples.
         n_samples: int
             The number of samples to generate.
+        out: array_like, (N, 2) or None
+            If given, the positions are written into this array.
 
         Returns
         -------
         positions: array_like, (N, 2)
-            Returns N = duration * sample_rate samples for the position
-            of the swarm. Position is given by the angle of the swarm
+            Returns N samples for the position of the swarm as x, y
+            coordinates on the circle.
         """
 
-        ##########################################
-        # NOTE: I THINK THIS SHOULD BE MORE ROBUST IF WE INPUT SAMPLE RATE AND
-        # NUMBER OF SAMPLES, RATHER THAN DURATION.
-        ##########################################
-
         # Give options for how long the hive can linger for
         min_linger_time = 3 # s
         max_linger_time = 30 # s
         linger_options = range(min_linger_time, max_linger_time)
 
         # Choose a random hive to begin at and update position
-        hive_no = np.random.randint(self.n_hives)
-        self.swarm_position = np.pi/12 + np.pi*hive_no/6
+        hive_no = self.rng.integers(self.n_hives)
+        self.swarm_position = self.hive_angles[hive_no]
 
         total_samples = n_samples
         s_counter = 0       # Sample counter
-        positions = np.empty((total_samples, 2))
+        if out is None:
+            out = np.empty((total_samples, 2))
+        positions = out
 
         increment = self.swarm_speed_rad/self.sample_rate
-        tolerance = increment
 
         while s_counter < total_samples:
             # Allocate positions while hive is stationary
-            t_stay = linger_options[np.random.randint(len(linger_options))]
-            sample_num = t_stay * self.sample_rate
-            new_s_counter = s_counter + sample_num
-
-            current_position = np.array(
-                [[self.hive_radius * np.cos(self.swarm_position),
-                  self.hive_radius * np.sin(self.swarm_position)]])
-
-            if s_counter + sample_num < total_samples:
-                positions[s_counter:new_s_counter, :] = \
-                                       np.full([sample_num,2], current_position)
-            else:
-                positions[s_counter:,:] = \
-                          np.full([total_samples-s_counter,2], current_position)
+            t_stay = linger_options[self.rng.integers(len(linger_options))]
+            sample_num = int(t_stay * self.sample_rate)
+            new_s_counter = min(s_counter + sample_num, total_samples)
+
+            positions[s_counter:new_s_counter, 0] = (
+                self.hive_radius * np.cos(self.swarm_position))
+            positions[s_counter:new_s_counter, 1] = (
+                self.hive_radius * np.sin(self.swarm_position))
+            s_counter = new_s_counter
 
             # Choose the next hive at random
-            hive_no = np.random.randint(7)
-            destination_angle = np.pi/12 + np.pi*hive_no/6
+            hive_no = self.rng.integers(self.n_hives)
+            destination_angle = self.hive_angles[hive_no]
 
             # Swarm direction,
             # Go either anticlockwise (+1) or clockwise (-1)
-            s_dir = 2 * np.random.randint(2) - 1
-
-            # Allocate positions while moving
-            while (new_s_counter < total_samples and
-                    self.swarm_position != destination_angle):
-                # Increment swarm position
-                self.swarm_position = self.swarm_position + s_dir*increment
-                current_position = (
-                    np.array([[self.hive_radius * np.cos(self.swarm_position),
-                    self.hive_radius * np.sin(self.swarm_position)]]))
+            s_dir = 2 * self.rng.integers(2) - 1
 
-                # Update positions array
-                positions[new_s_counter, :] = current_position
+            if s_counter >= total_samples or self.swarm_position == destination_angle:
+                continue
 
-                new_s_counter += 1
+            # Angle to travel in the chosen direction. The swarm arrives on
+            # the first increment that brings it within one increment of the
+            # destination, and always moves at least once.
+            distance = (s_dir * (destination_angle - self.swarm_position)) % (2*np.pi)
+            n_move = max(1, int(np.floor(distance / increment)))
+            n_move_samples = min(n_move, total_samples - s_counter)
 
-                pos = (
-                    self.swarm_position -
-                    np.floor(self.swarm_position/(2*np.pi)) * 2 * np.pi)
-                if abs(destination_angle - pos) < tolerance:
-                    self.swarm_position = destination_angle
+            # Allocate positions while moving
+            angles = self.swarm_position + s_dir * increment * np.arange(
+                1, n_move_samples + 1)
+            new_s_counter = s_counter + n_move_samples
+            positions[s_counter:new_s_counter, 0] = self.hive_radius * np.cos(angles)
+            positions[s_counter:new_s_counter, 1] = self.hive_radius * np.sin(angles)
+
+            if n_move_samples == n_move:
+                self.swarm_position = destination_angle
+            else:
+                self.swarm_position = angles[-1]
 
             s_counter = new_s_counter
 
         return positions
 
-    def sample_swarm_volumes(self, n_samples):
-        swarm_positions = self.sample_swarm_positions(n_samples)
+    def sample_swarm_volumes(self, n_samples, out=None):
+        if self._positions is None or self._positions.shape[0] != n_samples:
+            self._positions = np.empty(
+                (n_samples, self.hives.shape[1]), dtype=np.float32)
+        swarm_positions = self.sample_swarm_positions(
+            n_samples, out=self._positions)
         # print(swarm_positions)
         # print("Position: {}".format(swarm_positions[0]), end=", ")
-        return hive_volumes(self.hives, swarm_positions)
+        return self.gain_kernel(swarm_positions, out=out)
 
 class SwarmBuffer:
     """
     Wraps Swarm and generates samples for a large sequence. These are then
     returned chunk by chunk through sample_swarm_volumes.
+
+    See automation.GainAutomation for longer sequences, cached on disk.
     """
 
     def __init__(self, *args, **kwargs):
         self.swarm = Swarm(*args, **kwargs)
 
-        # Generate volumes for 10 mins
-        self.volumes = self.swarm.sample_swarm_volumes(41000 * 60 * 1)
+        # Generate volumes for one minute
+        self.volumes = np.asarray(
+            self.swarm.sample_swarm_volumes(
+                int(self.swarm.sample_rate * 60)), np.float32)
 
 
         self.next_sample = 0
 
-    def sample_swarm_volumes(self, n_samples):
-        end_sample = self.next_sample + n_samples
-        samples = np.take(
-            self.volumes,
-            range(self.next_sample, end_sample),
-            mode='wrap',
-            axis = 0)
-        self.next_sample = end_sample % self.volumes.shape[0]
+    def sample_swarm_volumes(self, n_samples, out=None):
+        samples = samplestream.read_looped(
+            self.volumes, self.next_sample, n_samples, out=out)
+        self.next_sample = (self.next_sample + n_samples) % self.volumes.shape[0]
 
         return samples
 
 
 
-def hive_volumes(hives, swarm_positions, sigma=1):
+class ControlRateSwarm:
+    """
+    Evaluates a swarm at control rate and interpolates its hive volumes up to
+    audio rate. The swarm moves slowly compared to the sample rate, so its
+    positions and volumes only need computing once every control_rate_divisor
+    frames. The volumes in between are linearly interpolated for each hive.
+
+    The wrapped swarm should be created with a sample rate of
+    sample_rate / control_rate_divisor, so that each of its samples is one
+    control tick.
+    """
+
+    def __init__(self, swarm, control_rate_divisor=64):
+        """
+        Parameters
+        ----------
+        swarm: SwarmLinear or Swarm
+            The swarm to evaluate at control rate.
+        control_rate_divisor: int
+            The number of audio frames per control tick.
+        """
+        self.swarm = swarm
+        self.hives = swarm.hives
+        self.n_hives = swarm.n_hives
+        self.control_rate_divisor = control_rate_divisor
+
+        # The frame index of the next sample to be generated.
+        self.frame = 0
+
+        # Volumes at consecutive control ticks, starting at tick first_tick.
+        # Tick t is at frame t * control_rate_divisor.
+        self.first_tick = 0
+        self.tick_volumes = np.array(swarm.sample_swarm_volumes(1))
+
+        # Interpolation weights for the volumes at the start and end of a
+        # tick, for each frame within the tick
+        ramp = (
+            np.arange(control_rate_divisor, dtype=np.float32) /
+            control_rate_divisor)
+        self.weights = np.stack((1 - ramp, ramp), axis=1)
+
+    def seek(self, frame):
+        """
+        Moves to frame, as though the swarm had been sampled up to there.
+        The wrapped swarm must support seek(), as SwarmLinear does.
+        """
+        K = self.control_rate_divisor
+        self.frame = frame
+        self.first_tick = frame // K
+        self.swarm.seek(self.first_tick)
+        self.tick_volumes = np.array(self.swarm.sample_swarm_volumes(1))
+
+    def get_state(self):
+        """
+        Returns a checkpoint of the swarm, for set_state().
+        """
+        return {
+            "swarm": self.swarm.get_state(),
+            "frame": self.frame,
+            "first_tick": self.first_tick,
+            "tick_volumes": self.tick_volumes.copy(),
+        }
+
+    def set_state(self, state):
+        self.swarm.set_state(state["swarm"])
+        self.frame = state["frame"]
+        self.first_tick = state["first_tick"]
+        self.tick_volumes = state["tick_volumes"].copy()
+
+    def retarget(self, hive, delay=0):
+        """
+        Sends the swarm towards hive from delay frames from now. Takes effect
+        from the first control tick at or after that frame that has not
+        already been evaluated.
+        """
+        K = self.control_rate_divisor
+        tick = -(-(self.frame + delay) // K)
+        n_evaluated = self.first_tick + len(self.tick_volumes)
+        self.swarm.retarget(hive, delay=max(tick - n_evaluated, 0))
+
+    def evaluate_ticks(self, n_samples):
+        """
+        Evaluates the swarm at any control ticks needed to interpolate the
+        next n_samples frames. Returns the range of ticks needed, relative to
+        first_tick.
+        """
+        K = self.control_rate_divisor
+        end_frame = self.frame + n_samples
+        last_tick = (end_frame - 1) // K + 1
+        n_new_ticks = last_tick - (self.first_tick + len(self.tick_volumes) - 1)
+        if n_new_ticks > 0:
+            self.tick_volumes = np.concatenate(
+                (self.tick_volumes,
+                 self.swarm.sample_swarm_volumes(n_new_ticks)))
+        return self.frame // K - self.first_tick, last_tick - self.first_tick
+
+    def active_channels(self, n_samples):
+        """
+        Returns the indices of the hives with a non-zero volume at any point
+        in the next n_samples frames. With a SparseGainKernel most hives are
+        silent, and only these need to be interpolated and mixed.
+        """
+        start_tick, end_tick = self.evaluate_ticks(n_samples)
+        return np.flatnonzero(
+            self.tick_volumes[start_tick:end_tick + 1].any(axis=0))
+
+    def sample_swarm_volumes(self, n_samples, out=None, channels=None):
+        """
+        Samples the volume of each hive for the next n_samples frames.
+
+        Parameters
+        ----------
+        n_samples: int
+            The number of samples to generate.
+        out: array_like, (N, H) float32 or None
+            If given, the volumes are written into this array.
+        channels: array_like of int or None
+            If given, only the volumes of these hives are interpolated, and
+            out is (N, len(channels)).
+
+        Returns
+        -------
+        volumes: array_like, (N, H)
+            The volume for each hive at each sample.
+        """
+        K = self.control_rate_divisor
+        start_frame = self.frame
+        end_frame = start_frame + n_samples
+
+        n_hives = self.n_hives if channels is None else len(channels)
+        if out is None:
+            out = np.empty((n_samples, n_hives), dtype=np.float32)
+
+        start_tick, _ = self.evaluate_ticks(n_samples)
+        tick_volumes = self.tick_volumes
+        if channels is not None:
+            tick_volumes = tick_volumes[:, channels]
+
+        if start_frame % K == 0 and n_samples % K == 0:
+            # Chunk is aligned with the control ticks, so interpolate a
+            # whole tick at a time as a weighted sum of the volumes at either
+            # end of the tick, (K, 2) x (2, H) for each tick.
+            n_ticks = n_samples // K
+            volumes = tick_volumes[start_tick:start_tick + n_ticks + 1]
+            # Overlapping (n_ticks, 2, H) view of consecutive tick pairs
+            tick_pairs = np.ndarray(
+                (n_ticks, 2, n_hives),
+                dtype=volumes.dtype,
+                buffer=volumes,
+                strides=(volumes.strides[0],) + volumes.strides)
+            blocks = out.reshape(n_ticks, K, n_hives)
+            np.matmul(self.weights, tick_pairs, out=blocks)
+            if not np.may_share_memory(blocks, out):
+                # out couldn't be reshaped in place, so the volumes went
+                # into a copy.
+                np.copyto(out, blocks.reshape(n_samples, n_hives))
+        else:
+            frames = np.arange(start_frame, end_frame)
+            ticks = frames // K - self.first_tick
+            fractions = (frames % K).astype(np.float32) / K
+            volumes = tick_volumes
+            np.multiply(
+                volumes[ticks + 1] - volumes[ticks],
+                fractions[:,np.newaxis],
+                out=out)
+            out += volumes[ticks]
+
+        # Forget ticks that are no longer needed
+        self.frame = end_frame
+        n_old_ticks = end_frame // K - self.first_tick
+        if n_old_ticks > 0:
+            self.tick_volumes = self.tick_volumes[n_old_ticks:]
+            self.first_tick += n_old_ticks
+
+        return out
+
+
+class GainKernel:
+    """
+    Computes the volume at each hive from the swarm position with a gaussian
+    kernel,
+
+        volume = exp(-|x - h|^2 / sigma^2)
+
+    for swarm position x and hive position h. Works in float32 and writes
+    into a caller supplied buffer, so that it can run on every chunk without
+    allocating.
+    """
+
+    def __init__(self, hives, sigma=1, expand=False):
+        """
+        Parameters
+        ----------
+        hives: array_like, (H, D)
+            The positions of the hives.
+        sigma: float
+            The width of the kernel, in the same units as the hive positions.
+        expand: bool
+            If True, compute squared distances with the expansion
+            |x|^2 - 2x.h + |h|^2 using precomputed hive norms, which turns the
+            bulk of the work into one matrix product. This is faster for
+            large numbers of hives but less accurate far from the hives.
+        """
+        self.hives = np.asarray(hives, dtype=np.float32)
+        self.n_hives = len(self.hives)
+        self.sigma = sigma
+        self.gamma = np.float32(1. / sigma**2)
+        self.expand = expand
+
+        # Squared norm of each hive, for the expansion
+        self.hive_norms = np.sum(self.hives**2, axis=1)
+        # Transposed hives scaled by 2, for the expansion
+        self.hives_t2 = np.ascontiguousarray(2 * self.hives.T)
+
+        # Reusable scratch buffers, allocated on first use and whenever the
+        # number of positions changes.
+        self._scratch = None
+        self._position_norms = None
+
+    def _ensure_scratch(self, n_positions):
+        if self._scratch is None or self._scratch.shape[0] != n_positions:
+            self._scratch = np.empty(
+                (n_positions, self.n_hives), dtype=np.float32)
+            self._position_norms = np.empty(n_positions, dtype=np.float32)
+
+    def __call__(self, positions, out=None):
+        """
+        Parameters
+        ----------
+        positions: array_like, (N, D)
+            The position of the swarm at each sample.
+        out: array_like, (N, H) float32 or None
+            If given, the volumes are written into this array.
+
+        Returns
+        -------
+        volumes: array_like, (N, H)
+            The volume for each hive at each sample.
+        """
+        positions = np.asarray(positions)
+        n_positions = positions.shape[0]
+        if out is None:
+            out = np.empty((n_positions, self.n_hives), dtype=np.float32)
+        self._ensure_scratch(n_positions)
+
+        if self.expand:
+            # -(|x|^2 - 2x.h + |h|^2)
+            np.matmul(positions, self.hives_t2, out=out, casting='unsafe')
+            out -= self.hive_norms
+            norms = self._position_norms
+            norms.fill(0)
+            for dim in range(positions.shape[1]):
+                np.square(positions[:,dim], out=self._scratch[:,0],
+                          casting='unsafe')
+                norms += self._scratch[:,0]
+            out -= norms[:,np.newaxis]
+            # Rounding can leave small positive values for coincident points
+            np.minimum(out, 0, out=out)
+        else:
+            # -sum over dimensions of (x - h)^2
+            scratch = self._scratch
+            out.fill(0)
+            for dim in range(positions.shape[1]):
+                np.subtract(
+                    positions[:,dim,np.newaxis], self.hives[:,dim],
+                    out=scratch, casting='unsafe')
+                np.square(scratch, out=scratch)
+                out -= scratch
+
+        out *= self.gamma
+        np.exp(out, out=out)
+        return out
+
+
+class SparseGainKernel:
+    """
+    The gain kernel of GainKernel, evaluated only for the hives near the
+    swarm. With many hives spread over a large space, most hives are far
+    enough from the swarm that their gain is negligible, so computing it is
+    wasted work.
+
+    For each batch of positions, the hives that can be within reach of any
+    of them are found from a spatial index over the hives. A hive is in
+    reach if its gain could be at least threshold, i.e. if it is within
+    sigma * sqrt(-ln(threshold)) of the batch's bounding box. Only those
+    hives are evaluated; every other hive's gain is taken to be zero, an
+    error of less than threshold.
+    """
+
+    def __init__(self, hives, sigma=1, threshold=1e-3, k=None):
+        """
+        Parameters
+        ----------
+        hives: array_like, (H, D)
+            The positions of the hives.
+        sigma: float
+            The width of the kernel, in the same units as the hive positions.
+        threshold: float
+            The gain below which a hive is treated as silent.
+        k: int or None
+            If given, at most the k hives nearest the centre of the batch are
+            evaluated, even if more are in reach.
+        """
+        # scipy is only needed for sparse gains, so it is imported here to
+        # keep it off the import path of the playback processes.
+        from scipy.spatial import cKDTree
+
+        self.hives = np.asarray(hives, dtype=np.float32)
+        self.n_hives = len(self.hives)
+        self.sigma = sigma
+        self.gamma = np.float32(1. / sigma**2)
+        self.threshold = threshold
+        self.k = k
+        self.cutoff = sigma * np.sqrt(-np.log(threshold))
+        self.tree = cKDTree(self.hives)
+
+        # Reusable scratch buffers, allocated on first use and whenever the
+        # number of positions changes.
+        self._n_positions = None
+
+    def _ensure_scratch(self, n_positions):
+        if self._n_positions != n_positions:
+            self._n_positions = n_positions
+            # Flat, so that an (N, A) view for any number of active hives A
+            # is contiguous.
+            self._scratch = np.empty(
+                n_positions * self.n_hives, dtype=np.float32)
+            self._gains = np.empty(
+                n_positions * self.n_hives, dtype=np.float32)
+
+    def active_hives(self, positions):
+        """
+        Returns the sorted indices of the hives in reach of any of the
+        positions.
+        """
+        lower = positions.min(axis=0)
+        upper = positions.max(axis=0)
+        centre = (lower + upper) / 2
+        radius = np.linalg.norm(upper - lower) / 2
+
+        hives = self.tree.query_ball_point(centre, self.cutoff + radius)
+        if self.k is not None and len(hives) > self.k:
+            _, hives = self.tree.query(
+                centre, self.k, distance_upper_bound=self.cutoff + radius)
+        return np.sort(np.atleast_1d(np.asarray(hives, dtype=np.int64)))
+
+    def sparse(self, positions, hives=None):
+        """
+        Evaluates the kernel for the active hives only.
+
+        Parameters
+        ----------
+        positions: array_like, (N, D)
+            The position of the swarm at each sample.
+        hives: array_like of int or None
+            The hives to evaluate. Defaults to active_hives(positions).
+
+        Returns
+        -------
+        hives: array_like of int, (A,)
+            The indices of the hives evaluated.
+        volumes: array_like, (N, A)
+            The volume for each of those hives at each sample. This is a
+            view of a scratch buffer that is overwritten by the next call.
+        """
+        positions = np.asarray(positions)
+        if hives is None:
+            hives = self.active_hives(positions)
+        n_positions = positions.shape[0]
+        n_active = len(hives)
+        self._ensure_scratch(n_positions)
+
+        active = self.hives[hives]
+        out = self._gains[:n_positions * n_active].reshape(
+            n_positions, n_active)
+        scratch = self._scratch[:n_positions * n_active].reshape(
+            n_positions, n_active)
+        out.fill(0)
+        for dim in range(positions.shape[1]):
+            np.subtract(
+                positions[:,dim,np.newaxis], active[:,dim],
+                out=scratch, casting='unsafe')
+            np.square(scratch, out=scratch)
+            out -= scratch
+        out *= self.gamma
+        np.exp(out, out=out)
+        return hives, out
+
+    def __call__(self, positions, out=None):
+        """
+        Computes the volume of every hive, as GainKernel does, with the
+        hives out of reach set to zero.
+        """
+        positions = np.asarray(positions)
+        if out is None:
+            out = np.empty((positions.shape[0], self.n_hives), dtype=np.float32)
+        hives, volumes = self.sparse(positions)
+        out.fill(0)
+        out[:, hives] = volumes
+        return out
+
+
+def hive_volumes(hives, swarm_positions, sigma=1, out=None):
     """
-    Computes the volume at each hive based on the swarm position.
+    Computes the volume at each hive based on the swarm position, as
+    exp(-|x - h|^2 / sigma^2). For repeated calls with the same hives,
+    construct a GainKernel once instead.
 
     Parameters
     ----------
@@ -351,10 +930,14 @@ def hive_volumes(hives, swarm_positions, sigma=1):
         H denotes the number of hives.
     swarm_positions: (N, 2)
         The position of the swarm at each sample.
+    sigma: float
+        The width of the kernel.
+    out: array_like, (N, H) or None
+        If given, the volumes are written into this array.
 
     Returns
     -------
-    hive_volumes: array_like, (H, N)
+    hive_volumes: array_like, (N, H)
         The volume for each hive at each sample.
     """
-    return rbf_kernel(swarm_positions, hives, gamma=1)
+    return GainKernel(hives, sigma=sigma)(swarm_positions, out=out)
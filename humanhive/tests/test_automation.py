@@ -0,0 +1,140 @@
+import os
+import tempfile
+from nose.tools import assert_equal, assert_true, assert_false, assert_raises
+from numpy.testing import assert_allclose, assert_array_equal
+import numpy as np
+from humanhive import automation, hive, scheduler, sources
+from humanhive.playback import Mixer
+
+
+def test_gain_automation_cache():
+    layout = hive.HiveLayout.circle(6, 3)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        gains = automation.GainAutomation(
+            layout, 8000, duration=20, crossfade=2, cache_dir=cache_dir)
+        assert_false(gains.loaded_from_cache)
+        assert_true(os.path.exists(gains.cache_file))
+        assert_equal(gains.table.shape, (2500, 6))
+        assert_equal(gains.table.dtype, np.float16)
+        assert_equal(gains.n_frames, 2500 * 64)
+
+        # The same parameters are memory mapped from the cache
+        cached = automation.GainAutomation(
+            layout, 8000, duration=20, crossfade=2, cache_dir=cache_dir)
+        assert_true(cached.loaded_from_cache)
+        assert_true(isinstance(cached.table, np.memmap))
+        assert_array_equal(cached.table, gains.table)
+
+        # Rendering is repeatable, and doesn't touch the global random state
+        state = np.random.get_state()[1].copy()
+        uncached = automation.GainAutomation(
+            layout, 8000, duration=20, crossfade=2, use_cache=False)
+        assert_array_equal(uncached.table, gains.table)
+        assert_array_equal(np.random.get_state()[1], state)
+
+        # Other seeds and sample rates have their own automation
+        for kwargs in [{"seed": 1}, {"sample_rate": 16000}]:
+            other = dict(sample_rate=8000, duration=20, crossfade=2,
+                         cache_dir=cache_dir)
+            other.update(kwargs)
+            assert_false(
+                automation.GainAutomation(layout, **other).loaded_from_cache)
+
+
+def test_gain_automation_uint8():
+    layout = hive.HiveLayout.circle(6, 3)
+    exact = automation.GainAutomation(
+        layout, 8000, duration=20, use_cache=False, sample_format="float16")
+    compact = automation.GainAutomation(
+        layout, 8000, duration=20, use_cache=False, sample_format="uint8")
+    assert_equal(compact.table.dtype, np.uint8)
+
+    expected = exact.player().sample_swarm_volumes(8192)
+    volumes = compact.player().sample_swarm_volumes(8192)
+    assert_allclose(volumes, expected, atol=1/255)
+
+    with assert_raises(ValueError):
+        automation.GainAutomation(
+            layout, 8000, use_cache=False, sample_format="int16")
+
+
+def test_automation_player():
+    layout = hive.HiveLayout.circle(6, 3)
+    gains = automation.GainAutomation(
+        layout, 8000, duration=20, crossfade=2, use_cache=False)
+    n_frames = gains.n_frames
+    table = gains.table.astype(np.float32)
+
+    # The ticks are interpolated linearly, whatever the chunk size
+    player = gains.player()
+    volumes = np.concatenate(
+        [player.sample_swarm_volumes(n) for n in [64, 100, 1, 1000, 64]])
+    frames = np.arange(len(volumes))
+    expected = np.stack(
+        [np.interp(frames / 64, np.arange(len(table)), table[:,h])
+         for h in range(6)], axis=1)
+    assert_allclose(volumes, expected, atol=1e-5)
+
+    # Seeking gives the same volumes as playing up to that point
+    player.seek(500)
+    assert_allclose(player.sample_swarm_volumes(300), volumes[500:800])
+    channels = np.array([1, 4])
+    player.seek(500)
+    assert_allclose(
+        player.sample_swarm_volumes(300, channels=channels),
+        volumes[500:800, channels])
+
+    # Aligned chunks can be written into a strided view, e.g. some of the
+    # channels of a bus.
+    player.seek(64)
+    bus = np.zeros((1152, 8), dtype=np.float32)
+    player.sample_swarm_volumes(1152, out=bus[:, 1:7])
+    assert_allclose(bus[:, 1:7], volumes[64:1216], atol=1e-6)
+    assert_true(np.all(bus[:, [0, 7]] == 0))
+
+    # The loop point is crossfaded, so the gains carry on smoothly across
+    # it rather than jumping back to the start.
+    player.seek(n_frames - 640)
+    looped = player.sample_swarm_volumes(1280)
+    steps = np.abs(np.diff(looped, axis=0)).max()
+    assert_true(steps < 1e-3)
+    assert_allclose(looped[640:], volumes[:640], atol=1e-5)
+
+
+def test_swarm_source_automation():
+    layout = hive.HiveLayout.circle(6, 3)
+    gains = automation.GainAutomation(
+        layout, 8000, duration=20, use_cache=False)
+    audio = np.ones(4096, dtype=np.float32)
+
+    source = sources.SwarmSource(audio, 6, 8000, automation=gains)
+    frames = source.get_frames(1024)
+    assert_equal(frames.shape, (1024, 6))
+
+    player = gains.player(source.swarm.frame - 1024)
+    assert_allclose(frames, player.sample_swarm_volumes(1024), atol=1e-6)
+
+    with assert_raises(ValueError):
+        sources.SwarmSource(audio, 4, 8000, automation=gains)
+
+
+def test_swarm_source_automation_retarget():
+    layout = hive.HiveLayout.circle(6, 3)
+    gains = automation.GainAutomation(
+        layout, 8000, duration=20, use_cache=False)
+    audio = np.ones(4096, dtype=np.float32)
+    source = sources.SwarmSource(audio, 6, 8000, automation=gains)
+    player = gains.player(source.swarm_start_frame)
+
+    # A retarget through the scheduler is ignored, and playback carries on
+    # along the automation.
+    source_bank = sources.SourceBank()
+    mixer = Mixer(source_bank, 6, 1024)
+    sched = scheduler.Scheduler(source_bank)
+    sched.post(scheduler.add_command("a", source, ramp_frames=0))
+    sched.post(scheduler.retarget_command("a", 3, frame=100))
+    for i in range(2):
+        sched.dispatch(i * 1024, 1024)
+        assert_allclose(
+            mixer.render(), player.sample_swarm_volumes(1024), atol=1e-6)
@@ -0,0 +1,94 @@
+import numpy as np
+from nose.tools import assert_equal, assert_raises, assert_true
+from numpy.testing import assert_array_equal
+
+from humanhive.fanout import (
+    DeviceOutput, DriftCompensator, FanoutQueueProducer, split_channels)
+from humanhive.ringbuffer import SharedRingBuffer
+from humanhive.sources import SourceBank
+
+
+class RampSource:
+    """
+    Plays a ramp that is different on every channel, so that the fan-out of
+    channels and the continuity across chunks can be checked.
+    """
+    def __init__(self, n_channels):
+        self.n_channels = n_channels
+        self.frame = 0
+
+    def get_frames(self, n_frames, out=None):
+        frames = np.arange(self.frame, self.frame + n_frames) % 1000
+        out[:] = frames[:, np.newaxis] + 1000 * np.arange(self.n_channels)
+        self.frame += n_frames
+        return out
+
+
+def test_split_channels():
+    assert_equal(
+        split_channels(8, n_devices=2), [slice(0, 4), slice(4, 8)])
+    assert_equal(
+        split_channels(10, [2, 8]), [slice(0, 2), slice(2, 10)])
+    assert_raises(ValueError, split_channels, 8, [2, 4])
+    assert_raises(ValueError, split_channels, 9, None, 2)
+
+
+def test_device_output_unity_ratio():
+    ring = SharedRingBuffer(4, 16, 2)
+    try:
+        device = DeviceOutput(ring, slice(0, 2), DriftCompensator(16))
+        frames = np.arange(3 * 16 * 2, dtype=np.float32).reshape(-1, 2)
+        for i in range(3):
+            device.push(frames[16 * i:16 * (i + 1)], 0.)
+
+        # At a ratio of one the frames are copied across, one frame late.
+        assert_equal(ring.fill_level(), 3)
+        out = np.concatenate([ring.chunks[i] for i in range(3)])
+        assert_array_equal(out[1:], frames[:-1])
+    finally:
+        ring.close()
+
+
+def test_fanout_drift():
+    n_frames = 64
+    rings = [SharedRingBuffer(16, n_frames, 2), SharedRingBuffer(16, n_frames, 3)]
+    try:
+        source_bank = SourceBank()
+        source_bank.add_source(RampSource(5))
+        producer = FanoutQueueProducer(
+            source_bank, rings, 5, 48000, n_frames)
+
+        producer.run(n_chunks=4)
+        # Each device gets its own slice of the channels.
+        assert_true(np.all(rings[0].chunks[0] < 2000))
+        assert_true(np.all(rings[1].chunks[1][:, 0] >= 2000))
+        assert_true(np.all(rings[1].chunks[1][:, 2] >= 4000))
+
+        # The second device's clock runs 500ppm fast, so it consumes
+        # slightly more chunks than the reference.
+        drift = 1 + 5e-4
+        consumed = 0.
+        fill_levels = []
+        ratios = []
+        for step in range(40000):
+            rings[0].read_chunk(block=False)
+            rings[0].commit_read()
+
+            consumed += drift
+            while consumed >= 1:
+                assert_true(rings[1].read_chunk(block=False) is not None)
+                rings[1].commit_read()
+                consumed -= 1
+
+            producer.run(n_chunks=1)
+            fill_levels.append(rings[1].fill_level())
+            ratios.append(producer.drift_ratios()[0])
+
+        # More frames are produced for the fast device, and its ring neither
+        # runs dry nor fills up.
+        assert_true(abs(np.mean(ratios[-10000:]) - 1 / drift) < 2e-5)
+        assert_true(min(fill_levels[-10000:]) > 0)
+        assert_equal(producer.metrics.counters["device_1_dropped_frames"], 0)
+    finally:
+        for ring in rings:
+            ring.close()
@@ -0,0 +1,86 @@
+import json
+import os
+import tempfile
+from nose.tools import assert_equal, assert_true, assert_false
+from numpy.testing import assert_allclose, assert_array_almost_equal
+import numpy as np
+from humanhive import hive, swarm
+
+
+def test_generate_hive_circle():
+    n_hives = 16
+    hives = hive.generate_hive_circle(n_hives, 3)
+
+    assert_equal(hives.shape, (n_hives, 2))
+    assert_array_almost_equal(np.linalg.norm(hives, axis=1), 3)
+    # Evenly spaced, so every neighbouring pair is the same distance apart
+    steps = np.linalg.norm(np.roll(hives, -1, axis=0) - hives, axis=1)
+    assert_array_almost_equal(steps, steps[0])
+
+
+def test_gain_table():
+    hives = hive.generate_hive_circle(8, 3)
+    positions = np.random.RandomState(0).uniform(-4, 4, size=(1000, 2))
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        gain_table = hive.GainTable(hives, cache_dir=cache_dir)
+        assert_false(gain_table.loaded_from_cache)
+        assert_true(os.path.exists(gain_table.cache_file))
+
+        expected = swarm.GainKernel(hives)(positions)
+        assert_allclose(gain_table(positions), expected, atol=2e-3)
+
+        # A second table for the same layout is loaded from the cache
+        cached = hive.GainTable(hives, cache_dir=cache_dir)
+        assert_true(cached.loaded_from_cache)
+        out = np.empty((1000, 8), dtype=np.float32)
+        cached(positions, out=out)
+        assert_allclose(out, expected, atol=2e-3)
+
+        # Different parameters have their own table
+        assert_false(
+            hive.GainTable(hives, sigma=2, cache_dir=cache_dir)
+            .loaded_from_cache)
+
+
+def test_layout_from_file():
+    hives = [[0, 0, 0], [1, 0, 0.5], [0, 2, 1]]
+    positions = np.array([[0, 0, 0], [0.3, 0.7, 0.2], [5, 5, 5]])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "layout.json")
+        with open(filename, "w") as f:
+            json.dump({"name": "test", "hives": hives}, f)
+
+        layout = hive.HiveLayout.from_file(filename)
+        assert_equal(layout.name, "test")
+        assert_equal(layout.n_hives, 3)
+        assert_equal(layout.n_dims, 3)
+
+        gain_table = layout.gain_table(resolution=0.1, cache_dir=tmp_dir)
+        assert_true(layout.gain_table(resolution=0.1, cache_dir=tmp_dir)
+                    is gain_table)
+        assert_allclose(
+            gain_table(positions), swarm.GainKernel(hives)(positions),
+            atol=5e-3)
+
+
+def test_layout_gain_kernel():
+    hives = hive.generate_hive_circle(4, 3)
+
+    assert_true(isinstance(
+        hive.HiveLayout(hives).gain_kernel(), swarm.GainKernel))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ["HUMANHIVE_CACHE"] = tmp_dir
+        try:
+            layout = hive.HiveLayout(hives, use_gain_table=True)
+            assert_true(isinstance(layout.gain_kernel(), hive.GainTable))
+
+            filename = os.path.join(tmp_dir, "layout.json")
+            layout.save(filename)
+            loaded = hive.HiveLayout.from_file(filename)
+            assert_true(loaded.use_gain_table)
+            assert_array_almost_equal(loaded.hives, hives)
+        finally:
+            del os.environ["HUMANHIVE_CACHE"]
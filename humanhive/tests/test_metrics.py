@@ -0,0 +1,39 @@
+import json
+import os
+import tempfile
+from nose.tools import assert_equal
+
+from humanhive.metrics import Histogram, Metrics
+
+
+def test_histogram():
+    histogram = Histogram([1, 2, 4])
+    for value in [0.5, 1.5, 1.5, 3, 10]:
+        histogram.record(value)
+
+    assert_equal(histogram.counts, [1, 2, 1, 1])
+    assert_equal(histogram.count, 5)
+    assert_equal(histogram.max, 10)
+    assert_equal(histogram.percentile(50), 2)
+    # The 99th percentile lies in the overflow bin.
+    assert_equal(histogram.percentile(99), None)
+
+
+def test_metrics_export():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "metrics.jsonl")
+        metrics = Metrics(path, interval=0, process_name="test")
+
+        metrics.increment("xruns")
+        metrics.increment("xruns", 2)
+        metrics.record("write_latency", 0.003)
+        metrics.maybe_export()
+        metrics.maybe_export()
+
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+
+    assert_equal(len(lines), 2)
+    assert_equal(lines[-1]["process"], "test")
+    assert_equal(lines[-1]["counters"], {"xruns": 3})
+    assert_equal(lines[-1]["histograms"]["write_latency"]["p50"], 5e-3)
@@ -0,0 +1,134 @@
+import time
+import numpy as np
+from nose.tools import assert_equal, assert_true
+from numpy.testing import assert_allclose
+
+from humanhive.metrics import Metrics
+from humanhive.mixpool import MixPool, partition
+from humanhive.playback import Mixer
+from humanhive.sources import SourceBank, SwarmSource
+
+
+N_CHANNELS = 4
+SAMPLE_RATE = 8000
+N_FRAMES = 256
+
+
+def build_source_bank(worker=0, n_workers=1, n_sources=5):
+    audio_data = (np.arange(3000) % 100).astype(np.int16)
+    source_bank = SourceBank()
+    for i in partition(range(n_sources), worker, n_workers):
+        source_bank.add_source(
+            SwarmSource(audio_data, N_CHANNELS, SAMPLE_RATE, seed=i))
+    return source_bank
+
+
+class SlowSource:
+    """
+    Takes 50ms to render each chunk, which is numbered from 1.
+    """
+
+    def __init__(self):
+        self.chunk = 0
+
+    def get_frames(self, n_frames, out=None):
+        time.sleep(0.05)
+        self.chunk += 1
+        out[:] = self.chunk
+        return out
+
+
+def build_slow_source_bank(worker, n_workers):
+    source_bank = SourceBank()
+    source_bank.add_source(SlowSource())
+    return source_bank
+
+
+def test_mix_pool():
+    pool = MixPool(
+        build_source_bank, 2, N_CHANNELS, SAMPLE_RATE, N_FRAMES, max_wait=5)
+    pool.start()
+    try:
+        assert_true(pool.wait_ready(timeout=10))
+        source_bank = SourceBank()
+        source_bank.add_source(pool)
+        mixer = Mixer(source_bank, N_CHANNELS, N_FRAMES)
+        mixed = np.concatenate([mixer.render().copy() for i in range(20)])
+    finally:
+        pool.stop()
+
+    # The stems of the workers' partitions add up to the mix of all the
+    # sources in one process.
+    mixer = Mixer(build_source_bank(), N_CHANNELS, N_FRAMES)
+    expected = np.concatenate([mixer.render().copy() for i in range(20)])
+    assert_allclose(mixed, expected, rtol=1e-5, atol=1e-2)
+    assert_equal(pool.metrics.snapshot()["counters"]["late_stems"], 0)
+
+
+def test_mix_pool_late_stems():
+    for reuse_late_stems, second_chunk in [(True, 1), (False, 0)]:
+        metrics = Metrics()
+        pool = MixPool(
+            build_slow_source_bank, 1, N_CHANNELS, SAMPLE_RATE, N_FRAMES,
+            max_wait=0.001, reuse_late_stems=reuse_late_stems,
+            metrics=metrics)
+        pool.start()
+        try:
+            assert_true(pool.wait_ready(timeout=10))
+            chunks = [pool.get_frames(N_FRAMES)[0, 0]]
+            # The worker is still rendering the second stem, so it is late.
+            chunks.append(pool.get_frames(N_FRAMES)[0, 0])
+            # Let the worker catch up. The late stem is dropped, so the third
+            # chunk is the worker's third stem.
+            time.sleep(0.3)
+            chunks.append(pool.get_frames(N_FRAMES)[0, 0])
+        finally:
+            pool.stop()
+
+        assert_equal(chunks, [1, second_chunk, 3])
+        assert_equal(metrics.snapshot()["counters"]["late_stems"], 1)
+
+
+class StallingSource:
+    """
+    Renders each chunk, numbered from 1, at once, except the fifth, which
+    takes 500ms.
+    """
+
+    def __init__(self):
+        self.chunk = 0
+
+    def get_frames(self, n_frames, out=None):
+        self.chunk += 1
+        if self.chunk == 5:
+            time.sleep(0.5)
+        out[:] = self.chunk
+        return out
+
+
+def build_stalling_source_bank(worker, n_workers):
+    source_bank = SourceBank()
+    source_bank.add_source(StallingSource())
+    return source_bank
+
+
+def test_mix_pool_recovers_from_stall():
+    metrics = Metrics()
+    pool = MixPool(
+        build_stalling_source_bank, 1, N_CHANNELS, SAMPLE_RATE, N_FRAMES,
+        max_wait=0.001, metrics=metrics)
+    pool.start()
+    try:
+        assert_true(pool.wait_ready(timeout=10))
+        chunks = []
+        for i in range(200):
+            chunks.append(pool.get_frames(N_FRAMES)[0, 0])
+            time.sleep(0.005)
+    finally:
+        pool.stop()
+
+    # The worker falls many more chunks behind than its ring holds while it
+    # stalls, then catches up, so the mix ends with its stems in time.
+    late_stems = metrics.snapshot()["counters"]["late_stems"]
+    assert_true(late_stems > 4)
+    assert_equal(chunks[-20:], list(range(181, 201)))
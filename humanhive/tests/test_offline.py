@@ -0,0 +1,171 @@
+import functools
+import os
+import tempfile
+import wave
+import numpy as np
+from nose.tools import assert_equal, assert_false, assert_raises, assert_true
+
+from humanhive.audio_interface_file import AudioInterface
+from humanhive.offline import render_offline, render_parallel
+from humanhive.playback import Mixer
+from humanhive.ringbuffer import SharedRingBuffer
+from humanhive.sources import SourceBank, SwarmSource
+
+
+def build_source_bank(n_channels, sample_rate):
+    np.random.seed(0)
+    audio_data = np.random.randint(
+        -2**12, 2**12, size=sample_rate).astype(np.int16)
+    source_bank = SourceBank()
+    source_bank.add_source(SwarmSource(audio_data, n_channels, sample_rate))
+    return source_bank
+
+
+def test_render_offline():
+    n_channels = 4
+    sample_rate = 8000
+    n_frames_per_chunk = 256
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "render.wav")
+        stats = render_offline(
+            build_source_bank(n_channels, sample_rate),
+            path,
+            n_channels,
+            sample_rate,
+            duration=2.1,
+            n_frames_per_chunk=n_frames_per_chunk)
+
+        # Rounded up to whole chunks
+        assert_equal(stats["n_frames"], 66 * n_frames_per_chunk)
+        assert_true(stats["real_time_factor"] > 0)
+
+        with wave.open(path, "rb") as wf:
+            assert_equal(wf.getnchannels(), n_channels)
+            assert_equal(wf.getframerate(), sample_rate)
+            assert_equal(wf.getnframes(), stats["n_frames"])
+            rendered = np.frombuffer(
+                wf.readframes(wf.getnframes()), dtype=np.int16)
+
+    # The offline render matches mixing the same sources directly.
+    mixer = Mixer(
+        build_source_bank(n_channels, sample_rate),
+        n_channels,
+        n_frames_per_chunk)
+    expected = np.empty((66, n_frames_per_chunk, n_channels), dtype=np.int16)
+    for chunk in expected:
+        mixer.render(out=chunk)
+    np.testing.assert_array_equal(rendered, expected.ravel())
+
+
+def test_render_offline_sample_formats():
+    n_channels = 2
+    sample_rate = 8000
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        renders = {}
+        for sample_format, filename in [("int16", "render.raw"),
+                                        ("int32", "render.wav"),
+                                        ("float32", "render.raw")]:
+            path = os.path.join(tmp_dir, sample_format + filename)
+            render_offline(
+                build_source_bank(n_channels, sample_rate),
+                path,
+                n_channels,
+                sample_rate,
+                duration=0.5,
+                sample_format=sample_format)
+            if filename.endswith(".wav"):
+                with wave.open(path, "rb") as wf:
+                    assert_equal(wf.getsampwidth(), 4)
+                    data = wf.readframes(wf.getnframes())
+            else:
+                with open(path, "rb") as f:
+                    data = f.read()
+            renders[sample_format] = np.frombuffer(data, dtype=sample_format)
+
+    # The same mix at each format's full scale, to within the int16
+    # rounding
+    expected = renders["int16"].astype(np.float64)
+    np.testing.assert_allclose(renders["int32"] / 65536, expected, atol=1)
+    np.testing.assert_allclose(renders["float32"] * 32768, expected, atol=1)
+
+
+def test_render_parallel():
+    n_channels = 4
+    sample_rate = 8000
+    n_frames_per_chunk = 256
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        renders = {}
+        for name, render in [("serial", render_offline),
+                             ("parallel", render_parallel)]:
+            path = os.path.join(tmp_dir, name + ".wav")
+            if render is render_offline:
+                stats = render(
+                    build_source_bank(n_channels, sample_rate), path,
+                    n_channels, sample_rate, duration=5.1,
+                    n_frames_per_chunk=n_frames_per_chunk)
+            else:
+                # Windows that don't divide the duration, so the last is
+                # short
+                stats = render(
+                    functools.partial(
+                        build_source_bank, n_channels, sample_rate),
+                    path, n_channels, sample_rate,
+                    duration=5.1, n_frames_per_chunk=n_frames_per_chunk,
+                    window_duration=0.9, max_workers=2)
+                assert_equal(stats["n_windows"], 6)
+                assert_equal(stats["n_workers"], 2)
+            assert_equal(stats["n_frames"], 160 * n_frames_per_chunk)
+
+            with wave.open(path, "rb") as wf:
+                assert_equal(wf.getnchannels(), n_channels)
+                assert_equal(wf.getframerate(), sample_rate)
+                assert_equal(wf.getnframes(), stats["n_frames"])
+            with open(path, "rb") as f:
+                renders[name] = f.read()
+
+    # Windows rendered separately and written in place give the same file,
+    # header included, as rendering the whole timeline in order.
+    assert_equal(len(renders["parallel"]), len(renders["serial"]))
+    assert_true(renders["parallel"] == renders["serial"])
+
+
+def test_render_parallel_wav_limit():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "long.wav")
+        # A day of 4 channel audio is more than a WAV file can hold, which
+        # is found before anything is rendered or written.
+        with assert_raises(ValueError):
+            render_parallel(
+                functools.partial(build_source_bank, 4, 8000),
+                path, 4, 8000, duration=24 * 3600.)
+        assert_false(os.path.exists(path))
+
+
+def test_render_parallel_dev_null():
+    # Discarding the output through a device, as when measuring the render
+    # speed, rather than with None
+    stats = render_parallel(
+        functools.partial(build_source_bank, 4, 8000),
+        os.devnull, 4, 8000, duration=2., window_duration=0.5,
+        max_workers=2)
+    assert_equal(stats["n_windows"], 4)
+
+
+def test_file_audio_interface_device_index():
+    # The device index the other backends default to isn't a path, so the
+    # audio is discarded rather than written to file descriptor 0.
+    playback_buffer = SharedRingBuffer(2, 64, 2, dtype=np.int16)
+    try:
+        playback_buffer.write_chunk().fill(1)
+        playback_buffer.commit_write()
+        audio_interface = AudioInterface(
+            playback_buffer, None, 2, 8000, 2, 0, frame_count=64)
+        assert_true(audio_interface.path is None)
+        audio_interface.run(n_chunks=1)
+        audio_interface.close_stream()
+        assert_equal(audio_interface.n_frames_written, 64)
+    finally:
+        playback_buffer.close()
@@ -0,0 +1,115 @@
+import numpy as np
+from nose.tools import assert_equal, assert_true
+from numpy.testing import assert_array_equal
+
+from humanhive.hive import HiveLayout
+from humanhive.playback import Mixer, SoftLimiter, clip_and_cast
+from humanhive.sources import SourceBank, SwarmSource
+
+
+def test_mixer_render():
+    audio_data = (np.arange(4096) % 100).astype(np.int16)
+
+    source_bank = SourceBank()
+    source_bank.add_source(SwarmSource(audio_data, 4, 1024))
+    source_bank.add_source(SwarmSource(audio_data, 4, 1024))
+
+    mixer = Mixer(source_bank, 4, 256)
+    out = np.empty((256, 4), dtype=np.int16)
+
+    bus = mixer.render(out=out)
+    assert_equal(bus.shape, (256, 4))
+    assert_equal(bus.dtype, np.float32)
+    assert_array_equal(out, bus.astype(np.int16))
+
+    # The bus is reused rather than reallocated for each chunk
+    assert_true(mixer.render() is bus)
+
+
+def test_mixer_sparse_sources():
+    audio_data = (np.arange(4096) % 100).astype(np.int16)
+
+    def render(**kwargs):
+        np.random.seed(0)
+        source_bank = SourceBank()
+        source_bank.add_source(SwarmSource(audio_data, 32, 1024, **kwargs))
+        mixer = Mixer(source_bank, 32, 256)
+        return np.concatenate([mixer.render().copy() for i in range(8)])
+
+    for control_rate_divisor in [64, 1]:
+        dense = render(control_rate_divisor=control_rate_divisor)
+        sparse = render(
+            control_rate_divisor=control_rate_divisor, gain_threshold=1e-3)
+        # Only the channels near the swarm are mixed, and the hives left out
+        # are quieter than the threshold.
+        assert_true(np.any(sparse == 0))
+        assert_true(np.abs(dense - sparse).max() <= 1e-3 * 100)
+
+
+def test_mixer_sparse_sources_out_of_reach():
+    audio_data = (np.arange(4096) % 100).astype(np.int16)
+    # Hives far enough apart that, between them, the swarm is too quiet
+    # to be heard by any.
+    layout = HiveLayout(np.array([[0, 0], [4, 0], [4, 4], [0, 4]]))
+
+    for control_rate_divisor in [64, 1]:
+        source_bank = SourceBank()
+        source_bank.add_source(SwarmSource(
+            audio_data, 4, 1024, control_rate_divisor=control_rate_divisor,
+            layout=layout, gain_threshold=0.5, seed=0))
+        mixer = Mixer(source_bank, 4, 256)
+        mix = np.stack([mixer.render().copy() for i in range(200)])
+        assert_true(np.any(np.all(mix == 0, axis=(1, 2))))
+
+
+def test_swarm_source_seek():
+    audio_data = (np.arange(3000) % 100).astype(np.int16)
+
+    def make_source():
+        return SwarmSource(audio_data, 6, 1024, seed=5)
+
+    source = make_source()
+    expected = np.concatenate(
+        [source.get_frames(1024) for i in range(12)])
+
+    # A seeded source can render any window of its output on its own
+    for frame in [1024, 5120, 8192]:
+        window = make_source()
+        window.seek(frame)
+        assert_array_equal(
+            np.concatenate([window.get_frames(1024) for i in range(2)]),
+            expected[frame:frame + 2048])
+
+
+def test_clip_and_cast():
+    bus = np.array([[-40000., -32768.], [0., 1000.5], [32767., 50000.]],
+                   dtype=np.float32)
+
+    # Loud samples saturate rather than wrapping round
+    out = clip_and_cast(bus.copy(), np.empty((3, 2), dtype=np.int16))
+    assert_array_equal(out, [[-32768, -32768], [0, 1000], [32767, 32767]])
+
+    out = clip_and_cast(bus.copy(), np.empty((3, 2), dtype=np.int32))
+    assert_array_equal(out >> 16, [[-32768, -32768], [0, 1000], [32767, 32767]])
+
+    out = clip_and_cast(bus.copy(), np.empty((3, 2), dtype=np.float32))
+    assert_true(np.all(np.abs(out) <= 1))
+    assert_array_equal(out[0], [-1, -1])
+
+
+def test_soft_limiter():
+    limiter = SoftLimiter(threshold=0.5)
+    levels = np.linspace(-3, 3, 601).astype(np.float32)
+    bus = (levels * 32768)[:, np.newaxis].copy()
+
+    limited = limiter(bus)[:, 0] / 32768
+    assert_true(limited is not None)
+    # Unchanged below the threshold, and smooth and below the ceiling above
+    quiet = np.abs(levels) <= 0.5
+    np.testing.assert_allclose(limited[quiet], levels[quiet], atol=1e-6)
+    assert_true(np.all(np.abs(limited) < 1))
+    assert_true(np.all(np.diff(limited) > 0))
+
+    # Quiet buses are passed through untouched
+    bus = np.full((4, 2), 1000, dtype=np.float32)
+    assert_array_equal(limiter(bus), 1000)
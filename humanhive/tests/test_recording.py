@@ -1,22 +1,104 @@
 import os
-from humanhive import humanhive as hh, samplestream
+import queue
+import numpy as np
+from nose.tools import assert_equal, assert_true
+
+from humanhive import samplestream
+from humanhive.recording import Recording, StreamingSegmenter
+from humanhive.sources import SourceBank
 
 
 onesecond_file = os.path.join(
     os.path.dirname(__file__), "audio", "recorded_buzz.wav")
 
 
+def feed_chunks(recording, audio_data, n_frames_per_chunk=1024):
+    takes = []
+    for start in range(0, len(audio_data), n_frames_per_chunk):
+        take = recording.process_audio(
+            audio_data[start:start + n_frames_per_chunk])
+        if take is not None:
+            takes.append(take)
+    return takes
+
+
 def test_recording():
     audio_data = samplestream.load_wave_file(
         onesecond_file, mono=True)
 
-    print(audio_data.dtype)
-    recording = hh.Recording(None, 0)
+    take_queue = queue.Queue()
+    recording = Recording(take_queue, None, 48000)
+    takes = feed_chunks(recording, audio_data)
+
+    assert_equal(take_queue.qsize(), len(takes))
+    for take in takes:
+        assert_equal(take.dtype, np.int16)
+        assert_equal(take.ndim, 1)
+
+
+def test_streaming_segmenter():
+    sample_rate = 8000
+    rng = np.random.RandomState(0)
+
+    # 2s of quiet noise, a 1s tone, then 2s of quiet noise, in stereo.
+    noise = rng.normal(0, 50, size=(5 * sample_rate, 2))
+    t = np.arange(sample_rate) / sample_rate
+    tone = 5000 * np.sin(2 * np.pi * 440 * t)
+    audio_data = noise.copy()
+    audio_data[2 * sample_rate:3 * sample_rate] += tone[:, np.newaxis]
+    audio_data = audio_data.astype(np.int16)
+
+    segmenter = StreamingSegmenter(
+        sample_rate,
+        pre_roll_time=0.25,
+        release_time=0.25)
+
+    takes = []
+    for start in range(0, len(audio_data), 256):
+        take = segmenter.process(audio_data[start:start + 256])
+        if take is not None:
+            takes.append(take)
+
+    assert_equal(len(takes), 1)
+    take = takes[0]
+    # The take holds the pre-roll, the tone and the release, give or take
+    # the envelope window.
+    assert_true(1.4 * sample_rate < len(take) < 1.8 * sample_rate)
+
+    # The pre-roll is the quiet audio just before the take started.
+    n_pre_roll = int(0.25 * sample_rate)
+    assert_true(np.abs(take[:n_pre_roll]).max() < 500)
+    onset = np.nonzero(np.abs(take) > 2000)[0][0]
+    assert_true(n_pre_roll - 256 <= onset <= n_pre_roll + 256)
+
+    # The ambient estimate is not raised by the take.
+    assert_true(segmenter.ambient_volume < 100)
+
+
+def test_streaming_segmenter_short_take():
+    sample_rate = 8000
+    audio_data = np.zeros(3 * sample_rate, dtype=np.int16)
+    # A click, much shorter than the minimum take time.
+    audio_data[sample_rate:sample_rate + 100] = 10000
+
+    segmenter = StreamingSegmenter(sample_rate)
+    for start in range(0, len(audio_data), 256):
+        assert_true(segmenter.process(audio_data[start:start + 256]) is None)
+    assert_true(not segmenter.recording)
+
+
+def test_source_bank_poll_takes():
+    take_queue = queue.Queue()
+    source_bank = SourceBank(
+        take_queue=take_queue,
+        take_source_factory=lambda take: ("source", take[0]),
+        max_take_sources=2)
+    source_bank.add_source("swarm")
 
-    n_frames_per_chunk = 1024
+    assert_equal(source_bank.poll_takes(), 0)
+    for i in range(3):
+        take_queue.put(np.full(10, i, dtype=np.int16))
+    assert_equal(source_bank.poll_takes(), 3)
 
-    while len(audio_data) > 0:
-        n_frames_to_take = min((len(audio_data), n_frames_per_chunk))
-        recording.process_audio(
-            audio_data[:n_frames_to_take], n_frames_per_chunk)
-        audio_data = audio_data[n_frames_to_take:]
+    # The oldest take was removed, the other source was not.
+    assert_equal(source_bank.sources, ["swarm", ("source", 1), ("source", 2)])
@@ -0,0 +1,92 @@
+import pickle
+import numpy as np
+from nose.tools import assert_equal, assert_true
+from numpy.testing import assert_array_equal
+
+from humanhive.metrics import Histogram
+from humanhive.ringbuffer import FrameReader, SharedRingBuffer
+
+
+def test_ring_buffer_fifo():
+    ring = SharedRingBuffer(4, 16, 2)
+    try:
+        assert_equal(ring.fill_level(), 0)
+        assert_true(ring.read_chunk(block=False) is None)
+
+        for i in range(4):
+            slot = ring.write_chunk(block=False)
+            slot[:] = i
+            ring.commit_write()
+
+        assert_equal(ring.fill_level(), 4)
+        # Ring is full
+        assert_true(ring.write_chunk(block=False) is None)
+
+        for i in range(4):
+            chunk = ring.read_chunk(block=False)
+            assert_equal(chunk.shape, (16, 2))
+            assert_true(np.all(chunk == i))
+            ring.commit_read()
+
+        assert_equal(ring.fill_level(), 0)
+    finally:
+        ring.close()
+
+
+def test_ring_buffer_attach():
+    ring = SharedRingBuffer(4, 16, 2)
+    try:
+        # Unpickling attaches to the same shared memory, as happens when the
+        # ring is passed to a spawned process.
+        attached = pickle.loads(pickle.dumps(ring))
+
+        data = np.arange(32, dtype=np.int16).reshape(16, 2)
+        ring.put(data)
+
+        assert_equal(attached.fill_level(), 1)
+        assert_array_equal(attached.read_chunk(), data)
+        attached.commit_read()
+        assert_equal(ring.fill_level(), 0)
+        attached.close()
+    finally:
+        ring.close()
+
+
+def test_ring_buffer_timestamps():
+    ring = SharedRingBuffer(2, 16, 2)
+    try:
+        for timestamp in [1.5, 2.5, 3.5]:
+            ring.write_chunk(block=False)
+            ring.commit_write(timestamp=timestamp)
+            ring.read_chunk(block=False)
+            assert_equal(ring.read_timestamp(), timestamp)
+            ring.commit_read()
+    finally:
+        ring.close()
+
+
+def test_frame_reader():
+    ring = SharedRingBuffer(4, 16, 2)
+    try:
+        data = np.arange(3 * 16 * 2, dtype=np.int16).reshape(-1, 2)
+        for i in range(3):
+            ring.put(data[16 * i:16 * (i + 1)])
+
+        latency = Histogram()
+        reader = FrameReader(ring, latency)
+        out = np.zeros((6, 2), dtype=np.int16)
+        frames = []
+        # Periods of 6 frames span chunk boundaries.
+        for _ in range(8):
+            n_read = reader.read_frames(out)
+            frames.append(out[:n_read].copy())
+            if n_read < len(out):
+                break
+
+        assert_array_equal(np.concatenate(frames), data)
+        # Each chunk is released once it has been read.
+        assert_equal(ring.fill_level(), 0)
+        assert_equal(latency.count, 3)
+        assert_equal(reader.read_frames(out), 0)
+    finally:
+        ring.close()
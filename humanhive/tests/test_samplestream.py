@@ -1,11 +1,14 @@
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_true
 import os
+import pickle
+import wave
+import numpy as np
 
 from humanhive import samplestream
 from numpy.testing import assert_array_equal
 
-onesecond_file = os.path.join(
-    os.path.dirname(__file__), "audio", "onesecond.wav")
+audio_dir = os.path.join(os.path.dirname(__file__), "audio")
+onesecond_file = os.path.join(audio_dir, "onesecond.wav")
 
 def test_load_wave_file():
 
@@ -13,6 +16,42 @@ def test_load_wave_file():
 
     assert_equal(audio.shape, (44100, 2))
 
+    # Matches the samples read with the wave module
+    wavefile = wave.open(onesecond_file, 'rb')
+    expected = np.frombuffer(
+        wavefile.readframes(wavefile.getnframes()), dtype=np.int16)
+    wavefile.close()
+    assert_array_equal(audio.ravel(), expected)
+
+
+def test_load_wave_file_mapped():
+
+    audio = samplestream.load_wave_file(onesecond_file)
+    mono = samplestream.load_wave_file(onesecond_file, mono=True)
+
+    # Samples are mapped from the file and mono is a view, not a copy
+    assert_true(isinstance(audio, np.memmap))
+    assert_true(isinstance(mono, np.memmap))
+    assert_equal(mono.shape, (44100,))
+    assert_true(mono.base is not None)
+    assert_array_equal(mono, audio[:,0])
+
+    # Pickling maps the file again rather than copying the samples
+    unpickled = pickle.loads(pickle.dumps(mono))
+    assert_true(isinstance(unpickled, np.memmap))
+    assert_array_equal(unpickled, mono)
+
+
+def test_load_samples_from_dir():
+
+    samples = samplestream.load_samples_from_dir(audio_dir)
+
+    assert_equal(len(samples), 2)
+    # Nothing is loaded until it is used
+    assert_true(all(sample is None for sample in samples._samples))
+    assert_equal(samples[1].ndim, 1)
+    assert_true(samples._samples[0] is None)
+
 
 def test_sample_stream_mono():
 
@@ -35,3 +74,40 @@ def test_sample_stream_mono():
     last_batch = sample_stream.retrieve_samples(100)
 
     assert_array_equal(first_batch, last_batch)
+
+
+def test_read_looped():
+
+    buffer = np.arange(10, dtype=np.int16)
+
+    # Inside the buffer a view is returned
+    samples = samplestream.read_looped(buffer, 2, 5)
+    assert_array_equal(samples, [2, 3, 4, 5, 6])
+    assert_true(np.shares_memory(samples, buffer))
+
+    # Across the loop point
+    assert_array_equal(
+        samplestream.read_looped(buffer, 8, 5), [8, 9, 0, 1, 2])
+
+    # Longer than the buffer
+    assert_array_equal(
+        samplestream.read_looped(buffer, 8, 14), np.take(
+            buffer, range(8, 22), mode='wrap'))
+
+    # Into a float buffer
+    out = np.empty(5, dtype=np.float32)
+    assert_true(samplestream.read_looped(buffer, 8, 5, out=out) is out)
+    assert_array_equal(out, [8, 9, 0, 1, 2])
+
+
+def test_sample_stream_out():
+
+    audio = np.arange(1000, dtype=np.int16)
+    sample_stream = samplestream.SampleStream(audio)
+    out = np.empty(300, dtype=np.float32)
+
+    for start in range(0, 3000, 300):
+        samples = sample_stream.retrieve_samples(300, out=out)
+        assert_true(samples is out)
+        assert_array_equal(
+            samples, np.take(audio, range(start, start + 300), mode='wrap'))
@@ -0,0 +1,151 @@
+import queue
+import numpy as np
+from nose.tools import assert_equal, assert_true
+from numpy.testing import assert_allclose, assert_array_equal
+
+from humanhive import scheduler
+from humanhive.playback import Mixer
+from humanhive.sources import SourceBank
+
+
+class ConstantSource:
+    """
+    A source that plays a constant value on every channel, and counts the
+    frames it has rendered.
+    """
+    def __init__(self, value, n_channels=2):
+        self.value = value
+        self.n_channels = n_channels
+        self.n_frames_rendered = 0
+
+    def get_frames(self, n_frames, out=None):
+        if out is None:
+            out = np.empty((n_frames, self.n_channels), dtype=np.float32)
+        out.fill(self.value)
+        self.n_frames_rendered += n_frames
+        return out
+
+
+def render(mixer, sched, n_chunks):
+    chunks = []
+    for i in range(n_chunks):
+        sched.dispatch(i * mixer.n_frames, mixer.n_frames)
+        chunks.append(mixer.render()[:,0].copy())
+    return np.concatenate(chunks)
+
+
+def test_add_at_frame():
+    source_bank = SourceBank()
+    mixer = Mixer(source_bank, 2, 64)
+    sched = scheduler.Scheduler(source_bank)
+
+    sched.post(scheduler.add_command(
+        "a", ConstantSource(100), frame=100, ramp_frames=0))
+    mix = render(mixer, sched, 4)
+
+    # Silent up to the exact frame, then playing
+    assert_array_equal(mix[:100], 0)
+    assert_array_equal(mix[100:], 100)
+
+
+def test_fade_in_and_out():
+    source_bank = SourceBank()
+    mixer = Mixer(source_bank, 2, 64)
+    command_queue = queue.Queue()
+    sched = scheduler.Scheduler(source_bank, command_queue=command_queue)
+
+    source = ConstantSource(100)
+    command_queue.put(scheduler.add_command(
+        "a", source, frame=10, ramp_frames=100))
+    command_queue.put(scheduler.remove_command(
+        "a", frame=200, ramp_frames=50))
+    mix = render(mixer, sched, 5)
+
+    assert_array_equal(mix[:10], 0)
+    # Ramps linearly across the chunk boundary
+    assert_allclose(mix[10:111], np.linspace(0, 100, 101), atol=1e-3)
+    assert_array_equal(mix[110:200], 100)
+    assert_allclose(mix[200:251], np.linspace(100, 0, 51), atol=1e-3)
+    assert_array_equal(mix[250:], 0)
+
+    # Removed from the bank once the fade has finished
+    assert_equal(len(source_bank.sources), 0)
+    assert_true(source.n_frames_rendered < 5 * 64)
+
+
+def test_set_volume():
+    source_bank = SourceBank()
+    mixer = Mixer(source_bank, 2, 64)
+    sched = scheduler.Scheduler(source_bank)
+
+    sched.post(scheduler.add_command(
+        "a", ConstantSource(100), ramp_frames=0))
+    sched.post(scheduler.set_volume_command(
+        "a", 0.5, frame=70, ramp_frames=20))
+    sched.post(scheduler.set_volume_command(
+        "a", 0., frame=150, ramp_frames=0))
+    mix = render(mixer, sched, 3)
+
+    assert_array_equal(mix[:70], 100)
+    assert_allclose(mix[70:91], np.linspace(100, 50, 21), atol=1e-3)
+    assert_allclose(mix[90:150], 50)
+    assert_array_equal(mix[150:], 0)
+
+
+def test_retarget():
+    retargets = []
+
+    class RetargetSource(ConstantSource):
+        def retarget(self, hive, delay=0):
+            retargets.append((hive, delay))
+
+    source_bank = SourceBank()
+    mixer = Mixer(source_bank, 2, 64)
+    sched = scheduler.Scheduler(source_bank)
+    sched.post(scheduler.add_command("a", RetargetSource(1), ramp_frames=0))
+    sched.post(scheduler.retarget_command("a", 3, frame=130))
+    render(mixer, sched, 3)
+
+    assert_equal(retargets, [(3, 2)])
+
+
+def test_replace_source():
+    source_bank = SourceBank()
+    mixer = Mixer(source_bank, 2, 64)
+    sched = scheduler.Scheduler(source_bank)
+
+    old = ConstantSource(100)
+    sched.post(scheduler.add_command("a", old, ramp_frames=0))
+    sched.post(scheduler.add_command(
+        "a", ConstantSource(1), frame=100, ramp_frames=50))
+    mix = render(mixer, sched, 4)
+
+    # The old source plays up to the frame of the add, then crossfades into
+    # the new one.
+    assert_array_equal(mix[:100], 100)
+    ramp = np.linspace(0, 1, 51)
+    assert_allclose(mix[100:151], 100 * (1 - ramp) + ramp, atol=1e-3)
+    assert_array_equal(mix[150:], 1)
+    assert_equal(len(source_bank.sources), 1)
+    assert_true(sched.sources["a"].source is not old)
+
+
+def test_add_during_fade_out():
+    source_bank = SourceBank()
+    mixer = Mixer(source_bank, 2, 64)
+    sched = scheduler.Scheduler(source_bank)
+
+    sched.post(scheduler.add_command("a", ConstantSource(100), ramp_frames=0))
+    sched.post(scheduler.remove_command("a", frame=10, ramp_frames=256))
+    # The id is reused before the old source has finished fading out
+    new = ConstantSource(1)
+    sched.post(scheduler.add_command("a", new, frame=100, ramp_frames=0))
+    mix = render(mixer, sched, 8)
+
+    # The old source's fade out is cut short by the add, but its removal
+    # once the fade would have finished leaves the new one playing.
+    fade = 100 * (1 - np.arange(90) / 256)
+    assert_allclose(mix[10:100], fade, atol=1e-3)
+    assert_array_equal(mix[100:], 1)
+    assert_true(sched.sources["a"].source is new)
+    assert_equal(len(source_bank.sources), 1)
@@ -23,6 +23,15 @@ def test_swarm():
 
     assert_equal(test_positions.shape, (100, 2))
 
+    # A long window covers several lingers and moves. The swarm stays on
+    # the circle and moves by at most one increment per sample.
+    long_swarm = swarm.Swarm(hive_radius, hives, swarm_speed, 1000)
+    test_positions = long_swarm.sample_swarm_positions(1000 * 300)
+    assert_array_almost_equal(
+        np.linalg.norm(test_positions, axis=1), hive_radius)
+    steps = np.linalg.norm(np.diff(test_positions, axis=0), axis=1)
+    assert_true(np.all(steps <= swarm_speed / 1000 + 1e-9))
+
 #    print test_swarm.swarm_position
 
 #    print "The swarm position is now at %f" % test_swarm.swarm_position
@@ -75,6 +84,9 @@ def test_swarm_linear_6_channel():
         [5, 5]
     ]
 
+    # Seed so that the swarm carries on to the next hive rather than
+    # randomly changing direction or jumping.
+    np.random.seed(0)
     test_swarm = swarm.SwarmLinear(hives, 1.4, 1024)
 
     positions = test_swarm.sample_swarm_positions(1024)
@@ -97,6 +109,44 @@ def test_swarm_linear_6_channel():
     print(positions)
 
 
+def test_swarm_linear_long_window():
+
+    hives = [
+        [0, 0],
+        [0, 1],
+        [1, 1],
+    ]
+
+    # 1 unit/s with a 1 second linger, so each leg takes at most 2.5 seconds.
+    # A 10 second window covers several legs in one call.
+    test_swarm = swarm.SwarmLinear(
+        hives, 1., 1000, p_change_direction=0, p_jump_hives=0,
+        linger_time=1)
+
+    positions = test_swarm.sample_swarm_positions(10000)
+    assert_equal(positions.shape, (10000, 2))
+
+    # The vertical leg from hive 0 to hive 1 arrives after 1 second
+    assert_array_almost_equal(positions[0], [0, 0])
+    assert_array_almost_equal(positions[500], [0, 0.5])
+    assert_array_almost_equal(positions[1500], [0, 1])
+    # Then a horizontal leg to hive 2
+    assert_array_almost_equal(positions[2500], [0.5, 1])
+    assert_array_almost_equal(positions[3500], [1, 1])
+
+    # Speed never exceeds 1 unit/s
+    steps = np.linalg.norm(np.diff(positions, axis=0), axis=1)
+    assert_true(np.all(steps <= 1e-3 + 1e-6))
+
+    # Sampling in chunks gives the same path
+    chunked_swarm = swarm.SwarmLinear(
+        hives, 1., 1000, p_change_direction=0, p_jump_hives=0,
+        linger_time=1)
+    chunked = np.vstack(
+        [chunked_swarm.sample_swarm_positions(1000) for _ in range(10)])
+    assert_array_almost_equal(chunked, positions)
+
+
 def test_hive_volumes():
 
     positions = np.random.rand(100, 2)
@@ -105,3 +155,182 @@ def test_hive_volumes():
     volumes = swarm.hive_volumes(hives, positions, sigma=0.1)
     assert_equal(volumes.shape, (100, 6))
     assert_true(np.all(volumes >= 0) and np.all(volumes <= 1))
+
+
+def test_gain_kernel():
+
+    positions = np.random.rand(100, 2)
+    hives = np.random.rand(6, 2)
+    sigma = 0.5
+
+    distances = np.linalg.norm(
+        positions[:,np.newaxis,:] - hives[np.newaxis,:,:], axis=2)
+    expected = np.exp(-distances**2 / sigma**2)
+
+    kernel = swarm.GainKernel(hives, sigma=sigma)
+    out = np.empty((100, 6), dtype=np.float32)
+    volumes = kernel(positions, out=out)
+    assert_true(volumes is out)
+    assert_array_almost_equal(volumes, expected, decimal=5)
+
+    expanded_kernel = swarm.GainKernel(hives, sigma=sigma, expand=True)
+    assert_array_almost_equal(
+        expanded_kernel(positions), expected, decimal=5)
+
+
+def test_control_rate_swarm():
+
+    hives = [
+        [0, 0],
+        [1, 1],
+        [2, 0],
+    ]
+    sample_rate = 1024
+    control_rate_divisor = 16
+
+    full_rate_swarm = swarm.SwarmLinear(
+        hives, 1.4, sample_rate, p_change_direction=0, p_jump_hives=0)
+    control_rate_swarm = swarm.ControlRateSwarm(
+        swarm.SwarmLinear(
+            hives, 1.4, sample_rate / control_rate_divisor,
+            p_change_direction=0, p_jump_hives=0),
+        control_rate_divisor)
+
+    # Cover several moves and lingers, in chunks that are and are not
+    # aligned with the control ticks, ending on a tick.
+    for n_samples in [1024, 1000, 24, 4096, 333, 2048] * 3 + [1, 32]:
+        full_rate = full_rate_swarm.sample_swarm_volumes(n_samples)
+        control_rate = control_rate_swarm.sample_swarm_volumes(n_samples)
+
+        assert_equal(control_rate.shape, (n_samples, 3))
+        # The swarm moves 0.02 units between ticks, so the interpolated
+        # volumes stay close to the full rate volumes
+        assert_true(np.abs(full_rate - control_rate).max() < 0.01)
+
+    # The volumes can be written into a strided view, e.g. some of the
+    # channels of a bus.
+    state = control_rate_swarm.get_state()
+    expected = control_rate_swarm.sample_swarm_volumes(1024)
+    control_rate_swarm.set_state(state)
+    bus = np.zeros((1024, 5), dtype=np.float32)
+    control_rate_swarm.sample_swarm_volumes(1024, out=bus[:, 1:4])
+    assert_array_almost_equal(bus[:, 1:4], expected)
+    assert_true(np.all(bus[:, [0, 4]] == 0))
+
+
+def test_sparse_gain_kernel():
+
+    hives = hive.generate_hive_circle(64, 3)
+    kernel = swarm.GainKernel(hives)
+    sparse_kernel = swarm.SparseGainKernel(hives, threshold=1e-3)
+
+    # A short segment of a path, as in one batch of control ticks
+    positions = np.linspace([3, 0], [2.8, 0.5], 16)
+    active, volumes = sparse_kernel.sparse(positions)
+    assert_true(0 < len(active) < 64)
+    assert_array_almost_equal(volumes, kernel(positions)[:, active], decimal=5)
+
+    # Every hive left out is below the threshold
+    assert_true(np.abs(sparse_kernel(positions) - kernel(positions)).max()
+                < 1e-3)
+
+    # At most k hives are evaluated, the nearest ones
+    capped = swarm.SparseGainKernel(hives, threshold=1e-3, k=4)
+    active = capped.active_hives(positions)
+    assert_equal(len(active), 4)
+    assert_true(np.all(kernel(positions)[:, active].max(axis=0) > 0.5))
+
+
+def test_control_rate_swarm_channels():
+
+    hives = hive.generate_hive_circle(32, 3)
+    sample_rate = 1024
+    control_rate_divisor = 16
+
+    def make_swarm():
+        return swarm.ControlRateSwarm(
+            swarm.SwarmLinear(
+                hives, 1., sample_rate / control_rate_divisor,
+                p_change_direction=0, p_jump_hives=0,
+                gain_kernel=swarm.SparseGainKernel(hives)),
+            control_rate_divisor)
+    dense_swarm = make_swarm()
+    sparse_swarm = make_swarm()
+
+    for n_samples in [1024, 1000, 24, 4096, 333, 2048] * 3:
+        dense = dense_swarm.sample_swarm_volumes(n_samples)
+        channels = sparse_swarm.active_channels(n_samples)
+        sparse = sparse_swarm.sample_swarm_volumes(
+            n_samples, channels=channels)
+
+        assert_true(len(channels) < 32)
+        assert_array_almost_equal(sparse, dense[:, channels])
+        # The channels left out are silent throughout the chunk
+        dense[:, channels] = 0
+        assert_true(np.all(dense == 0))
+
+
+def test_swarm_linear_seed():
+    hives = hive.generate_hive_circle(8, 3)
+    sample_rate = 100
+
+    def make_swarm(seed):
+        # Short lingers, so that many legs are planned
+        return swarm.SwarmLinear(
+            hives, 1., sample_rate, p_change_direction=0.5,
+            p_jump_hives=0.3, linger_time=0.5, seed=seed)
+
+    # The same seed gives the same trajectory however it is sampled
+    expected = make_swarm(1).sample_swarm_positions(20000)
+    seeded = make_swarm(1)
+    positions = np.concatenate(
+        [seeded.sample_swarm_positions(n) for n in [1, 999, 5000, 14000]])
+    assert_array_almost_equal(positions, expected)
+    assert_true(
+        np.abs(make_swarm(2).sample_swarm_positions(20000) - expected).max()
+        > 1)
+
+    # Any window can be computed on its own
+    window = make_swarm(1)
+    window.seek(12345)
+    assert_array_almost_equal(
+        window.sample_swarm_positions(5000), expected[12345:17345])
+
+    # A checkpoint resumes the trajectory, including retargets
+    checkpointed = make_swarm(1)
+    checkpointed.sample_swarm_positions(3000)
+    checkpointed.retarget(4, delay=10)
+    state = checkpointed.get_state()
+    resumed = checkpointed.sample_swarm_positions(8000)
+    restored = make_swarm(7)
+    restored.set_state(state)
+    assert_array_almost_equal(restored.sample_swarm_positions(8000), resumed)
+
+
+def test_control_rate_swarm_seek():
+    hives = hive.generate_hive_circle(8, 3)
+    sample_rate = 1024
+    control_rate_divisor = 16
+
+    def make_swarm():
+        return swarm.ControlRateSwarm(
+            swarm.SwarmLinear(
+                hives, 1., sample_rate / control_rate_divisor,
+                linger_time=1, seed=3),
+            control_rate_divisor)
+
+    expected = make_swarm().sample_swarm_volumes(60000)
+    for frame in [0, 16, 1000, 40000]:
+        window = make_swarm()
+        window.seek(frame)
+        assert_array_almost_equal(
+            window.sample_swarm_volumes(20000),
+            expected[frame:frame + 20000])
+
+    checkpointed = make_swarm()
+    checkpointed.sample_swarm_volumes(5000)
+    state = checkpointed.get_state()
+    resumed = checkpointed.sample_swarm_volumes(5000)
+    restored = make_swarm()
+    restored.set_state(state)
+    assert_array_almost_equal(restored.sample_swarm_volumes(5000), resumed)
@@ -9,13 +9,24 @@ def test_compute_audio_volume_per_frame():
     N = 1024
     sin_data = np.sin(np.linspace(0, 20*np.pi, N))
     volumes = utils.compute_audio_volume_per_frame(sin_data)
-    print(volumes)
-    print("Warning, test assertion disabled")
-    # assert_equal(volumes.shape, (N,))
-    assert_true(np.allclose(volumes, 19.59, atol=0.01))
-
+    assert_equal(volumes.shape, (1 + N // 512,))
+    assert_true(np.allclose(volumes, 1 / np.sqrt(2), atol=0.01))
 
+    # Compare against directly computing the RMS of each centred frame.
+    audio = np.random.RandomState(0).normal(size=5000)
+    volumes = utils.compute_audio_volume_per_frame(
+        audio, frame_length=256, hop_length=64)
+    padded = np.pad(audio, 128, mode="reflect")
+    expected = [
+        np.sqrt(np.mean(padded[i:i + 256] ** 2))
+        for i in range(0, 64 * len(volumes), 64)]
+    assert_true(np.allclose(volumes, expected))
 
 
 def test_compute_audio_threshold_crossings():
-    pass
+    volumes = np.array([0, 1, 3, 4, 2, 0, 5, 1])
+    crossings_up, crossings_down = utils.compute_audio_threshold_crossings(
+        volumes, 2)
+
+    assert_true(np.array_equal(crossings_up, [1, 5]))
+    assert_true(np.array_equal(crossings_down, [4, 6]))
@@ -0,0 +1,66 @@
+import numpy as np
+from nose.tools import assert_equal, assert_raises
+from numpy.testing import assert_allclose
+
+from humanhive import hive
+from humanhive.sources import SwarmSource
+from humanhive.voicepool import SwarmVoicePool
+
+
+def test_voice_pool_matches_swarm_sources():
+
+    n_channels = 6
+    sample_rate = 48000
+    hives = hive.generate_hive_circle(n_channels, 3)
+
+    rng = np.random.RandomState(0)
+    voices_audio = [
+        rng.randint(-1000, 1000, size=size).astype(np.int16)
+        for size in (1500, 3000, 10000)]
+
+    pool = SwarmVoicePool(hives, sample_rate)
+    sources = []
+    for audio_data in voices_audio:
+        pool.add_voice(audio_data, volume=0.5, start_hive=0)
+        sources.append(
+            SwarmSource(audio_data, n_channels, sample_rate, volume=0.5))
+
+    assert_equal(pool.n_voices, 3)
+
+    for _ in range(5):
+        frames = pool.get_frames(1024)
+        expected = sum(source.get_frames(1024) for source in sources)
+
+        assert_equal(frames.shape, (1024, n_channels))
+        assert_allclose(frames, expected, rtol=1e-4, atol=1e-2)
+
+    # The mix can be written into a strided view, e.g. some of the channels
+    # of a bus.
+    bus = np.zeros((1024, n_channels + 2), dtype=np.float32)
+    pool.get_frames(1024, out=bus[:, 1:-1])
+    expected = sum(source.get_frames(1024) for source in sources)
+    assert_allclose(bus[:, 1:-1], expected, rtol=1e-4, atol=1e-2)
+    assert_equal(np.abs(bus[:, [0, -1]]).max(), 0)
+
+
+def test_voice_pool_legs():
+
+    hives = [[0, 0], [1, 0]]
+    # Each leg is a 1 second move followed by a 1 second linger
+    pool = SwarmVoicePool(
+        hives, 1024, max_voices=4, swarm_speed=1, p_change_direction=0,
+        p_jump_hives=0, linger_time=1, control_rate_divisor=16)
+    voice = pool.add_voice(np.ones(100, dtype=np.int16), start_hive=0)
+
+    # Several legs in one call
+    tick_frames = np.arange(0, 6 * 1024, 512, dtype=np.float64)
+    positions = pool.sample_swarm_positions(np.array([voice]), tick_frames)
+
+    assert_allclose(
+        positions[0,:,0],
+        [0, 0.5, 1, 1, 1, 0.5, 0, 0, 0, 0.5, 1, 1])
+
+    pool.remove_voice(voice)
+    assert_equal(pool.n_voices, 0)
+    assert_equal(pool.get_frames(64).max(), 0)
+    assert_raises(ValueError, pool.get_frames, 100)
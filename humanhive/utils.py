@@ -1,19 +1,39 @@
 import numpy as np
 
-### Work around for librosa importing matplotlib
-import mock
-import sys
-sys.modules.update((mod_name, mock.Mock()) for mod_name in ['matplotlib', 'matplotlib.pyplot', 'matplotlib.image'])
 
-import librosa.feature
-import librosa.core
+def compute_audio_volume_per_frame(in_data, frame_length=2048, hop_length=512):
+    """
+    Computes the RMS volume of overlapping frames of audio.
+
+    Frames are centred on multiples of hop_length, with the audio reflected
+    at either end, as librosa's rms feature does.
 
-import pyaudio
+    Parameters
+    ----------
+    in_data: array_like, (N,)
+        Mono audio.
+    frame_length: int
+        The number of samples in each frame.
+    hop_length: int
+        The number of samples between the centres of consecutive frames.
 
+    Returns
+    -------
+    volumes: array_like, (1 + N // hop_length,)
+        The RMS volume of each frame.
+    """
+    in_data = np.asarray(in_data, dtype=np.float64)
+    padded = np.pad(in_data, frame_length // 2, mode="reflect")
 
-def compute_audio_volume_per_frame(in_data):
-    rmse = librosa.feature.rmse(in_data)
-    return rmse
+    # Running sum of squares, so each frame's energy is one subtraction.
+    cumulative = np.zeros(padded.size + 1)
+    np.cumsum(padded ** 2, out=cumulative[1:])
+
+    n_frames = 1 + in_data.size // hop_length
+    starts = np.arange(n_frames) * hop_length
+    energies = cumulative[starts + frame_length] - cumulative[starts]
+    # Rounding in the running sum can leave tiny negative energies.
+    return np.sqrt(np.maximum(energies, 0) / frame_length)
 
 def compute_audio_volume(in_data):
     return np.mean(compute_audio_volume_per_frame(in_data))
@@ -26,9 +46,9 @@ def compute_audio_threshold_crossings(frame_volumes, threshold):
     thresh_centre = frame_volumes - threshold
 
     crossings_up = np.nonzero(
-        (thresh_centre[:-1] < 0) and (thresh_centre[1:] >= 0))[0]
+        (thresh_centre[:-1] < 0) & (thresh_centre[1:] >= 0))[0]
     crossings_down = np.nonzero(
-        (thresh_centre[:-1] >= 0) and (thresh_centre[1:] < 0))[0]
+        (thresh_centre[:-1] >= 0) & (thresh_centre[1:] < 0))[0]
 
     return crossings_up, crossings_down
 
@@ -37,6 +57,9 @@ def get_sample_rate_for_device(device_id=0):
     """
     Get's the default sample rate for the audio device.
     """
+    # Imported here so that importing humanhive does not load PortAudio.
+    import pyaudio
+
     p = pyaudio.PyAudio()
 
     device_params = p.get_device_info_by_index(device_id)
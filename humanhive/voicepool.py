@@ -0,0 +1,361 @@
+"""
+voicepool module
+
+Plays hundreds of recorded voices at once, each moving around the hives with
+its own swarm. Rather than a SwarmSource per voice, the playback cursors,
+volumes and swarm states of all voices are stored as arrays, and each chunk
+is rendered for every voice in one vectorized pass.
+"""
+import numpy as np
+from . import swarm
+
+
+class SwarmVoicePool:
+    """
+    A source that plays many voices, each with its own linear swarm moving
+    between the hives as in swarm.SwarmLinear.
+
+    Swarm positions and hive volumes of all voices are evaluated together at
+    control rate, once every control_rate_divisor frames. The voices are then
+    mixed into the channels with a single batched matrix product per chunk,
+    and the volumes interpolated between control ticks.
+
+    Add the pool to a SourceBank like any other source.
+    """
+
+    def __init__(self,
+                 hives,
+                 sample_rate,
+                 max_voices=256,
+                 swarm_speed=0.1,
+                 p_change_direction=0.2,
+                 p_jump_hives=0.1,
+                 linger_time=3,
+                 sigma=1,
+                 control_rate_divisor=64,
+                 gain_kernel=None,
+                 seed=None):
+        """
+        Parameters
+        ----------
+        hives: array_like, (H, 2)
+            The positions of the hives. Each hive is one output channel.
+        sample_rate: int
+            The sample rate.
+        max_voices: int
+            The number of voices that can play at once.
+        swarm_speed: float
+            The speed of each swarm in units/second.
+        p_change_direction: float
+            Probability of a swarm reversing direction on reaching a hive.
+        p_jump_hives: float
+            Probability of a swarm heading to a random hive on reaching a
+            hive.
+        linger_time: float
+            Time in seconds that a swarm lingers at each hive.
+        sigma: float
+            Width of the gain kernel used to compute hive volumes.
+        control_rate_divisor: int
+            The number of frames per control tick. Chunk sizes must be a
+            multiple of this.
+        gain_kernel: callable or None
+            Computes hive volumes from swarm positions, e.g. a
+            hive.GainTable for the hives. Defaults to a GainKernel with
+            width sigma.
+        seed: int or None
+            Seeds the random choices of every voice's swarm. If None, a seed
+            is drawn from numpy's global random state.
+        """
+        self.hives = np.asarray(hives, dtype=np.float64)
+        self.n_hives = len(self.hives)
+        self.n_channels = self.n_hives
+        self.sample_rate = sample_rate
+        self.max_voices = max_voices
+
+        self.swarm_speed_upf = swarm_speed / sample_rate
+        self.p_change_direction = p_change_direction
+        self.p_jump_hives = p_jump_hives
+        self.n_linger_frames = linger_time * sample_rate
+        self.control_rate_divisor = control_rate_divisor
+
+        if gain_kernel is None:
+            gain_kernel = swarm.GainKernel(self.hives, sigma=sigma)
+        self.gain_kernel = gain_kernel
+
+        self.seed = swarm.default_seed(seed)
+        self.rng = np.random.Generator(
+            np.random.Philox(key=swarm.swarm_key(self.seed)))
+
+        # The frame index of the next sample to be generated.
+        self.frame = 0
+
+        ###
+        # Voice state, one entry per voice slot
+        ###
+        self.active = np.zeros(max_voices, dtype=bool)
+        self.volumes = np.zeros(max_voices, dtype=np.float32)
+
+        # Audio of all voices is stored in one buffer so that a chunk for
+        # every voice can be gathered at once. Each voice loops over
+        # audio[offsets[v]:offsets[v] + lengths[v]].
+        self.audio = np.zeros(0, dtype=np.int16)
+        self.audio_size = 0
+        self.offsets = np.zeros(max_voices, dtype=np.int64)
+        self.lengths = np.ones(max_voices, dtype=np.int64)
+        self.cursors = np.zeros(max_voices, dtype=np.int64)
+
+        # Swarm state. Each voice's swarm moves from origin to destination,
+        # starting at move_start_frame and arriving at arrive_frame, then
+        # lingers until leave_frame.
+        self.origins = np.zeros((max_voices, 2))
+        self.destinations = np.zeros((max_voices, 2))
+        self.destination_hives = np.zeros(max_voices, dtype=np.int64)
+        self.directions = np.ones(max_voices, dtype=np.int64)
+        self.move_start_frames = np.zeros(max_voices)
+        self.arrive_frames = np.zeros(max_voices)
+        self.leave_frames = np.zeros(max_voices)
+
+        # Interpolation weights for the volumes at the start and end of a
+        # control tick, for each frame within the tick
+        ramp = (
+            np.arange(control_rate_divisor, dtype=np.float32) /
+            control_rate_divisor)
+        self.weights = np.stack((1 - ramp, ramp), axis=1)
+
+    @property
+    def n_voices(self):
+        return int(np.count_nonzero(self.active))
+
+    def add_voice(self, audio_data, volume=1.0, start_hive=None):
+        """
+        Starts playing a voice.
+
+        Parameters
+        ----------
+        audio_data: array_like, (N,)
+            Mono audio of the voice, looped while it plays.
+        volume: float
+            The volume of the voice.
+        start_hive: int or None
+            The hive the voice's swarm starts at. Chosen at random if None.
+
+        Returns
+        -------
+        voice_id: int
+            Identifies the voice for remove_voice().
+        """
+        if audio_data.ndim != 1:
+            raise ValueError("Only mono audio supported")
+        free = np.flatnonzero(~self.active)
+        if len(free) == 0:
+            raise ValueError(
+                "Voice pool is full, max_voices is {}".format(self.max_voices))
+        voice = free[0]
+
+        self.offsets[voice] = self._store_audio(audio_data)
+        self.lengths[voice] = len(audio_data)
+        self.cursors[voice] = 0
+        self.volumes[voice] = volume
+
+        if start_hive is None:
+            start_hive = int(self.rng.integers(self.n_hives))
+        self.origins[voice] = self.hives[start_hive]
+        self.destination_hives[voice] = (start_hive + 1) % self.n_hives
+        self.directions[voice] = 1
+        self._start_moves(np.array([voice]), self.frame)
+
+        self.active[voice] = True
+        return int(voice)
+
+    def remove_voice(self, voice_id):
+        """
+        Stops playing a voice.
+        """
+        self.active[voice_id] = False
+
+    def _store_audio(self, audio_data):
+        """
+        Appends a voice's audio to the shared buffer. When the buffer is
+        full it is reallocated with room to grow, dropping the audio of
+        removed voices. Returns the offset.
+        """
+        n_samples = len(audio_data)
+        if self.audio_size + n_samples > len(self.audio):
+            live = self.active.copy()
+            live_size = int(self.lengths[live].sum())
+            capacity = max(2 * (live_size + n_samples), 1024)
+            audio = np.empty(capacity, dtype=np.int16)
+
+            # Copy the audio of the playing voices into the new buffer
+            offset = 0
+            for voice in np.flatnonzero(live):
+                start = self.offsets[voice]
+                length = self.lengths[voice]
+                audio[offset:offset + length] = self.audio[start:start + length]
+                self.offsets[voice] = offset
+                offset += length
+            self.audio = audio
+            self.audio_size = offset
+
+        offset = self.audio_size
+        self.audio[offset:offset + n_samples] = audio_data
+        self.audio_size += n_samples
+        return offset
+
+    def _start_moves(self, voices, start_frames):
+        """
+        Sets the swarms of the given voices moving from their origin to their
+        destination hive, starting at start_frames.
+        """
+        destinations = self.hives[self.destination_hives[voices]]
+        distances = np.linalg.norm(destinations - self.origins[voices], axis=1)
+
+        self.destinations[voices] = destinations
+        self.move_start_frames[voices] = start_frames
+        self.arrive_frames[voices] = (
+            start_frames + distances / self.swarm_speed_upf)
+        # Always advance by at least one frame so that planning terminates
+        self.leave_frames[voices] = np.maximum(
+            self.arrive_frames[voices] + self.n_linger_frames,
+            self.move_start_frames[voices] + 1)
+
+    def _next_legs(self, voices):
+        """
+        Starts the next leg for swarms that have finished lingering: chooses
+        each one's next destination hive and sets it moving.
+        """
+        n = len(voices)
+
+        # Change direction?
+        change = self.rng.random(n) < self.p_change_direction
+        self.directions[voices[change]] *= -1
+        self.destination_hives[voices] = (
+            self.destination_hives[voices] + self.directions[voices]
+        ) % self.n_hives
+
+        # Jump hives?
+        jump = voices[self.rng.random(n) < self.p_jump_hives]
+        self.destination_hives[jump] = self.rng.integers(
+            self.n_hives, size=len(jump))
+
+        self.origins[voices] = self.destinations[voices]
+        self._start_moves(voices, self.leave_frames[voices])
+
+    def _leg_positions(self, voices, tick_frames):
+        """
+        Returns the positions, (V, T, 2), of the swarms of the given voices
+        on their current leg at each tick frame.
+        """
+        start = self.move_start_frames[voices][:,np.newaxis]
+        duration = (self.arrive_frames[voices] - self.move_start_frames[voices])
+        # A leg with no movement is at its destination throughout
+        duration = np.where(duration > 0, duration, np.inf)[:,np.newaxis]
+        fraction = np.clip((tick_frames[np.newaxis,:] - start) / duration, 0, 1)
+        fraction[np.isinf(duration[:,0])] = 1
+
+        origins = self.origins[voices][:,np.newaxis,:]
+        deltas = (self.destinations[voices] - self.origins[voices])
+        return origins + deltas[:,np.newaxis,:] * fraction[:,:,np.newaxis]
+
+    def sample_swarm_positions(self, voices, tick_frames):
+        """
+        Returns the swarm positions, (V, T, 2), of the given voices at each
+        tick frame, advancing the swarms through as many legs as needed.
+        """
+        positions = self._leg_positions(voices, tick_frames)
+
+        # Swarms that finish lingering within the ticks start their next leg.
+        # Legs are several seconds long, so this loop rarely runs more than
+        # once per chunk.
+        advancing = voices[self.leave_frames[voices] <= tick_frames[-1]]
+        while len(advancing) > 0:
+            self._next_legs(advancing)
+            rows = np.searchsorted(voices, advancing)
+            on_leg = (
+                tick_frames[np.newaxis,:] >=
+                self.move_start_frames[advancing][:,np.newaxis])
+            positions[rows] = np.where(
+                on_leg[:,:,np.newaxis],
+                self._leg_positions(advancing, tick_frames),
+                positions[rows])
+            advancing = advancing[
+                self.leave_frames[advancing] <= tick_frames[-1]]
+
+        return positions
+
+    def get_frames(self, n_frames, out=None):
+        """
+        Renders the next n_frames of all voices mixed together.
+
+        Parameters
+        ----------
+        n_frames: int
+            The number of frames to render, a multiple of
+            control_rate_divisor.
+        out: array_like, (n_frames, n_channels) float32 or None
+            If given, the frames are rendered into this array.
+
+        Returns
+        -------
+        frames: array_like, (n_frames, n_channels)
+            The rendered frames.
+        """
+        K = self.control_rate_divisor
+        if n_frames % K != 0:
+            raise ValueError(
+                "n_frames ({}) must be a multiple of the control rate "
+                "divisor ({})".format(n_frames, K))
+        if out is None:
+            out = np.empty((n_frames, self.n_channels), dtype=np.float32)
+
+        voices = np.flatnonzero(self.active)
+        n_voices = len(voices)
+        if n_voices == 0:
+            out.fill(0)
+            self.frame += n_frames
+            return out
+        n_ticks = n_frames // K
+
+        # Gather the next chunk of every voice, (n_frames, V). Only voices
+        # whose chunk crosses their loop point need wrapping.
+        frame_indices = np.arange(n_frames)[:,np.newaxis]
+        cursors = self.cursors[voices]
+        lengths = self.lengths[voices]
+        indices = (self.offsets[voices] + cursors) + frame_indices
+        wrapping = np.flatnonzero(cursors + n_frames > lengths)
+        if len(wrapping) > 0:
+            indices[:,wrapping] = self.offsets[voices[wrapping]] + (
+                (cursors[wrapping] + frame_indices) % lengths[wrapping])
+        samples = self.audio[indices].astype(np.float32)
+        samples *= self.volumes[voices]
+        self.cursors[voices] = (cursors + n_frames) % lengths
+
+        # Hive volumes at each control tick, including the tick at the start
+        # of the next chunk, (V, T + 1, H)
+        tick_frames = self.frame + K * np.arange(n_ticks + 1, dtype=np.float64)
+        positions = self.sample_swarm_positions(voices, tick_frames)
+        gains = self.gain_kernel(
+            positions.reshape(-1, 2)).reshape(n_voices, n_ticks + 1, -1)
+
+        # Mix. Within each tick, frame k of the output is
+        #   (1 - r_k) sum_v samples[v, k] g0[v] + r_k sum_v samples[v, k] g1[v]
+        # for the volumes g0, g1 at either end of the tick. Stack g0 and g1
+        # side by side so that both sums over the voices are a single
+        # (K, V) x (V, 2H) product per tick, then interpolate.
+        H = self.n_hives
+        tick_gains = np.empty((n_ticks, n_voices, 2 * H), dtype=np.float32)
+        tick_gains[:,:,:H] = gains[:,:-1].transpose(1, 0, 2)
+        tick_gains[:,:,H:] = gains[:,1:].transpose(1, 0, 2)
+
+        mixed = np.matmul(samples.reshape(n_ticks, K, n_voices), tick_gains)
+
+        blocks = out.reshape(n_ticks, K, H)
+        np.multiply(
+            mixed[:,:,:H], self.weights[np.newaxis,:,0,np.newaxis], out=blocks)
+        blocks += mixed[:,:,H:] * self.weights[np.newaxis,:,1,np.newaxis]
+        if not np.may_share_memory(blocks, out):
+            # out couldn't be reshaped in place, so the mix went into a copy.
+            np.copyto(out, blocks.reshape(n_frames, H))
+
+        self.frame += n_frames
+        return out
@@ -6,12 +6,16 @@ The Human Hive
 import sys
 import time
 import argparse
+import functools
 import multiprocessing
 
 import numpy as np
-import pyaudio
-from humanhive import samplestream, utils, sources
+from humanhive import samplestream, utils, sources, hive
+from humanhive.automation import AUTOMATION_FORMATS, GainAutomation
+from humanhive.playback import SAMPLE_FORMATS, SoftLimiter
 from humanhive import HumanHive
+from humanhive.mixpool import partition
+from humanhive.offline import render_offline, render_parallel
 
 def build_parser():
     parser = argparse.ArgumentParser(__doc__)
@@ -29,11 +33,23 @@ def build_parser():
 
     parser.add_argument(
         "--output-device-id",
-        help="The ID for the output sound card to use.",
+        help=(
+            "The ID for the output sound card to use. Give several IDs to "
+            "spread the channels over several cards."),
         default=None,
+        nargs="+",
         # type=int
     )
 
+    parser.add_argument(
+        "--device-channels",
+        help=(
+            "The number of channels on each output card, when using several. "
+            "Defaults to splitting the channels evenly."),
+        default=None,
+        nargs="+",
+        type=int)
+
     parser.add_argument(
         "--input-device-id",
         help="The ID for the input sound card to use.",
@@ -49,31 +65,293 @@ def build_parser():
             "Directory for saving recordings. "
             "Will be created if it doesn't exist."))
 
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help=(
+            "Export latency and xrun metrics from each process to this file "
+            "as JSON lines, or to udp://host:port."))
+
+    parser.add_argument(
+        "--metrics-interval",
+        default=5.0,
+        type=float,
+        help="Time in seconds between metrics exports.")
+
+    parser.add_argument(
+        "--audio-backend",
+        default=None,
+        choices=["alsa", "pyaudio", "file"],
+        help=(
+            "The audio backend. Defaults to alsa on linux, pyaudio elsewhere. "
+            "With the file backend, --output-device-id is the output file."))
+
+    parser.add_argument(
+        "--n-frames-per-chunk",
+        default=1024,
+        type=int,
+        help="The number of frames rendered at a time.")
+
+    parser.add_argument(
+        "--period-size",
+        default=None,
+        type=int,
+        help=(
+            "The number of frames per audio device period, e.g. 128 or 256 "
+            "for low latency. Defaults to --n-frames-per-chunk."))
+
+    parser.add_argument(
+        "--periods",
+        default=4,
+        type=int,
+        help="The number of periods in the ALSA buffer.")
+
+    parser.add_argument(
+        "--input-channels",
+        default=2,
+        type=int,
+        help="The number of channels to capture with ALSA.")
+
+    parser.add_argument(
+        "--render-to",
+        default=None,
+        help=(
+            "Render offline, as fast as possible and without a sound card, "
+            "to this file instead of playing. Writes a WAV file if the name "
+            "ends in .wav, otherwise raw interleaved samples. Use "
+            "/dev/null to only measure the render speed."))
+
+    parser.add_argument(
+        "--duration",
+        default=60.,
+        type=float,
+        help="The number of seconds to render with --render-to.")
+
+    parser.add_argument(
+        "--render-workers",
+        default=1,
+        type=int,
+        help=(
+            "Render with --render-to in this many processes at once, each "
+            "taking a window of the timeline."))
+
+    parser.add_argument(
+        "--window-duration",
+        default=60.,
+        type=float,
+        help="The length in seconds of each window rendered by a worker.")
+
+    parser.add_argument(
+        "--seed",
+        default=None,
+        type=int,
+        help=(
+            "Seed the swarm of a render, to repeat it exactly. A random seed "
+            "is chosen and printed if not given."))
+
+    parser.add_argument(
+        "--mix-workers",
+        default=0,
+        type=int,
+        help=(
+            "Mix --worker-sources extra swarm sources in this many worker "
+            "processes, to use more than one core when playing."))
+
+    parser.add_argument(
+        "--worker-sources",
+        default=0,
+        type=int,
+        help="The number of swarm sources to spread over the mix workers.")
+
+    parser.add_argument(
+        "--layout",
+        default=None,
+        help=(
+            "A JSON file giving the positions of the hives, one per channel. "
+            "Defaults to a circle."))
+
+    parser.add_argument(
+        "--gain-threshold",
+        default=None,
+        type=float,
+        help=(
+            "Use sparse hive gains, only evaluating and mixing the hives "
+            "whose gain can be above this, e.g. 1e-3. This only pays off for "
+            "swarms evaluated at every frame. At the control rate the swarms "
+            "run at here, it is slower than mixing every hive, so leave it "
+            "unset unless profiling shows otherwise."))
+
+    parser.add_argument(
+        "--sample-format",
+        default="int16",
+        choices=sorted(SAMPLE_FORMATS),
+        help=(
+            "The sample format sent to the audio device: int16 (S16_LE), "
+            "int32 (S32_LE) or float32 (FLOAT_LE)."))
+
+    parser.add_argument(
+        "--limiter-threshold",
+        default=None,
+        type=float,
+        help=(
+            "Soft limit the mix above this fraction of full scale, e.g. 0.8, "
+            "rather than clipping it hard."))
+
+    parser.add_argument(
+        "--automation-minutes",
+        default=None,
+        type=float,
+        help=(
+            "Play the swarms back from this many minutes of gain automation, "
+            "rendered once and cached on disk, rather than modelling them."))
+
+    parser.add_argument(
+        "--automation-format",
+        default="float16",
+        choices=sorted(AUTOMATION_FORMATS),
+        help="The format gain automation is stored in.")
+
     return parser
 
 
+def build_source_bank(audio_data, n_channels, sample_rate, **kwargs):
+    """
+    Builds the sources of a render. Module level, so that render workers can
+    each build their own.
+    """
+    source_bank = sources.SourceBank()
+    source_bank.add_source(
+        sources.SwarmSource(audio_data, n_channels, sample_rate, **kwargs))
+    return source_bank
+
+
+def build_worker_source_bank(worker, n_workers, audio_data, n_channels,
+                             sample_rate, n_sources, **kwargs):
+    """
+    Builds one mix worker's share of n_sources swarm sources.
+    """
+    source_bank = sources.SourceBank()
+    for i in partition(range(n_sources), worker, n_workers):
+        source_bank.add_source(
+            sources.SwarmSource(
+                audio_data, n_channels, sample_rate, seed=i, **kwargs))
+    return source_bank
+
+
 if __name__ == "__main__":
     args = build_parser().parse_args()
 
     sample_rate = 48000#utils.get_sample_rate_for_device(args.output_device_id)
 
+    audio_data = samplestream.load_wave_file(
+        args.swarm_sample, mono=True)
+
+    layout = None
+    if args.layout is not None:
+        layout = hive.HiveLayout.from_file(args.layout)
+
+    limiter = None
+    if args.limiter_threshold is not None:
+        limiter = SoftLimiter(args.limiter_threshold)
+
+    automation = None
+    if args.automation_minutes is not None:
+        automation = GainAutomation(
+            layout if layout is not None
+            else hive.HiveLayout.circle(args.n_channels, 3),
+            sample_rate,
+            duration=60 * args.automation_minutes,
+            sample_format=args.automation_format)
+        print("Gain automation {} from {}".format(
+            "loaded" if automation.loaded_from_cache else "rendered",
+            automation.cache_file))
+
+    if args.render_to is not None:
+        seed = args.seed
+        if seed is None:
+            seed = np.random.randint(2**31)
+        print("Seed: {}".format(seed))
+        source_bank_factory = functools.partial(
+            build_source_bank,
+            audio_data,
+            args.n_channels,
+            sample_rate,
+            layout=layout,
+            gain_threshold=args.gain_threshold,
+            automation=automation,
+            seed=seed)
+
+        print("Rendering {} s to {}".format(args.duration, args.render_to))
+        if args.render_workers > 1:
+            stats = render_parallel(
+                source_bank_factory,
+                args.render_to,
+                args.n_channels,
+                sample_rate,
+                args.duration,
+                n_frames_per_chunk=args.n_frames_per_chunk,
+                window_duration=args.window_duration,
+                max_workers=args.render_workers,
+                sample_format=args.sample_format,
+                limiter=limiter)
+        else:
+            stats = render_offline(
+                source_bank_factory(),
+                args.render_to,
+                args.n_channels,
+                sample_rate,
+                args.duration,
+                n_frames_per_chunk=args.n_frames_per_chunk,
+                sample_format=args.sample_format,
+                limiter=limiter)
+        print("Rendered {:.1f} s in {:.2f} s ({:.1f}x real time)".format(
+            stats["duration"], stats["elapsed"], stats["real_time_factor"]))
+        sys.exit(0)
+
     print("Initialising...")
     humanhive = HumanHive(
         n_channels=args.n_channels,
-        output_device_id=args.output_device_id,
+        output_device_id=(
+            args.output_device_id[0]
+            if args.output_device_id is not None and
+            len(args.output_device_id) == 1
+            else args.output_device_id),
+        device_channels=args.device_channels,
         input_device_id=args.input_device_id,
         sample_rate=sample_rate,
-        master_volume=1.0)
-
+        master_volume=1.0,
+        metrics_path=args.metrics,
+        metrics_interval=args.metrics_interval,
+        audio_backend=args.audio_backend,
+        n_frames_per_chunk=args.n_frames_per_chunk,
+        period_size=args.period_size,
+        periods=args.periods,
+        input_channels=args.input_channels,
+        layout=layout,
+        gain_threshold=args.gain_threshold,
+        sample_format=args.sample_format,
+        limiter=limiter,
+        automation=automation,
+        mix_workers=args.mix_workers,
+        worker_source_bank_factory=functools.partial(
+            build_worker_source_bank,
+            audio_data=audio_data,
+            n_channels=args.n_channels,
+            sample_rate=sample_rate,
+            n_sources=args.worker_sources,
+            layout=layout,
+            gain_threshold=args.gain_threshold,
+            automation=automation))
 
-    audio_data = samplestream.load_wave_file(
-        args.swarm_sample, mono=True)
     # Add a source
     humanhive.source_bank.add_source(
         sources.SwarmSource(
             audio_data,
             n_channels=args.n_channels,
-            sample_rate=sample_rate))
+            sample_rate=sample_rate,
+            layout=layout,
+            gain_threshold=args.gain_threshold,
+            automation=automation))
 
 
     print("Entering HumanHive main loop")